@@ -0,0 +1,657 @@
+# job_store.py
+# ジョブ状態テーブル（convert_jobs / video_jobs_by_src / publish_queues）の読み書きをまとめたモジュール（レイヤで配布）
+#  - 型付きレコード Job / SrcJob / PublishQueue（__slots__ の dataclass。知らない属性は extra に入る）
+#  - get / get_many / put / put_many / update / delete / query（GSI）/ query_page（GSI を 1 ページずつ）/ scan。
+#    読み取りは fields で射影できる
+#  - 任意でプロセス内の読み取りキャッシュ（ウォームスタート間で同じジョブを読み直さない）
+#  - バックエンドは差し替え可能:
+#      JOB_STORE_BACKEND=dynamodb（既定） / sqlite（JOB_STORE_SQLITE_PATH） / memory
+#    sqlite / memory はパイプライン全体をオフラインで負荷試験するためのもの
+#  - 条件はバックエンド共通の形で渡す: if_exists / if_missing=(属性,..) / expect={属性: 値} / if_above={属性: 値}
+#  - 予約投稿: enqueue() でアカウントごとの待ち行列（publish_queues）に積む。取り出しは lambda_publish_scheduler
+#  - 未移行: ddb_helpers（status の段階遷移は OR を含む条件と list_append の履歴を 1 回の UpdateItem で書くため、
+#    バックエンド共通の条件では表せない。X アップロードのチェックポイントも同じモジュールにあるので一緒に残す）
+import os, json, time, copy, sqlite3, threading
+from dataclasses import dataclass, field, fields as dc_fields
+from decimal import Decimal
+
+REGION       = os.getenv("AWS_REGION", "ap-northeast-1")
+BACKEND      = os.getenv("JOB_STORE_BACKEND", "dynamodb")
+SQLITE_PATH  = os.getenv("JOB_STORE_SQLITE_PATH", "/tmp/job_store.sqlite3")
+CACHE_SEC    = float(os.getenv("JOB_STORE_CACHE_SEC", "0"))    # 0 でキャッシュしない
+QUEUES_TABLE = os.getenv("PUBLISH_QUEUES_TABLE", "publish_queues")
+DUE_INDEX    = os.getenv("JOBS_GSI_DUE", "sched_queue-publish_at-index")   # convert_jobs の GSI（予約中のジョブだけ載る）
+
+
+# ===== レコード =====
+def _num(v, default=0):
+    if v is None or v == "":
+        return default
+    return int(v) if isinstance(v, (int, Decimal)) or float(v).is_integer() else float(v)
+
+
+class _Record:
+    """Job / SrcJob 共通: テーブルの項目 dict との相互変換"""
+    __slots__ = ()
+    KEY = ""
+    NUMERIC = ()
+
+    @classmethod
+    def from_item(cls, item: dict):
+        known = {f.name for f in dc_fields(cls)} - {"extra"}
+        kwargs = {k: v for k, v in item.items() if k in known}
+        for k in cls.NUMERIC:
+            if k in kwargs:
+                kwargs[k] = _num(kwargs[k])
+        return cls(**kwargs, extra={k: v for k, v in item.items() if k not in known})
+
+    def to_item(self) -> dict:
+        item = dict(self.extra)
+        for f in dc_fields(self):
+            if f.name != "extra":
+                v = getattr(self, f.name)
+                if v is not None and v != "":
+                    item[f.name] = v
+        return item
+
+    def get(self, name: str, default=None):
+        if name != "extra" and name in self.__slots__:
+            v = getattr(self, name)
+            return default if v is None else v
+        return self.extra.get(name, default)
+
+    @property
+    def key(self):
+        return getattr(self, self.KEY)
+
+
+@dataclass(slots=True)
+class Job(_Record):
+    """convert_jobs の 1 件（presign / start が作成、各段が status を進める）"""
+    KEY = "job_id"
+    NUMERIC = ("created_at", "updated_at", "status_rank", "publish_at")
+
+    job_id: str
+    platform: str = ""
+    status: str = "pending"
+    created_at: int = 0
+    updated_at: int = 0
+    site_url: str = ""
+    wp_id: str = ""
+    ig_user_id: str = ""
+    caption: str = ""
+    text: str = ""
+    media_urls: list = None
+    media_objects: list = None  # X の予約投稿: media_urls と同じ順の自社バケットの {bucket, key}（他所の URL は None）
+    token_cipher: str = ""
+    in_bucket: str = ""
+    in_key: str = ""
+    out_bucket: str = ""
+    out_key: str = ""
+    publish_at: int = None      # 予約投稿の時刻（epoch 秒）
+    sched_queue: str = ""       # 予約中だけ入る（DUE_INDEX のパーティションキー。取り出すと消す）
+    extra: dict = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class SrcJob(_Record):
+    """video_jobs_by_src の 1 件（convert-worker が入力オブジェクトごとに記録）"""
+    KEY = "src_key"
+    NUMERIC = ("updated_at", "size_bytes", "seg_total")
+
+    src_key: str
+    status: str = ""
+    updated_at: int = 0
+    size_bytes: int = None
+    convert_path: str = ""
+    seg_total: int = None
+    extra: dict = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class PublishQueue(_Record):
+    """publish_queues の 1 件（プラットフォーム × アカウントごとの予約投稿の待ち行列）"""
+    KEY = "queue_key"
+    NUMERIC = ("pending", "next_at", "updated_at")
+
+    queue_key: str
+    platform: str = ""
+    account: str = ""
+    pending: int = 0            # 積んだ数 - 取り出した数（実際の件数以上に保つ）
+    next_at: int = None         # これ以前に取り出せるジョブがあるかもしれない時刻（無ければ空）
+    updated_at: int = 0
+    extra: dict = field(default_factory=dict)
+
+
+class ConditionFailed(Exception):
+    pass
+
+
+# ===== バックエンド =====
+class DynamoBackend:
+    def __init__(self, region=REGION):
+        import boto3
+        self.resource = boto3.resource("dynamodb", region_name=region)
+        self._tables = {}
+
+    def _t(self, table):
+        if table not in self._tables:
+            self._tables[table] = self.resource.Table(table)
+        return self._tables[table]
+
+    @staticmethod
+    def _projection(fields, key):
+        if not fields:
+            return {}
+        names = {f"#p{i}": f for i, f in enumerate(dict.fromkeys([key, *fields]))}
+        return {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+    def get(self, table, key, kv, fields=None):
+        return self._t(table).get_item(Key={key: kv}, **self._projection(fields, key)).get("Item")
+
+    def get_many(self, table, key, kvs, fields=None):
+        out = {}
+        for i in range(0, len(kvs), 100):
+            req = {table: {"Keys": [{key: k} for k in kvs[i:i + 100]], **self._projection(fields, key)}}
+            while req:
+                r = self.resource.batch_get_item(RequestItems=req)
+                for it in r.get("Responses", {}).get(table, []):
+                    out[it[key]] = it
+                req = r.get("UnprocessedKeys") or None
+        return out
+
+    def query(self, table, key, index, hash_attr, hash_value, range_attr=None, upto=None, limit=None, fields=None):
+        from boto3.dynamodb.conditions import Key
+        cond = Key(hash_attr).eq(hash_value)
+        if range_attr and upto is not None:
+            cond = cond & Key(range_attr).lte(upto)
+        kwargs = {"IndexName": index, "KeyConditionExpression": cond, **self._projection(fields, key)}
+        out = []
+        while True:
+            if limit:
+                kwargs["Limit"] = limit - len(out)
+            r = self._t(table).query(**kwargs)
+            out += r.get("Items", [])
+            if (limit and len(out) >= limit) or "LastEvaluatedKey" not in r:
+                return out
+            kwargs["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+
+    def query_page(self, table, key, index, hash_attr, hash_value, range_attr, gt=None, gte=None, desc=False,
+                   limit=None, start=None, fields=None):
+        from boto3.dynamodb.conditions import Key
+        cond = Key(hash_attr).eq(hash_value)
+        if gt is not None:
+            cond = cond & Key(range_attr).gt(gt)
+        elif gte is not None:
+            cond = cond & Key(range_attr).gte(gte)
+        kwargs = {"IndexName": index, "KeyConditionExpression": cond, "ScanIndexForward": not desc,
+                  **self._projection(fields, key)}
+        if limit:
+            kwargs["Limit"] = limit
+        if start:
+            kwargs["ExclusiveStartKey"] = start
+        r = self._t(table).query(**kwargs)
+        return r.get("Items", []), r.get("LastEvaluatedKey")
+
+    def scan(self, table, key, fields=None):
+        kwargs, out = self._projection(fields, key), []
+        while True:
+            r = self._t(table).scan(**kwargs)
+            out += r.get("Items", [])
+            if "LastEvaluatedKey" not in r:
+                return out
+            kwargs["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+
+    def put(self, table, key, item):
+        self._t(table).put_item(Item=item)
+
+    def put_many(self, table, key, items):
+        # batch_writer が 25 件ずつの BatchWriteItem と未処理分の再送を受け持つ
+        with self._t(table).batch_writer(overwrite_by_pkeys=[key]) as bw:
+            for it in items:
+                bw.put_item(Item=it)
+
+    def update(self, table, key, kv, set_=None, add=None, remove=(), if_exists=False, if_missing=(),
+               expect=None, if_above=None, return_new=False):
+        names, values, parts, conds = {}, {}, [], []
+        n = iter(range(10 ** 6))
+
+        def _name(a):
+            ph = f"#n{next(n)}"
+            names[ph] = a
+            return ph
+
+        def _value(v):
+            ph = f":v{next(n)}"
+            values[ph] = v
+            return ph
+
+        if set_:
+            parts.append("SET " + ", ".join(f"{_name(a)} = {_value(v)}" for a, v in set_.items()))
+        if add:
+            parts.append("ADD " + ", ".join(f"{_name(a)} {_value(v)}" for a, v in add.items()))
+        if remove:
+            parts.append("REMOVE " + ", ".join(_name(a) for a in remove))
+        if if_exists:
+            conds.append(f"attribute_exists({_name(key)})")
+        conds += [f"attribute_not_exists({_name(a)})" for a in if_missing]
+        conds += [f"{_name(a)} = {_value(v)}" for a, v in (expect or {}).items()]
+        for a, v in (if_above or {}).items():
+            ph = _name(a)
+            conds.append(f"(attribute_not_exists({ph}) OR {ph} > {_value(v)})")
+
+        kwargs = {"Key": {key: kv}, "UpdateExpression": " ".join(parts), "ExpressionAttributeNames": names}
+        if values:
+            kwargs["ExpressionAttributeValues"] = values
+        if conds:
+            kwargs["ConditionExpression"] = " AND ".join(conds)
+        if return_new:
+            kwargs["ReturnValues"] = "ALL_NEW"
+        t = self._t(table)
+        try:
+            r = t.update_item(**kwargs)
+        except t.meta.client.exceptions.ConditionalCheckFailedException:
+            raise ConditionFailed(kwargs.get("ConditionExpression"))
+        return r.get("Attributes")
+
+    def delete(self, table, key, kv):
+        self._t(table).delete_item(Key={key: kv})
+
+
+def _apply_update(item, key, kv, set_, add, remove, if_exists, if_missing, expect, if_above=None):
+    """sqlite / memory 共通: DynamoDB の UpdateItem と同じ意味で item を更新した新しい dict を返す"""
+    if if_exists and item is None:
+        raise ConditionFailed("attribute_exists")
+    cur = item or {}
+    for a in if_missing:
+        if a in cur:
+            raise ConditionFailed(f"attribute_not_exists({a})")
+    for a, v in (expect or {}).items():
+        if cur.get(a) != v:
+            raise ConditionFailed(f"{a} = {v!r}")
+    for a, v in (if_above or {}).items():
+        if a in cur and not cur[a] > v:
+            raise ConditionFailed(f"{a} > {v!r}")
+
+    new = copy.deepcopy(cur) if item is not None else {key: kv}
+    new.update(copy.deepcopy(set_ or {}))
+    for a, v in (add or {}).items():
+        if isinstance(v, set):
+            new[a] = set(new.get(a) or set()) | v
+        else:
+            new[a] = new.get(a, 0) + v
+    for a in remove:
+        new.pop(a, None)
+    return new
+
+
+class MemoryBackend:
+    """プロセス内の dict（テストや 1 プロセスのシミュレーション用）"""
+
+    def __init__(self):
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def _t(self, table):
+        return self.tables.setdefault(table, {})
+
+    @staticmethod
+    def _project(item, fields, key):
+        if item is None or not fields:
+            return copy.deepcopy(item)
+        return {k: copy.deepcopy(v) for k, v in item.items() if k == key or k in fields}
+
+    def get(self, table, key, kv, fields=None):
+        with self._lock:
+            return self._project(self._t(table).get(kv), fields, key)
+
+    def get_many(self, table, key, kvs, fields=None):
+        with self._lock:
+            t = self._t(table)
+            return {k: self._project(t[k], fields, key) for k in kvs if k in t}
+
+    def query(self, table, key, index, hash_attr, hash_value, range_attr=None, upto=None, limit=None, fields=None):
+        with self._lock:
+            hit = _select(self._t(table).values(), hash_attr, hash_value, range_attr, upto, limit)
+            return [self._project(it, fields, key) for it in hit]
+
+    def query_page(self, table, key, index, hash_attr, hash_value, range_attr, gt=None, gte=None, desc=False,
+                   limit=None, start=None, fields=None):
+        with self._lock:
+            hit, last = _page(self._t(table).values(), key, hash_attr, hash_value, range_attr, gt, gte, desc, limit,
+                              start)
+            return [self._project(it, fields, key) for it in hit], last
+
+    def scan(self, table, key, fields=None):
+        with self._lock:
+            return [self._project(it, fields, key) for it in self._t(table).values()]
+
+    def put(self, table, key, item):
+        with self._lock:
+            self._t(table)[item[key]] = copy.deepcopy(item)
+
+    def put_many(self, table, key, items):
+        for it in items:
+            self.put(table, key, it)
+
+    def update(self, table, key, kv, set_=None, add=None, remove=(), if_exists=False, if_missing=(),
+               expect=None, if_above=None, return_new=False):
+        with self._lock:
+            t = self._t(table)
+            t[kv] = _apply_update(t.get(kv), key, kv, set_, add, remove, if_exists, if_missing, expect, if_above)
+            return copy.deepcopy(t[kv]) if return_new else None
+
+    def delete(self, table, key, kv):
+        with self._lock:
+            self._t(table).pop(kv, None)
+
+
+def _enc(v):
+    if isinstance(v, set):
+        return {"__set__": sorted(v, key=str)}
+    if isinstance(v, Decimal):
+        return int(v) if v == v.to_integral_value() else float(v)
+    raise TypeError(type(v).__name__)
+
+
+def _dec(d):
+    return set(d["__set__"]) if "__set__" in d else d
+
+
+def _page(items, key, hash_attr, hash_value, range_attr, gt, gte, desc, limit, start):
+    """
+    sqlite / memory 共通: GSI の 1 ページ分の Query。(range_attr, key) の順で並べ、
+    start（前のページの最後の項目のキー。DynamoDB の LastEvaluatedKey と同じ形）の次から limit 件
+    """
+    hit = [it for it in items if it.get(hash_attr) == hash_value and range_attr in it
+           and (gt is None or it[range_attr] > gt) and (gte is None or it[range_attr] >= gte)]
+    order = lambda it: (it[range_attr], it[key])
+    hit.sort(key=order, reverse=desc)
+    if start:
+        pos = (start[range_attr], start[key])
+        hit = [it for it in hit if (order(it) < pos if desc else order(it) > pos)]
+    if limit and len(hit) > limit:
+        last = hit[limit - 1]
+        return hit[:limit], {key: last[key], hash_attr: hash_value, range_attr: last[range_attr]}
+    return hit, None
+
+
+def _select(items, hash_attr, hash_value, range_attr, upto, limit):
+    """sqlite / memory 共通: GSI の Query と同じく range_attr の昇順（range_attr が無い項目は載らない）"""
+    hit = [it for it in items if it.get(hash_attr) == hash_value and (not range_attr or range_attr in it)]
+    if range_attr:
+        if upto is not None:
+            hit = [it for it in hit if it[range_attr] <= upto]
+        hit.sort(key=lambda it: it[range_attr])
+    return hit[:limit] if limit else hit
+
+
+class SqliteBackend:
+    """
+    1 テーブル = (pk, doc JSON) の SQLite テーブル。複数プロセスから同じファイルを使える
+    （条件付き更新は BEGIN IMMEDIATE で直列化）
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._created = set()
+
+    def _conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+        return c
+
+    def _t(self, table):
+        if table not in self._created:
+            self._conn().execute(f'CREATE TABLE IF NOT EXISTS "{table}" (pk TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+            self._created.add(table)
+        return f'"{table}"'
+
+    @staticmethod
+    def _load(doc, fields, key):
+        item = json.loads(doc, object_hook=_dec)
+        return item if not fields else {k: v for k, v in item.items() if k == key or k in fields}
+
+    def get(self, table, key, kv, fields=None):
+        row = self._conn().execute(f"SELECT doc FROM {self._t(table)} WHERE pk = ?", (kv,)).fetchone()
+        return self._load(row[0], fields, key) if row else None
+
+    def get_many(self, table, key, kvs, fields=None):
+        out, t = {}, self._t(table)
+        for i in range(0, len(kvs), 500):
+            chunk = kvs[i:i + 500]
+            q = f"SELECT pk, doc FROM {t} WHERE pk IN ({','.join('?' * len(chunk))})"
+            for pk, doc in self._conn().execute(q, chunk):
+                out[pk] = self._load(doc, fields, key)
+        return out
+
+    def query(self, table, key, index, hash_attr, hash_value, range_attr=None, upto=None, limit=None, fields=None):
+        rows = self._conn().execute(f"SELECT doc FROM {self._t(table)} WHERE json_extract(doc, ?) = ?",
+                                    (f"$.{hash_attr}", hash_value))
+        hit = _select([json.loads(r[0], object_hook=_dec) for r in rows], hash_attr, hash_value, range_attr, upto, limit)
+        return [it if not fields else {k: v for k, v in it.items() if k == key or k in fields} for it in hit]
+
+    def query_page(self, table, key, index, hash_attr, hash_value, range_attr, gt=None, gte=None, desc=False,
+                   limit=None, start=None, fields=None):
+        rows = self._conn().execute(f"SELECT doc FROM {self._t(table)} WHERE json_extract(doc, ?) = ?",
+                                    (f"$.{hash_attr}", hash_value))
+        hit, last = _page([json.loads(r[0], object_hook=_dec) for r in rows], key, hash_attr, hash_value, range_attr,
+                          gt, gte, desc, limit, start)
+        return [it if not fields else {k: v for k, v in it.items() if k == key or k in fields} for it in hit], last
+
+    def scan(self, table, key, fields=None):
+        return [self._load(r[0], fields, key) for r in self._conn().execute(f"SELECT doc FROM {self._t(table)}")]
+
+    def put(self, table, key, item):
+        self.put_many(table, key, [item])
+
+    def put_many(self, table, key, items):
+        t, c = self._t(table), self._conn()
+        with c:
+            c.executemany(f"INSERT OR REPLACE INTO {t} (pk, doc) VALUES (?, ?)",
+                          [(it[key], json.dumps(it, default=_enc, ensure_ascii=False)) for it in items])
+
+    def update(self, table, key, kv, set_=None, add=None, remove=(), if_exists=False, if_missing=(),
+               expect=None, if_above=None, return_new=False):
+        t, c = self._t(table), self._conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            row = c.execute(f"SELECT doc FROM {t} WHERE pk = ?", (kv,)).fetchone()
+            new = _apply_update(json.loads(row[0], object_hook=_dec) if row else None,
+                                key, kv, set_, add, remove, if_exists, if_missing, expect, if_above)
+            c.execute(f"INSERT OR REPLACE INTO {t} (pk, doc) VALUES (?, ?)",
+                      (kv, json.dumps(new, default=_enc, ensure_ascii=False)))
+            c.execute("COMMIT")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        return new if return_new else None
+
+    def delete(self, table, key, kv):
+        c = self._conn()
+        with c:
+            c.execute(f"DELETE FROM {self._t(table)} WHERE pk = ?", (kv,))
+
+
+_backends = {}
+
+def backend(name: str = None):
+    """名前ごとにプロセス内で 1 つ（dynamodb / sqlite / memory）"""
+    name = name or BACKEND
+    if name not in _backends:
+        _backends[name] = {"dynamodb": DynamoBackend, "sqlite": SqliteBackend, "memory": MemoryBackend}[name]()
+    return _backends[name]
+
+
+# ===== ストア =====
+class JobStore:
+    """
+    1 テーブル分の入口。戻り値は record 型（Job / SrcJob）。
+    update は条件を満たさなければ False（return_new=True なら None）を返す。
+    """
+
+    def __init__(self, table: str, record=Job, backend_=None, cache_sec: float = None):
+        self.table = table
+        self.record = record
+        self.key = record.KEY
+        self.backend = backend_ or backend()
+        self.cache_sec = CACHE_SEC if cache_sec is None else cache_sec
+        self._cache = {}   # key -> (expires_at, item)   射影なしで読んだ完全な項目だけ入れる
+        self._lock = threading.Lock()
+
+    # --- キャッシュ ---
+    def _cached(self, kv):
+        if self.cache_sec <= 0:
+            return None
+        with self._lock:
+            hit = self._cache.get(kv)
+            if hit and hit[0] > time.time():
+                return hit[1]
+            self._cache.pop(kv, None)
+        return None
+
+    def _remember(self, kv, item):
+        if self.cache_sec > 0 and item is not None:
+            with self._lock:
+                self._cache[kv] = (time.time() + self.cache_sec, item)
+
+    def _forget(self, kv):
+        with self._lock:
+            self._cache.pop(kv, None)
+
+    def _wrap(self, item, fields=None):
+        if item is None:
+            return None
+        if fields:
+            item = {k: v for k, v in item.items() if k == self.key or k in fields}
+        return self.record.from_item(item)
+
+    # --- 読み取り ---
+    def get(self, kv, fields=None):
+        item = self._cached(kv)
+        if item is None:
+            item = self.backend.get(self.table, self.key, kv, fields)
+            if not fields:
+                self._remember(kv, item)
+        return self._wrap(item, fields)
+
+    def get_many(self, kvs, fields=None) -> dict:
+        kvs = list(dict.fromkeys(kvs))
+        out, missing = {}, []
+        for kv in kvs:
+            item = self._cached(kv)
+            if item is not None:
+                out[kv] = self._wrap(item, fields)
+            else:
+                missing.append(kv)
+        if missing:
+            for kv, item in self.backend.get_many(self.table, self.key, missing, fields).items():
+                if not fields:
+                    self._remember(kv, item)
+                out[kv] = self._wrap(item)
+        return out
+
+    def query(self, index, hash_attr, hash_value, range_attr=None, upto=None, limit=None, fields=None) -> list:
+        """GSI を hash_attr = hash_value（range_attr <= upto）で range_attr の昇順に読む（キャッシュは使わない）"""
+        items = self.backend.query(self.table, self.key, index, hash_attr, hash_value, range_attr, upto, limit, fields)
+        return [self._wrap(it) for it in items]
+
+    def query_page(self, index, hash_attr, hash_value, range_attr, gt=None, gte=None, desc=False, limit=None,
+                   start=None, fields=None):
+        """
+        GSI を 1 ページだけ読む（range_attr > gt / >= gte、desc=True で降順）。
+        戻り値: (records, next_start)。next_start を start に渡すと続きから（None なら終わり）
+        """
+        items, last = self.backend.query_page(self.table, self.key, index, hash_attr, hash_value, range_attr, gt=gt,
+                                              gte=gte, desc=desc, limit=limit, start=start, fields=fields)
+        return [self._wrap(it) for it in items], last
+
+    def scan(self, fields=None) -> list:
+        """全件（小さなテーブル向け。publish_queues など）"""
+        return [self._wrap(it) for it in self.backend.scan(self.table, self.key, fields)]
+
+    # --- 書き込み ---
+    def _item(self, rec) -> dict:
+        return rec.to_item() if isinstance(rec, _Record) else dict(rec)
+
+    def put(self, rec):
+        item = self._item(rec)
+        self.backend.put(self.table, self.key, item)
+        self._forget(item[self.key])
+
+    def put_many(self, recs):
+        items = [self._item(r) for r in recs]
+        if items:
+            self.backend.put_many(self.table, self.key, items)
+        for it in items:
+            self._forget(it[self.key])
+
+    def update(self, kv, set=None, add=None, remove=(), if_exists=False, if_missing=(), expect=None,
+               if_above=None, return_new=False):
+        """
+        set: 上書きする属性 / add: 数値の加算・セットへの追加 / remove: 削除する属性
+        if_exists: 項目が無ければ作らない / if_missing: これらの属性が無いときだけ / expect: 属性がこの値のときだけ
+        if_above: 属性が無いか、この値より大きいときだけ（「早いほうへ更新」に使う）
+        """
+        self._forget(kv)
+        try:
+            new = self.backend.update(self.table, self.key, kv, set_=set, add=add, remove=tuple(remove),
+                                      if_exists=if_exists, if_missing=tuple(if_missing), expect=expect,
+                                      if_above=if_above, return_new=return_new)
+        except ConditionFailed:
+            return None if return_new else False
+        return new if return_new else True
+
+    def delete(self, kv):
+        self.backend.delete(self.table, self.key, kv)
+        self._forget(kv)
+
+
+_stores = {}
+
+def store(table: str, record=Job) -> JobStore:
+    """テーブル名ごとにプロセス内で 1 つ（ウォームスタート間でキャッシュも共有）"""
+    if table not in _stores:
+        _stores[table] = JobStore(table, record)
+    return _stores[table]
+
+
+# ===== 予約投稿の待ち行列 =====
+def queue_key(platform: str, account: str) -> str:
+    return f"{(platform or '').lower()}#{account or '-'}"
+
+
+def enqueue(platform: str, account: str, publish_at: int) -> str:
+    """
+    プラットフォーム × アカウントの待ち行列に 1 件足す（pending +1、next_at は早いほうへ）。
+    戻り値はジョブの sched_queue に入れる値。ジョブを書く前に呼ぶこと（pending が実際の件数を下回らないように）
+    """
+    queues = store(QUEUES_TABLE, PublishQueue)
+    qk, at = queue_key(platform, account), int(publish_at)
+    queues.update(qk, set={"platform": (platform or "").lower(), "account": account or "-",
+                           "updated_at": int(time.time())}, add={"pending": 1})
+    queues.update(qk, set={"next_at": at}, if_above={"next_at": at})
+    return qk
+
+
+def parse_publish_at(v):
+    """publish_at の入力（epoch 秒 / ISO 8601。タイムゾーン無しは UTC）を epoch 秒に。空なら None、不正なら ValueError"""
+    if v is None or v == "":
+        return None
+    if isinstance(v, (int, float, Decimal)) and not isinstance(v, bool):
+        return int(v)
+    s = str(v).strip()
+    if s.lstrip("-").isdigit():
+        return int(s)
+    from datetime import datetime, timezone
+    dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
+    return int((dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp())
+
+
+def dequeue(qk: str, n: int = 1) -> dict:
+    """待ち行列の pending を n 減らす（取り出した・積むのをやめた分）。戻り値は更新後の項目"""
+    return store(QUEUES_TABLE, PublishQueue).update(qk, set={"updated_at": int(time.time())}, add={"pending": -n},
+                                                    return_new=True)
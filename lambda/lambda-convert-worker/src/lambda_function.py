@@ -1,13 +1,55 @@
-import os, json, time, urllib.parse, tempfile, shutil, subprocess, boto3
+import os, re, json, math, time, base64, struct, hashlib, urllib.parse, tempfile, shutil, subprocess, threading, boto3
+from concurrent.futures import ThreadPoolExecutor
+from job_store import SrcJob, store
+from s3_records import run_records
 
 AWS_REGION   = os.getenv("AWS_REGION", "ap-northeast-1")
 UPLOAD_BUCKET= os.getenv("UPLOAD_BUCKET")
 JOBS_TABLE   = os.getenv("JOBS_TABLE", "video_jobs_by_src")
+CONVERT_JOBS_TABLE = os.getenv("CONVERT_JOBS_TABLE", "convert_jobs")  # 変換状況を convert_status として反映（変更フィード用）
 FFMPEG       = "/opt/bin/ffmpeg"  # レイヤーの配置先
+FFPROBE      = "/opt/bin/ffprobe" # レイヤーに無ければ ffmpeg -i の出力を解析する
+LAMBDA_MEMORY_MB = int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1536"))
+# pipe: 入力を S3 の Range GET から ffmpeg の stdin へ流す（moov が先頭にある場合のみ。無理なら file にフォールバック）
+# file: 従来通り /tmp にダウンロードしてから変換
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "pipe")
+# 1 にすると出力を fragmented MP4 として stdout から S3 マルチパートアップロードへ直接流す（/tmp を使わない）
+STREAM_OUTPUT = os.getenv("STREAM_OUTPUT", "0") == "1"
+READ_CHUNK   = 8 * 1024 * 1024   # 入力の Range GET 単位
+PART_SIZE    = 8 * 1024 * 1024   # マルチパートの 1 パート（最後以外は 5MB 以上必須）
+# 分割並列変換: これ以上の長さ（秒）の入力は SEGMENT_SEC ごとに分けて別の呼び出しで変換し、最後に連結する（0 で無効）
+SEGMENT_MIN_SEC = float(os.getenv("SEGMENT_MIN_SEC", "180"))
+SEGMENT_SEC  = float(os.getenv("SEGMENT_SEC", "60"))
+MAX_SEGMENTS = int(os.getenv("MAX_SEGMENTS", "16"))
+WORK_PREFIX  = "work/"           # セグメントの置き場（UPLOAD_BUCKET 内。トリガー対象の in/ の外）
+RECORD_CONCURRENCY = int(os.getenv("RECORD_CONCURRENCY", "1"))  # 同時に変換するレコード数（CPU と /tmp を分け合う）
+# 変換キャッシュ: (入力 ETag/サイズ, 正規化した params, ENCODER_VERSION) が同じなら前回の出力をコピーする
+CACHE_TABLE  = os.getenv("CACHE_TABLE")               # 未設定ならキャッシュしない
+CACHE_BUCKET = os.getenv("CACHE_BUCKET") or UPLOAD_BUCKET
+CACHE_PREFIX = "cache/"
+CACHE_TTL_DAYS  = int(os.getenv("CACHE_TTL_DAYS", "7"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+ENCODER_VERSION = "x264-1"  # ffmpeg の引数や判定を変えたら上げる（古いキャッシュを使わないため）
+# 投稿先の制約（これを満たし、かつ params の目標も満たす入力は再エンコードしない）
+PLATFORM_LIMITS = {
+    "instagram": {  # Reels
+        "max_bytes": 300 * 1024 * 1024, "min_duration": 3, "max_duration": 900,
+        "max_long_side": 1920, "max_short_side": 1920, "min_fps": 23, "max_fps": 60,
+        "max_kbps": 25000, "max_audio_hz": 48000,
+    },
+    "x": {
+        "max_bytes": 512 * 1024 * 1024, "min_duration": 0.5, "max_duration": 140,
+        "max_long_side": 1920, "max_short_side": 1200, "min_fps": 0, "max_fps": 60,
+        "max_kbps": 25000, "max_audio_hz": 48000,
+    },
+}
 
 dynamodb = boto3.resource("dynamodb", region_name=AWS_REGION)
-table    = dynamodb.Table(JOBS_TABLE)
+table    = store(JOBS_TABLE, SrcJob)
+convert_jobs = store(CONVERT_JOBS_TABLE) if CONVERT_JOBS_TABLE else None
 s3       = boto3.client("s3", region_name=AWS_REGION)
+cache_table = dynamodb.Table(CACHE_TABLE) if CACHE_TABLE else None
+lambda_client = boto3.client("lambda", region_name=AWS_REGION)
 
 def _get_head_and_tags(bucket: str, key: str) -> tuple[dict, dict]:
     """HeadObject と Tagging を取得して dict 化して返す"""
@@ -19,149 +61,935 @@ def _get_head_and_tags(bucket: str, key: str) -> tuple[dict, dict]:
     tagset = s3.get_object_tagging(Bucket=bucket, Key=key).get("TagSet", [])
     tags = {t["Key"]: t["Value"] for t in tagset}
 
-    info = {"content_type": content_type, "metadata": metadata}
+    info = {"content_type": content_type, "metadata": metadata, "size": head.get("ContentLength", 0),
+            "etag": (head.get("ETag") or "").strip('"')}
     return info, tags
 
-def _update_status(src_key, status, size_bytes=None, extra=None):
-    update_expr = ["#s = :s", "updated_at = :t"]
-    ean = {"#s": "status"}
-    eav = {":s": status, ":t": int(time.time())}
+def _touch_convert_job(job_id, status):
+    """
+    convert_jobs[job_id] に convert_status を書き updated_at を進める。
+    site_url-updated_at-index の並びが変わるので、/jobs/changes や ETag に変換の進み具合が反映される。
+    """
+    if not job_id or not convert_jobs:
+        return
+    try:
+        # アップロードのみ（ジョブ無し）の場合は作らない
+        convert_jobs.update(job_id, set={"convert_status": status, "updated_at": int(time.time())}, add={"rev": 1},
+                            if_exists=True)
+    except Exception as e:
+        print("WARN convert_jobs update:", e)
 
+def _update_status(src_key, status, size_bytes=None, extra=None, if_missing=(), job_id=None, expect=None) -> bool:
+    """video_jobs_by_src を更新。if_missing の属性が既にある / expect と違うなら書かずに False"""
+    attrs = {"status": status, "updated_at": int(time.time())}
     if size_bytes is not None:
-        update_expr.append("size_bytes = :sz")
-        eav[":sz"] = int(size_bytes)
-
-    if extra:
-        for i, (k_attr, v) in enumerate(extra.items()):
-            ph = f":v{i}"
-            update_expr.append(f"{k_attr} = {ph}")
-            eav[ph] = v
-
-    table.update_item(
-        Key={"src_key": src_key},
-        UpdateExpression="SET " + ", ".join(update_expr),
-        ExpressionAttributeNames=ean,
-        ExpressionAttributeValues=eav,
-    )
+        attrs["size_bytes"] = int(size_bytes)
+    attrs.update(extra or {})
 
-def lambda_handler(event, ctx):
-    
-    # S3:ObjectCreated イベント想定
-    for rec in event.get("Records", []):
-        bucket = rec["s3"]["bucket"]["name"]
-        key = urllib.parse.unquote_plus(rec["s3"]["object"]["key"])
-
-        # 早期フィルタ
-        if UPLOAD_BUCKET and bucket != UPLOAD_BUCKET:
-            print("skip other bucket:", bucket); continue
-        
-        # ここで HeadObject / Tagging を取得
-        info, tags = _get_head_and_tags(bucket, key)
-        print("INFO content_type:", info["content_type"])
-        print("INFO metadata:", info["metadata"])
-        print("INFO tags:", tags)
-        #　metadata又はtagが空なら変換処理しない
-        if info["metadata"]=={} and tags=={}:
-            print("skip not tagged:", key); continue
-        #　出力先がないなら変換処理しない
-        if tags.get("out_key") == "":
-            print("skip not uploaded:", key);
-        # 出力先情報 
-        dst_key = tags.get("out_key")
-        dst_bucket = tags.get("out_bucket")
-
-        # 作業ディレクトリ
-        work = tempfile.mkdtemp(prefix="ffwork_", dir="/tmp")
-        in_path  = os.path.join(work, "input.mp4")
-        out_path = os.path.join(work, "output.mp4")
+    if not table.update(src_key, set=attrs, if_missing=if_missing, expect=expect):
+        return False
+    _touch_convert_job(job_id, status)
+    return True
+
+def _presigned(bucket: str, key: str) -> str:
+    """ffmpeg / ffprobe に直接読ませるための GET URL"""
+    return s3.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=3600)
 
+def _parse_params(md: dict) -> dict:
+    """metadata の params（または params-b64）を dict にする"""
+    raw = md.get("params")
+    if not raw and md.get("params-b64"):
         try:
-            print("[DL] s3://%s/%s -> %s" % (bucket, key, in_path))
-            s3.download_file(bucket, key, in_path)
-            md = info.get("metadata", {})  # {'params': '{"width":1080,...}'}
-            params = {}
+            raw = base64.b64decode(md["params-b64"]).decode("utf-8")
+        except Exception as e:
+            print("WARN: params-b64 decode failed:", e)
+    if raw:  # 文字列をdictへ
+        try:
+            return json.loads(raw)
+        except Exception as e:
+            print("WARN: params JSON parse failed:", e)
+    return {}
+
+def _kbps(v) -> int:
+    """'5M' / '128k' / 5000000 → kbps"""
+    v = str(v).strip().lower()
+    if v.endswith("m"):
+        return int(float(v[:-1]) * 1000)
+    if v.endswith("k"):
+        return int(float(v[:-1]))
+    return int(float(v) / 1000) if v else 0
+
+# ===== 変換キャッシュ =====
+# cache_table: {cache_key, bucket, key, size, created_at, last_hit_at, expires_at(TTL)}
+# 実体は CACHE_BUCKET の cache/<cache_key>.mp4（同じ日数のライフサイクルで削除）
+# 合計サイズは cache_key=__total__ の total_bytes に ADD で数え、上限を超えたときだけ全件を読んで古いものから消す
+# （TTL で消えた分は減らないので多めに数えるが、sweep が実測値で置き直す）
+CACHE_TOTAL_KEY = "__total__"
+
+def _cache_key(etag: str, size: int, params: dict) -> str:
+    """既定値を埋めて表記ゆれ（"30" と 30、"5M" と "5000k" など）を吸収した params でハッシュする"""
+    canon = {
+        "width": int(params.get("width", 1080)),
+        "height": int(params.get("height", 1920)),
+        "fps": int(params.get("fps", 30)),
+        "video_kbps": _kbps(params.get("video_bitrate", "5M")),
+        "audio_kbps": _kbps(params.get("audio_bitrate", "128k")),
+        "audio_samplerate": int(params.get("audio_samplerate", 44100)),
+        "tune": params.get("tune") or "",
+        "platforms": sorted(params.get("platforms") or PLATFORM_LIMITS.keys()),
+    }
+    raw = "|".join([etag, str(size), json.dumps(canon, sort_keys=True, separators=(",", ":")), ENCODER_VERSION])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _cache_get(cache_key: str, dst_bucket: str, dst_key: str, out_meta: dict) -> bool:
+    """ヒットしたら出力先へサーバサイドコピーして True"""
+    item = cache_table.get_item(Key={"cache_key": cache_key}).get("Item")
+    if not item or int(item.get("expires_at", 0)) <= time.time():
+        return False
+    try:
+        s3.copy_object(
+            Bucket=dst_bucket, Key=dst_key,
+            CopySource={"Bucket": item["bucket"], "Key": item["key"]},
+            ContentType="video/mp4", Metadata=out_meta, MetadataDirective="REPLACE",
+        )
+    except s3.exceptions.ClientError as e:
+        # 実体がライフサイクル等で消えていたら索引も消してミス扱い
+        print("WARN cache object missing:", item["key"], e)
+        cache_table.delete_item(Key={"cache_key": cache_key})
+        _cache_total_add(-int(item.get("size", 0)))
+        return False
+    cache_table.update_item(
+        Key={"cache_key": cache_key},
+        UpdateExpression="SET last_hit_at = :t ADD hits :one",
+        ExpressionAttributeValues={":t": int(time.time()), ":one": 1},
+    )
+    return True
+
+def _cache_put(cache_key: str, dst_bucket: str, dst_key: str, size_bytes: int):
+    """出力を cache/ に複製して索引を書く。合計が容量上限を超えたら古いものから消す"""
+    obj_key = f"{CACHE_PREFIX}{cache_key}.mp4"
+    s3.copy_object(Bucket=CACHE_BUCKET, Key=obj_key, CopySource={"Bucket": dst_bucket, "Key": dst_key})
+    now = int(time.time())
+    cache_table.put_item(Item={
+        "cache_key": cache_key, "bucket": CACHE_BUCKET, "key": obj_key, "size": int(size_bytes),
+        "created_at": now, "last_hit_at": now, "expires_at": now + CACHE_TTL_DAYS * 86400,
+    })
+    if _cache_total_add(size_bytes) > CACHE_MAX_BYTES:
+        _cache_sweep()
+
+def _cache_total_add(delta: int) -> int:
+    """合計サイズのカウンタを delta 進めて、進めた後の値を返す"""
+    r = cache_table.update_item(
+        Key={"cache_key": CACHE_TOTAL_KEY},
+        UpdateExpression="ADD total_bytes :d",
+        ExpressionAttributeValues={":d": int(delta)},
+        ReturnValues="UPDATED_NEW",
+    )
+    return int(r["Attributes"]["total_bytes"])
+
+def _cache_sweep():
+    items, counted = [], 0
+    kwargs = {"ProjectionExpression": "cache_key, #k, #sz, last_hit_at, total_bytes",
+              "ExpressionAttributeNames": {"#k": "key", "#sz": "size"}}
+    while True:
+        r = cache_table.scan(**kwargs)
+        for i in r.get("Items", []):
+            if i["cache_key"] == CACHE_TOTAL_KEY:
+                counted = int(i.get("total_bytes", 0))
+            else:
+                items.append(i)
+        if "LastEvaluatedKey" not in r:
+            break
+        kwargs["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+    total = sum(int(i.get("size", 0)) for i in items)
+    # 最後に使われたのが古い順に消す
+    for i in sorted(items, key=lambda i: int(i.get("last_hit_at", 0))):
+        if total <= CACHE_MAX_BYTES:
+            break
+        cache_table.delete_item(Key={"cache_key": i["cache_key"]})
+        s3.delete_object(Bucket=CACHE_BUCKET, Key=i["key"])
+        total -= int(i.get("size", 0))
+        print("[CACHE] evict", i["cache_key"], "size=", i.get("size"))
+    # カウンタを数え直した値に合わせる（TTL で消えた分・重複して数えた分のずれを戻す）。
+    # 差分を ADD するので、読んだ後に他の呼び出しが足した分は消さない
+    _cache_total_add(total - counted)
+    print("[CACHE] sweep items=", len(items), "total=", total)
+
+def _probe_input(src: str) -> dict:
+    """
+    入力のストリーム情報を返す。ffprobe があればその JSON、無ければ ffmpeg -i の stderr を解析。
+    失敗時は {}（プランナーは全再エンコードにフォールバック）。
+    """
+    try:
+        if os.path.exists(FFPROBE):
+            out = subprocess.run(
+                [FFPROBE, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", src],
+                capture_output=True, text=True, timeout=60,
+            ).stdout
+            return _parse_ffprobe_json(json.loads(out or "{}"))
+        err = subprocess.run([FFMPEG, "-hide_banner", "-i", src], capture_output=True, text=True, timeout=60).stderr
+        return _parse_ffmpeg_banner(err)
+    except Exception as e:
+        print("WARN probe failed:", e)
+        return {}
+
+def _parse_ffprobe_json(j: dict) -> dict:
+    info = {"duration": float((j.get("format") or {}).get("duration") or 0)}
+    for st in j.get("streams", []):
+        if st.get("codec_type") == "video" and "video" not in info:
+            num, _, den = (st.get("avg_frame_rate") or "0/1").partition("/")
+            rot = abs(int(float((st.get("tags") or {}).get("rotate", 0) or 0)))
+            for sd in st.get("side_data_list") or []:
+                rot = abs(int(float(sd.get("rotation", rot) or 0)))
+            w, h = int(st.get("width", 0)), int(st.get("height", 0))
+            info["video"] = {
+                "codec": st.get("codec_name", ""),
+                "profile": st.get("profile", ""),
+                "pix_fmt": st.get("pix_fmt", ""),
+                "width": h if rot in (90, 270) else w,
+                "height": w if rot in (90, 270) else h,
+                "fps": float(num) / float(den or 1) if float(den or 1) else 0.0,
+                "kbps": int(st.get("bit_rate") or 0) // 1000,
+            }
+        elif st.get("codec_type") == "audio" and "audio" not in info:
+            info["audio"] = {
+                "codec": st.get("codec_name", ""),
+                "sample_rate": int(st.get("sample_rate") or 0),
+                "kbps": int(st.get("bit_rate") or 0) // 1000,
+            }
+    return info
+
+def _parse_ffmpeg_banner(err: str) -> dict:
+    info = {}
+    m = re.search(r"Duration: (\d+):(\d+):([\d.]+)", err)
+    if m:
+        info["duration"] = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+    rot = re.search(r"rotation of (-?[\d.]+) degrees|rotate\s*:\s*(-?\d+)", err)
+    rot = abs(int(float(rot.group(1) or rot.group(2)))) if rot else 0
+
+    m = re.search(r"Stream #\S+: Video: (\w+)(?: \(([^)]*)\))?[^\n]*", err)
+    if m:
+        line = m.group(0)
+        size = re.search(r", (\d{2,5})x(\d{2,5})", line)
+        w, h = (int(size.group(1)), int(size.group(2))) if size else (0, 0)
+        pix = re.search(r", (yuv\w+|nv\d+|gray\w*|rgb\w+|bgr\w+)", line)
+        fps = re.search(r", ([\d.]+) fps", line)
+        kbps = re.search(r", (\d+) kb/s", line)
+        info["video"] = {
+            "codec": m.group(1),
+            "profile": m.group(2) or "",
+            "pix_fmt": pix.group(1) if pix else "",
+            "width": h if rot in (90, 270) else w,
+            "height": w if rot in (90, 270) else h,
+            "fps": float(fps.group(1)) if fps else 0.0,
+            "kbps": int(kbps.group(1)) if kbps else 0,
+        }
+    m = re.search(r"Stream #\S+: Audio: (\w+)[^\n]*", err)
+    if m:
+        line = m.group(0)
+        hz = re.search(r", (\d+) Hz", line)
+        kbps = re.search(r", (\d+) kb/s", line)
+        info["audio"] = {
+            "codec": m.group(1),
+            "sample_rate": int(hz.group(1)) if hz else 0,
+            "kbps": int(kbps.group(1)) if kbps else 0,
+        }
+    return info
+
+def _plan_encoding(probe: dict, params: dict) -> dict:
+    """
+    入力の probe 結果と Lambda のメモリ量（≒ vCPU 数）から ffmpeg の実行計画を決める。
+      - threads / preset: 1769MB ≒ 1 vCPU（最大 6）。4K 入力で vCPU が少なければ preset を軽くする
+      - scale: 既に width×height に収まっていて偶数サイズならスケール/パッドを省略
+      - video/audio: コーデック・ビットレート・fps 等が目標を満たせばストリームコピー
+    """
+    width  = int(params.get("width", 1080))
+    height = int(params.get("height", 1920))
+    fps    = int(params.get("fps", 30))
+    vkbps  = _kbps(params.get("video_bitrate", "5M"))
+    akbps  = _kbps(params.get("audio_bitrate", "128k"))
+    asr    = int(params.get("audio_samplerate", 44100))
+
+    vcpus = max(1, min(6, math.ceil(LAMBDA_MEMORY_MB / 1769)))
+    v = probe.get("video") or {}
+    a = probe.get("audio") or {}
+    src_pixels = v.get("width", 0) * v.get("height", 0)
+
+    preset = {1: "veryfast", 2: "faster", 3: "fast", 4: "fast"}.get(vcpus, "medium")
+    if src_pixels > 1920 * 1080 and vcpus <= 2:
+        preset = "superfast"  # 4K→1080p の縮小はデコード/スケールだけで重いのでエンコードを軽くする
+
+    fits = bool(v) and v["width"] <= width and v["height"] <= height
+    even = bool(v) and v["width"] % 2 == 0 and v["height"] % 2 == 0
+    fps_ok = bool(v) and 0 < v["fps"] <= fps + 0.5
+
+    video_copy = (
+        fits and even and fps_ok
+        and v["codec"] == "h264"
+        and v["pix_fmt"] == "yuv420p"
+        and v["profile"].lower() in ("high", "main", "baseline", "constrained baseline")
+        and 0 < v["kbps"] <= vkbps
+    )
+    audio_copy = (
+        bool(a) and a["codec"] == "aac"
+        and a["sample_rate"] == asr
+        and 0 < a["kbps"] <= akbps * 1.1
+    )
 
-            raw = md.get("params")
-            if raw:  # 文字列をdictへ
+    plan = {
+        "threads": vcpus,
+        "preset": preset,
+        "tune": params.get("tune") or None,
+        "scale": not (fits and even),
+        "keep_fps": fps_ok,
+        "video": "copy" if video_copy else "encode",
+        "audio": "none" if probe and not a else ("copy" if audio_copy else "encode"),
+        "vcpus": vcpus,
+    }
+    print("[PLAN]", plan, "probe=", probe)
+    return plan
+
+def _check_compliance(probe: dict, plan: dict, size: int, params: dict) -> list:
+    """
+    再エンコード不要かを判定し、満たしていない理由のリストを返す（空なら適合）。
+      - 映像/音声ともプランナーがストリームコピー可と判断していること（= params の目標を満たす）
+      - params["platforms"]（既定: instagram と x）すべての制約内であること
+    """
+    if not probe:
+        return ["probe_failed"]
+    reasons = []
+    if plan["video"] != "copy":
+        reasons.append("video_needs_encode")
+    if plan["audio"] == "encode":
+        reasons.append("audio_needs_encode")
+    v = probe.get("video") or {}
+    a = probe.get("audio") or {}
+    dur = probe.get("duration", 0)
+    long_side, short_side = max(v.get("width", 0), v.get("height", 0)), min(v.get("width", 0), v.get("height", 0))
+
+    for name in params.get("platforms") or PLATFORM_LIMITS.keys():
+        lim = PLATFORM_LIMITS.get(name)
+        if not lim:
+            continue
+        if size > lim["max_bytes"]:
+            reasons.append(f"{name}:size")
+        if not lim["min_duration"] <= dur <= lim["max_duration"]:
+            reasons.append(f"{name}:duration")
+        if long_side > lim["max_long_side"] or short_side > lim["max_short_side"]:
+            reasons.append(f"{name}:dimensions")
+        if not lim["min_fps"] <= v.get("fps", 0) <= lim["max_fps"]:
+            reasons.append(f"{name}:fps")
+        if v.get("kbps", 0) > lim["max_kbps"]:
+            reasons.append(f"{name}:bitrate")
+        if a and a.get("sample_rate", 0) > lim["max_audio_hz"]:
+            reasons.append(f"{name}:audio_hz")
+    return reasons
+
+def _remux_cmd(src: str, dst: str) -> list:
+    """コンテナだけ作り直す（moov を先頭へ）"""
+    return [FFMPEG, "-y", "-i", src, "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy", "-movflags", "+faststart", dst]
+
+def _build_ffmpeg_cmd(src: str, dst: str, params: dict, fragmented: bool = False, plan: dict = None,
+                      seek: tuple = None) -> list:
+    width  = int(params.get("width", 1080))
+    height = int(params.get("height", 1920))
+    fps    = int(params.get("fps", 30))
+    vbr    = str(params.get("video_bitrate", "5M"))
+    abr    = str(params.get("audio_bitrate", "128k"))
+    asr    = int(params.get("audio_samplerate", 44100))
+    plan   = plan or {"scale": True, "keep_fps": False, "video": "encode", "audio": "encode"}
+
+    vf = (
+        f"scale='min({width},iw)':'min({height},ih)':"
+        "force_original_aspect_ratio=decrease,"
+        "pad=ceil(iw/2)*2:ceil(ih/2)*2:(ow-iw)/2:(oh-ih)/2"
+    )
+    # faststart は出力ファイルを後から書き換えるのでシーク不可の pipe では使えない
+    movflags = "frag_keyframe+empty_moov+default_base_moof" if fragmented else "+faststart"
+
+    cmd = [FFMPEG, "-y"]
+    if seek:
+        # 入力側シーク（分割変換のセグメント）。duration が None なら末尾まで
+        cmd += ["-ss", f"{seek[0]:.3f}"]
+        if seek[1]:
+            cmd += ["-t", f"{seek[1]:.3f}"]
+    cmd += ["-i", src]
+    if plan.get("threads"):
+        cmd += ["-threads", str(plan["threads"])]
+
+    if plan["video"] == "copy":
+        cmd += ["-c:v", "copy"]
+    else:
+        # 1080p60 を超える場合は level 4.1 では足りない
+        level = "4.2" if width * height * fps > 1920 * 1080 * 30 else "4.1"
+        if plan["scale"]:
+            cmd += ["-vf", vf]
+        if not plan["keep_fps"]:
+            cmd += ["-r", str(fps)]
+        cmd += [
+            "-c:v", "libx264",
+            "-profile:v", "high", "-level", level,
+            "-pix_fmt", "yuv420p",
+            "-b:v", vbr, "-maxrate", vbr, "-bufsize", f"{_kbps(vbr) * 2}k",
+            "-g", str(max(1, fps*2)),
+        ]
+        if plan.get("preset"):
+            cmd += ["-preset", plan["preset"]]
+        if plan.get("tune"):
+            cmd += ["-tune", plan["tune"]]
+
+    if plan["audio"] == "copy":
+        cmd += ["-c:a", "copy"]
+    elif plan["audio"] == "none":
+        cmd += ["-an"]
+    else:
+        cmd += ["-c:a", "aac", "-b:a", abr, "-ar", str(asr)]
+
+    cmd += ["-movflags", movflags]
+    if fragmented:
+        cmd += ["-f", "mp4"]
+    cmd.append(dst)
+    return cmd
+
+def _moov_before_mdat(bucket: str, key: str, size: int) -> bool:
+    """
+    MP4/MOV のトップレベル box を先頭から辿り、moov が mdat より前にあるか調べる。
+    （moov が後ろにあると demuxer がシークするため stdin からは読めない）
+    """
+    offset = 0
+    for _ in range(16):
+        if offset + 8 > size:
+            return False
+        hdr = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{offset + 15}")["Body"].read()
+        box_size, box_type = struct.unpack(">I4s", hdr[:8])
+        if box_size == 1 and len(hdr) >= 16:
+            box_size = struct.unpack(">Q", hdr[8:16])[0]
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat" or box_size < 8:
+            return False
+        offset += box_size
+    return False
+
+def _feed_stdin(proc, bucket: str, key: str, size: int):
+    """S3 を READ_CHUNK ごとの Range GET で読み、ffmpeg の stdin に書き込む（スレッドで実行）"""
+    try:
+        for start in range(0, size, READ_CHUNK):
+            end = min(start + READ_CHUNK, size) - 1
+            for attempt in range(3):
                 try:
-                    params = json.loads(raw)
+                    chunk = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")["Body"].read()
+                    break
                 except Exception as e:
-                    print("WARN: params JSON parse failed:", e)
-                    params = {}
-
-            width  = int(params.get("width", 1080))
-            height = int(params.get("height", 1920))
-            fps    = int(params.get("fps", 30))
-            vbr    = str(params.get("video_bitrate", "5M"))
-            abr    = str(params.get("audio_bitrate", "128k"))
-            asr    = int(params.get("audio_samplerate", 44100))
-
-            vf = (
-                f"scale='min({width},iw)':'min({height},ih)':"
-                "force_original_aspect_ratio=decrease,"
-                "pad=ceil(iw/2)*2:ceil(ih/2)*2:(ow-iw)/2:(oh-ih)/2"
-            )
-
-            cmd = [
-                FFMPEG, "-y",
-                "-i", in_path,
-                "-vf", vf,
-                "-r", str(fps),
-                "-c:v", "libx264",
-                "-profile:v", "high", "-level", "4.1",
-                "-pix_fmt", "yuv420p",
-                "-b:v", vbr, "-maxrate", vbr, "-bufsize", "10M",
-                "-g", str(max(1, fps*2)),
-                "-c:a", "aac", "-b:a", abr, "-ar", str(asr),
-                "-movflags", "+faststart",
-                out_path
-            ]
-            print("[CMD]", " ".join(cmd));
-            t0 = time.time()
-            rc = subprocess.run(cmd, capture_output=True, text=True).returncode
-            print("[FFMPEG] rc=", rc, "elapsed=", round(time.time()-t0,2), "s")
-            if rc != 0 or not os.path.exists(out_path):
-                _update_status(k, "error")
-                # 直近のエラーメッセージをログ
-                print("[ERR] ffmpeg failed")
-                continue
-
-            print("[UL] %s -> s3://%s/%s" % (out_path, dst_bucket, dst_key))
-            # metadataを渡す
-            out_meta={}
-            # job-id（必須）
-            job_id = md.get("job-id")
-            if job_id:
-                out_meta["job-id"] = job_id
-            # ← Webhook の Base64
-            cb_b64  = md.get("cb-b64")                  
-            if cb_b64:
-                out_meta["cb-b64"] = cb_b64
-                
-            s3.upload_file(
-                out_path, 
-                dst_bucket, 
-                dst_key, 
-                ExtraArgs={
-                    "ContentType":"video/mp4",
-                    "Metadata": out_meta,  
-                }
-            )
-            # S3の実体を確認（サイズ・ETag・ContentTypeなど取れる）
-            head = s3.head_object(Bucket=dst_bucket, Key=dst_key)
-            size_bytes = head["ContentLength"]
-            content_type = head.get("ContentType")
-            etag = head.get("ETag")
-            print("HEAD:", content_type, size_bytes, etag)
-            _update_status(
-                key, 
-                "done",
-                size_bytes=size_bytes,
-                extra={"content_type": content_type, "etag": etag},
-            )
-
-        finally:
-            try:
-                shutil.rmtree(work)
-            except Exception as e:
-                print("cleanup warn:", e)
+                    print("WARN range read retry:", start, e)
+                    if attempt == 2:
+                        raise
+                    time.sleep(2 ** attempt)
+            proc.stdin.write(chunk)
+    except BrokenPipeError:
+        print("WARN ffmpeg closed stdin early")
+    finally:
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+
+class _MultipartSink:
+    """ffmpeg の stdout を PART_SIZE ごとに S3 マルチパートアップロードへ流す（スレッドで実行）"""
+
+    def __init__(self, bucket: str, key: str, content_type: str, metadata: dict):
+        self.bucket, self.key = bucket, key
+        self.upload_id = s3.create_multipart_upload(
+            Bucket=bucket, Key=key, ContentType=content_type, Metadata=metadata
+        )["UploadId"]
+        self.parts = []
+        self.size = 0
+        self.error = None
+
+    def _put(self, number: int, data: bytes):
+        r = s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                           PartNumber=number, Body=data)
+        return {"PartNumber": number, "ETag": r["ETag"]}
+
+    def consume(self, stream):
+        try:
+            # 読み込みとアップロードを重ねるため 2 並列（保持するパートは最大 2 つ）
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                futures, number = [], 0
+                while True:
+                    data = stream.read(PART_SIZE)
+                    if not data:
+                        break
+                    number += 1
+                    self.size += len(data)
+                    if len(futures) >= 2:
+                        self.parts.append(futures.pop(0).result())
+                    futures.append(pool.submit(self._put, number, data))
+                for f in futures:
+                    self.parts.append(f.result())
+        except Exception as e:
+            self.error = e
+            # ffmpeg が stdout 書き込みで詰まらないよう残りを読み捨てる
+            while stream.read(PART_SIZE):
+                pass
+
+    def complete(self):
+        if not self.parts:
+            # 空出力は完了できないので空オブジェクトにはしない
+            raise RuntimeError("no output from ffmpeg")
+        s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": sorted(self.parts, key=lambda p: p["PartNumber"])},
+        )
+
+    def abort(self):
+        try:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print("WARN abort multipart:", e)
+
+def _run_ffmpeg(cmd: list, feeder=None, sink=None) -> tuple[int, str]:
+    """
+    ffmpeg を起動し、stdin 供給 / stdout 回収をスレッドで並行させる。戻り値: (rc, stderr の末尾)
+    入力供給が途中で失敗した場合は、出力が途切れていても rc=0 になり得るので rc=-1 とみなす。
+    """
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if feeder else subprocess.DEVNULL,
+        stdout=subprocess.PIPE if sink else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    feed_errors = []
+
+    def _guarded_feed(p):
+        try:
+            feeder(p)
+        except Exception as e:
+            feed_errors.append(e)
+
+    threads = []
+    if feeder:
+        threads.append(threading.Thread(target=_guarded_feed, args=(proc,), daemon=True))
+    if sink:
+        threads.append(threading.Thread(target=sink.consume, args=(proc.stdout,), daemon=True))
+    for t in threads:
+        t.start()
+    err = proc.stderr.read().decode("utf-8", errors="replace")
+    rc = proc.wait()
+    for t in threads:
+        t.join()
+    if feed_errors:
+        print("[ERR] input feed failed:", feed_errors[0])
+        rc = rc or -1
+    return rc, err[-2000:]
+
+def _transcode(bucket, key, size, dst_bucket, dst_key, params, out_meta, work, cache_key=None) -> dict:
+    """
+    入力 → ffmpeg → 出力 を実行し、各フェーズの所要時間を返す。
+      経路: 投稿先の制約と params を満たし moov も先頭なら S3 コピー、満たすが moov が後ろなら remux、
+            それ以外は再エンコード（選んだ経路は戻り値の path）
+      入力: PIPELINE_MODE=pipe かつ moov 先頭なら S3 → stdin、それ以外は /tmp にダウンロード
+      出力: STREAM_OUTPUT=1 なら stdout → マルチパート、それ以外は /tmp に faststart で書いて upload_file
+      長尺（SEGMENT_MIN_SEC 以上）の再エンコードは分割並列変換に回し、async=True で返す
+      cache_key があり変換キャッシュにヒットすれば、何もせずキャッシュからコピーする
+    """
+    timings = {}
+    t0 = time.time()
+
+    if cache_key:
+        try:
+            if _cache_get(cache_key, dst_bucket, dst_key, out_meta):
+                timings["total"] = round(time.time() - t0, 2)
+                print("[CACHE] hit", cache_key, "elapsed=", timings["total"], "s")
+                return {"ok": True, "timings": timings, "path": "cache_hit"}
+            print("[CACHE] miss", cache_key)
+        except Exception as e:
+            print("WARN cache lookup failed:", e)
+
+    # moov が先頭か（pipe 入力の可否と、S3 コピーで済むかの判定に使う）
+    try:
+        moov_front = _moov_before_mdat(bucket, key, size)
+    except Exception as e:
+        print("WARN moov probe failed:", e)
+        moov_front = False
+
+    # 入力をダウンロードする前に presigned URL で probe する（先頭数 MB しか読まない）
+    t1 = time.time()
+    probe = _probe_input(_presigned(bucket, key))
+    plan = _plan_encoding(probe, params)
+    reasons = _check_compliance(probe, plan, size, params)
+    timings["probe"] = round(time.time() - t1, 2)
+
+    if not reasons and moov_front:
+        # そのまま投稿できる → サーバサイドコピーのみ（メタデータは出力用に置き換え）
+        path = "s3_copy"
+    elif not reasons:
+        path = "remux"
+    else:
+        path = "transcode"
+    print("[PATH]", path, "reasons=", reasons)
+
+    if path == "s3_copy":
+        s3.copy_object(
+            Bucket=dst_bucket, Key=dst_key,
+            CopySource={"Bucket": bucket, "Key": key},
+            ContentType="video/mp4", Metadata=out_meta, MetadataDirective="REPLACE",
+            TaggingDirective="REPLACE", Tagging="",  # 入力側の transcode/out_key タグは引き継がない
+        )
+        timings["copy"] = timings["total"] = round(time.time() - t0, 2)
+        print("[COPY] s3://%s/%s -> s3://%s/%s elapsed=" % (bucket, key, dst_bucket, dst_key), timings["copy"], "s")
+        return {"ok": True, "timings": timings, "path": path}
+
+    # 映像をコピーする（音声だけ作り直す等の）プランは分割しない: -ss/-t の切れ目がキーフレームに揃わず、
+    # 連結で継ぎ目が壊れる。コピーは速いので 1 回で済ませる
+    if (path == "transcode" and plan["video"] != "copy" and SEGMENT_MIN_SEC > 0
+            and probe.get("duration", 0) >= SEGMENT_MIN_SEC):
+        return _start_segmented(bucket, key, size, dst_bucket, dst_key, params, out_meta, plan, probe, timings,
+                                cache_key)
+
+    feeder, src = None, None
+    if PIPELINE_MODE == "pipe" and moov_front:
+        feeder = lambda proc: _feed_stdin(proc, bucket, key, size)
+        src = "pipe:0"
+    elif PIPELINE_MODE == "pipe":
+        print("[PIPE] moov is not at the head; fallback to temp file")
+    if not src:
+        src = os.path.join(work, "input.mp4")
+        print("[DL] s3://%s/%s -> %s" % (bucket, key, src))
+        t1 = time.time()
+        s3.download_file(bucket, key, src)
+        timings["download"] = round(time.time() - t1, 2)
+        print("[DL] elapsed=", timings["download"], "s")
+
+    if path == "remux":
+        # +faststart は出力のシークが必要なので remux は常に /tmp に書く
+        build = lambda dst, fragmented: _remux_cmd(src, dst)
+        ok = _encode_to_s3(build, dst_bucket, dst_key, out_meta, work, timings, feeder=feeder, stream=False)
+    else:
+        build = lambda dst, fragmented: _build_ffmpeg_cmd(src, dst, params, fragmented=fragmented, plan=plan)
+        ok = _encode_to_s3(build, dst_bucket, dst_key, out_meta, work, timings, feeder=feeder)
+    if not ok:
+        return {"ok": False, "timings": timings, "path": path}
+
+    timings["total"] = round(time.time() - t0, 2)
+    print("[TOTAL] elapsed=", timings["total"], "s", timings)
+    return {"ok": True, "timings": timings, "path": path}
+
+def _redact(text: str) -> str:
+    """ログに出す前に presigned URL のクエリ（署名・セッショントークン）を伏せる"""
+    return re.sub(r"(https?://[^\s?']+)\?[^\s']*", r"\1?<redacted>", text)
+
+def _encode_to_s3(build, dst_bucket, dst_key, out_meta, work, timings, feeder=None, stream=None) -> bool:
+    """
+    build(dst, fragmented) で組み立てた ffmpeg を実行し、結果を dst_bucket/dst_key に置く。
+      STREAM_OUTPUT=1（stream=None のとき）: stdout → マルチパート
+      それ以外: /tmp に書いて upload_file
+    """
+    stream = STREAM_OUTPUT if stream is None else stream
+    sink, out_path = None, None
+    if stream:
+        sink = _MultipartSink(dst_bucket, dst_key, "video/mp4", out_meta)
+        cmd = build("pipe:1", True)
+    else:
+        out_path = os.path.join(work, "output.mp4")
+        cmd = build(out_path, False)
+
+    print("[CMD]", _redact(" ".join(cmd)))
+    t1 = time.time()
+    try:
+        rc, err = _run_ffmpeg(cmd, feeder=feeder, sink=sink)
+    except Exception:
+        if sink:
+            sink.abort()
+        raise
+    timings["ffmpeg"] = round(time.time() - t1, 2)
+    print("[FFMPEG] rc=", rc, "elapsed=", timings["ffmpeg"], "s",
+          "input=", "pipe" if feeder else "file", "output=", "multipart" if sink else "file")
+
+    if sink:
+        if rc != 0 or sink.error:
+            sink.abort()
+            print("[ERR] ffmpeg/upload failed:", sink.error, _redact(str(err)))
+            return False
+        sink.complete()
+    else:
+        if rc != 0 or not os.path.exists(out_path):
+            # 直近のエラーメッセージをログ
+            print("[ERR] ffmpeg failed:", _redact(str(err)))
+            return False
+        print("[UL] %s -> s3://%s/%s" % (out_path, dst_bucket, dst_key))
+        t2 = time.time()
+        s3.upload_file(
+            out_path,
+            dst_bucket,
+            dst_key,
+            ExtraArgs={
+                "ContentType":"video/mp4",
+                "Metadata": out_meta,
+            }
+        )
+        timings["upload"] = round(time.time() - t2, 2)
+        print("[UL] elapsed=", timings["upload"], "s")
+    return True
+
+def _finish(src_key, dst_bucket, dst_key, path, cache_key=None, job_id=None):
+    """出力の実体を確認して done にする（ffmpeg を通した出力は変換キャッシュにも入れる）"""
+    # S3の実体を確認（サイズ・ETag・ContentTypeなど取れる）
+    head = s3.head_object(Bucket=dst_bucket, Key=dst_key)
+    size_bytes = head["ContentLength"]
+    content_type = head.get("ContentType")
+    etag = head.get("ETag")
+    print("HEAD:", content_type, size_bytes, etag)
+    _update_status(
+        src_key,
+        "done",
+        size_bytes=size_bytes,
+        extra={"content_type": content_type, "etag": etag, "convert_path": path},
+        job_id=job_id,
+    )
+    if cache_key and path in ("transcode", "remux", "segmented"):
+        try:
+            _cache_put(cache_key, dst_bucket, dst_key, size_bytes)
+        except Exception as e:
+            print("WARN cache store failed:", e)
+
+# ===== 分割並列変換 =====
+# 計画: キーフレーム位置（ffprobe が無ければ等分）で区切り、セグメントごとに自分自身を非同期 invoke
+# 変換: 各呼び出しが -ss/-t で担当区間だけを同じ ffmpeg 引数で変換し、work/ に置く
+# 連結: video_jobs_by_src の seg_done（数値セット）が seg_total に達した呼び出しが concat demuxer で結合
+
+def _keyframes(url: str) -> list:
+    """映像のキーフレーム時刻（秒）。ffprobe が無い/失敗したら []"""
+    if not os.path.exists(FFPROBE):
+        return []
+    try:
+        out = subprocess.run(
+            [FFPROBE, "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+             "-show_entries", "frame=pts_time", "-of", "csv=p=0", url],
+            capture_output=True, text=True, timeout=120,
+        ).stdout
+        return sorted(float(x) for x in out.split() if x.strip() not in ("", "N/A"))
+    except Exception as e:
+        print("WARN keyframe probe failed:", e)
+        return []
+
+def _plan_segments(duration: float, keyframes: list) -> list:
+    """[(start, duration or None), ...] 最後のセグメントは末尾まで"""
+    n = max(1, min(MAX_SEGMENTS, math.ceil(duration / SEGMENT_SEC)))
+    starts = [0.0]
+    for i in range(1, n):
+        target = duration * i / n
+        if keyframes:
+            # 目標位置以降で最初のキーフレームに合わせる（GOP の途中で切らない）
+            target = next((k for k in keyframes if k >= target), None)
+        if target is not None and target > starts[-1] + 1 and target < duration - 1:
+            starts.append(target)
+    return [(st, (starts[i + 1] - st) if i + 1 < len(starts) else None) for i, st in enumerate(starts)]
+
+def _segment_key(src_key: str, index: int) -> str:
+    return f"{WORK_PREFIX}{src_key}/seg_{index:04d}.mp4"
+
+def _start_segmented(bucket, key, size, dst_bucket, dst_key, params, out_meta, plan, probe, timings,
+                     cache_key=None) -> dict:
+    t1 = time.time()
+    segments = _plan_segments(probe["duration"], _keyframes(_presigned(bucket, key)))
+    timings["plan"] = round(time.time() - t1, 2)
+    print("[SEGMENT] plan n=", len(segments), "duration=", probe["duration"], "segments=", segments)
+
+    table.update(key, set={"status": "processing", "updated_at": int(time.time()), "convert_path": "segmented",
+                           "seg_total": len(segments), "seg_started_at": str(time.time())},
+                 remove=("seg_done", "seg_claimed", "seg_failed"))
+    base = {
+        "op": "segment", "bucket": bucket, "key": key, "dst_bucket": dst_bucket, "dst_key": dst_key,
+        "params": params, "out_meta": out_meta, "plan": plan, "total": len(segments), "cache_key": cache_key,
+    }
+    _touch_convert_job(out_meta.get("job-id"), "processing")
+    for i, (start, dur) in enumerate(segments):
+        lambda_client.invoke(
+            FunctionName=os.environ["AWS_LAMBDA_FUNCTION_NAME"],
+            InvocationType="Event",
+            Payload=json.dumps({**base, "index": i, "start": start, "duration": dur}).encode("utf-8"),
+        )
+    print("[SEGMENT] dispatched", len(segments), "elapsed=", round(time.time() - t1, 2), "s")
+    return {"ok": True, "timings": timings, "path": "segmented", "async": True}
+
+def _run_segment(ev: dict) -> dict:
+    """
+    1 セグメントを変換して work/ に置き、全セグメントが揃ったら連結する。
+    どれかのセグメントが失敗したら（seg_failed）、残りは変換も進捗の書き込みも連結もしない（error を上書きしない）
+    """
+    key, index = ev["key"], int(ev["index"])
+    job_id = ev["out_meta"].get("job-id")
+    cur = table.get(key, fields=["seg_failed"])
+    if cur is not None and cur.get("seg_failed") is not None:
+        print("[SEGMENT] skip index=", index, "segment", cur.get("seg_failed"), "already failed")
+        return {"ok": False, "index": index, "state": "aborted"}
+    work = tempfile.mkdtemp(prefix="ffseg_", dir="/tmp")
+    timings = {}
+    t0 = time.time()
+    try:
+        src = _presigned(ev["bucket"], key)
+        build = lambda dst, fragmented: _build_ffmpeg_cmd(
+            src, dst, ev["params"], plan=ev["plan"], seek=(ev["start"], ev.get("duration")))
+        if not _encode_to_s3(build, UPLOAD_BUCKET or ev["bucket"], _segment_key(key, index), {}, work, timings,
+                             stream=False):
+            _update_status(key, "error", extra={"convert_path": "segmented", "seg_failed": index}, job_id=job_id)
+            return {"ok": False, "index": index}
+        print("[SEGMENT] index=", index, "elapsed=", round(time.time() - t0, 2), "s", timings)
+
+        # 冪等（再試行で同じ index が来ても数え直さない）。変換中に他のセグメントが失敗していたらここで止める
+        r = table.update(key, add={"seg_done": {index}}, set={"updated_at": int(time.time())},
+                         if_missing=("seg_failed",), return_new=True)
+        if r is None:
+            print("[SEGMENT] index=", index, "done after another segment failed; not counted")
+            return {"ok": False, "index": index, "state": "aborted"}
+        done, total = len(r.get("seg_done", set())), int(r.get("seg_total", ev["total"]))
+        # 連結が始まった後・失敗が記録された後に遅れて届いた進捗で done / error を上書きしない
+        _update_status(key, "processing", extra={"progress": f"{done}/{total}"},
+                       if_missing=("seg_claimed", "seg_failed"), job_id=job_id)
+        if done < total:
+            return {"ok": True, "index": index, "progress": f"{done}/{total}"}
+
+        # 連結は 1 回だけ（最後に終わった呼び出しが担当）
+        if not table.update(key, set={"seg_claimed": int(time.time())}, if_missing=("seg_claimed", "seg_failed")):
+            return {"ok": True, "index": index, "progress": f"{done}/{total}"}
+        _concat_segments(ev, total, float(r.get("seg_started_at", t0)), work)
+        return {"ok": True, "index": index, "progress": "concat"}
+    finally:
+        try:
+            shutil.rmtree(work)
+        except Exception as e:
+            print("cleanup warn:", e)
+
+def _concat_segments(ev: dict, total: int, started_at: float, work: str):
+    key = ev["key"]
+    seg_bucket = UPLOAD_BUCKET or ev["bucket"]
+    seg_keys = [_segment_key(key, i) for i in range(total)]
+    list_path = os.path.join(work, "concat.txt")
+    with open(list_path, "w") as f:
+        for k in seg_keys:
+            f.write("file '%s'\n" % _presigned(seg_bucket, k))
+
+    timings = {}
+    build = lambda dst, fragmented: [
+        FFMPEG, "-y", "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,http,https,tcp,tls,crypto",
+        "-i", list_path, "-c", "copy",
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof" if fragmented else "+faststart",
+    ] + (["-f", "mp4"] if fragmented else []) + [dst]
+    ok = _encode_to_s3(build, ev["dst_bucket"], ev["dst_key"], ev["out_meta"], work, timings)
+    if ok:
+        _finish(key, ev["dst_bucket"], ev["dst_key"], "segmented", ev.get("cache_key"), ev["out_meta"].get("job-id"))
+    else:
+        _update_status(key, "error", extra={"convert_path": "segmented"}, job_id=ev["out_meta"].get("job-id"))
+    # 単一呼び出しの [TOTAL] と比較できるよう、計画開始からの経過時間を出す
+    print("[SEGMENTED] ok=", ok, "segments=", total, "concat=", timings.get("ffmpeg"),
+          "wall_clock=", round(time.time() - started_at, 2), "s")
+
+    try:
+        s3.delete_objects(Bucket=seg_bucket, Delete={"Objects": [{"Key": k} for k in seg_keys], "Quiet": True})
+    except Exception as e:
+        print("WARN segment cleanup:", e)
+
+def _out_meta(md: dict) -> dict:
+    """入力の metadata から出力へ引き継ぐもの（notifier が読む）"""
+    out_meta = {}
+    # job-id（必須）
+    if md.get("job-id"):
+        out_meta["job-id"] = md["job-id"]
+    # ← Webhook の Base64
+    if md.get("cb-b64"):
+        out_meta["cb-b64"] = md["cb-b64"]
+    # 予約投稿の時刻（notifier が待ち行列に積む）
+    if md.get("publish-at"):
+        out_meta["publish-at"] = md["publish-at"]
+    return out_meta
+
+def _process_record(rec) -> dict:
+    """
+    1 レコード分の変換。戻り値: {"ok": bool, "key": ..., "state"|"error": ...}
+    変換失敗（ffmpeg エラー等）は video_jobs_by_src に error を記録済みなので ok=True（再試行しない）。
+    """
+    bucket = rec["s3"]["bucket"]["name"]
+    key = urllib.parse.unquote_plus(rec["s3"]["object"]["key"])
+
+    # 早期フィルタ
+    if UPLOAD_BUCKET and bucket != UPLOAD_BUCKET:
+        print("skip other bucket:", bucket)
+        return {"ok": True, "key": key, "state": "skipped"}
+
+    # ここで HeadObject / Tagging を取得
+    info, tags = _get_head_and_tags(bucket, key)
+    print("INFO content_type:", info["content_type"])
+    print("INFO metadata:", info["metadata"])
+    print("INFO tags:", tags)
+    #　metadata又はtagが空なら変換処理しない
+    if info["metadata"]=={} and tags=={}:
+        print("skip not tagged:", key)
+        return {"ok": True, "key": key, "state": "skipped"}
+    #　出力先がないなら変換処理しない
+    if not tags.get("out_key"):
+        print("skip not uploaded:", key)
+        return {"ok": True, "key": key, "state": "skipped"}
+    # 出力先情報
+    dst_key = tags.get("out_key")
+    dst_bucket = tags.get("out_bucket")
+
+    md = info.get("metadata", {})  # {'params': '{"width":1080,...}'}
+    params = _parse_params(md)
+
+    # metadataを渡す
+    out_meta = _out_meta(md)
+    job_id = out_meta.get("job-id")
+
+    # 作業ディレクトリ（レコードごとに分ける）
+    work = tempfile.mkdtemp(prefix="ffwork_", dir="/tmp")
+
+    try:
+        cache_key = _cache_key(info["etag"], info["size"], params) if cache_table and info["etag"] else None
+        result = _transcode(bucket, key, info["size"], dst_bucket, dst_key, params, out_meta, work, cache_key)
+        if not result["ok"]:
+            _update_status(key, "error", extra={"convert_path": result["path"]}, job_id=job_id)
+            return {"ok": True, "key": key, "state": "error", "path": result["path"]}
+        if result.get("async"):
+            # 分割変換はセグメント側の最後の呼び出しが done にする
+            return {"ok": True, "key": key, "state": "processing", "path": result["path"]}
+
+        _finish(key, dst_bucket, dst_key, result["path"], cache_key, job_id)
+        return {"ok": True, "key": key, "state": "done", "path": result["path"]}
+
+    finally:
+        try:
+            shutil.rmtree(work)
+        except Exception as e:
+            print("cleanup warn:", e)
+
+def _on_async_failure(event: dict) -> dict:
+    """
+    非同期起動がリトライを使い切ったときの通知（EventInvokeConfig の OnFailure の宛先が自分自身）。
+    セグメントがタイムアウト・OOM・想定外の例外で落ちると seg_failed を書く者がいないので、ここで error にする
+    （残りのセグメントは seg_failed を見て止まる。完了済み・他の理由で error 済みなら書かない）
+    """
+    payload = event.get("requestPayload") or {}
+    condition = (event.get("requestContext") or {}).get("condition")
+    if payload.get("op") != "segment":
+        print("[ASYNC_FAILURE] condition=", condition, "records=", len(payload.get("Records", [])))
+        return {"ok": False, "state": "logged"}
+    key, index = payload["key"], int(payload["index"])
+    ok = _update_status(key, "error", extra={"convert_path": "segmented", "seg_failed": index,
+                                             "error": f"segment {index}: {condition}"},
+                        expect={"status": "processing"}, job_id=(payload.get("out_meta") or {}).get("job-id"))
+    print("[ASYNC_FAILURE] segment index=", index, "key=", key, "condition=", condition, "marked=", ok)
+    return {"ok": ok, "index": index, "state": "marked_failed" if ok else "unchanged"}
+
+def lambda_handler(event, ctx):
+
+    # 分割並列変換のセグメント（自分自身からの非同期 invoke）
+    if event.get("op") == "segment":
+        return _run_segment(event)
+
+    # 非同期起動の失敗通知（OnFailure の宛先）
+    if "requestContext" in event and "requestPayload" in event:
+        return _on_async_failure(event)
+
+    # S3:ObjectCreated イベント（直接 or SQS 経由）想定
+    return run_records(event, _process_record, RECORD_CONCURRENCY)
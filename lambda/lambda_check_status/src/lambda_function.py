@@ -1,43 +1,64 @@
-import json, urllib.request
-from ddb_helpers import set_status
+import os
+import json
+from ddb_helpers import JobUpdate
+from http_helpers import request
+from poll_helpers import poll
+from rate_limiter import RateLimited, acquire, observe
 
 GRAPH = "https://graph.facebook.com/v20.0"
+MAX_WAIT_SEC = int(os.getenv("IG_MAX_WAIT_SEC", "900"))   # リールの処理待ちの上限
+FINAL_CODES = ("FINISHED", "ERROR", "EXPIRED", "PUBLISHED")
 
 def _get(url, timeout=12):
-    req = urllib.request.Request(url, method="GET")
-    try:
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            raw = resp.read()
-            return {"ok": True, "status": resp.status, "body": json.loads(raw.decode("utf-8"))}
-    except urllib.error.HTTPError as e:
-        err = (e.read() or b"").decode("utf-8", errors="replace")
-        try:
-            j = json.loads(err)
-        except Exception:
-            j = {"raw": err}
-        return {"ok": False, "status": e.code, "body": j}
-    except Exception as e:
-        return {"ok": False, "status": 0, "body": {"error": str(e)}}
+    # 接続は http_helpers のプールから再利用（ウォーム時は TLS ハンドシェイク無し）
+    return request("GET", url, timeout=timeout)
 
 def lambda_handler(event, ctx):
     """
     event 例:
     {
       "job": {"access_token":"...","ig_user_id":"..."},
-      "cid": {"creation_id":"1789..."}
+      "cid": {"creation_id":"1789..."},
+      "poll": {...}            // 前回の戻り値の poll（初回は無し）
     }
+    Graph API は待ち時間を返さないので指数バックオフで聞き直す（残り時間に収まる間は呼び出しの中で）。
+    IN_PROGRESS のまま返すときは wait_sec 秒後に呼び直してもらう
     """
     token = event["job"]["access_token"]
+    ig    = event["job"].get("ig_user_id", "")
     cid   = event["cid"]["creation_id"]
 
     url = f"{GRAPH}/{cid}?fields=status_code&access_token={token}"
-    res = _get(url)
+    last = {}
+
+    def check():
+        try:
+            acquire("ig", ig, "graph", reserve=False)
+        except RateLimited as e:
+            # 空くまで聞きに行かない（処理中として扱い、空く時刻まで待つ）
+            last.setdefault("res", {"ok": True, "status": 429, "body": {}, "timings": {}})
+            return False, e.wait_sec, "IN_PROGRESS"
+        res = _get(url)
+        observe("ig", ig, "graph", res["status"], res["headers"], res["body"])
+        last["res"] = res
+        code = (res.get("body", {}).get("status_code") or "").upper()
+        return (not res["ok"]) or code in FINAL_CODES, None, code
+
+    r = poll(check, event.get("poll"), context=ctx, max_wait_sec=int(event.get("max_wait_sec") or MAX_WAIT_SEC))
+    res, code = last["res"], r["result"]
+    if r["timed_out"]:
+        code = "TIMEOUT"
 
     # 返却形：Step Functions の Choice で使いやすいように
-    code = (res.get("body", {}).get("status_code") or "").upper()
-    if not res["ok"]:
-        set_status(event["job"]["job_id"], f"ERROR,check_status,{res.get('status')}")
-    elif code == "ERROR":
-        set_status(event["job"]["job_id"], "ERROR,check_status,GRAPH_ERROR")
-    # IN_PROGRESS は何もしない
-    return {"ok": res["ok"], "status": res["status"], "code": code, "raw": res["body"]}
+    # IN_PROGRESS は何もしない（ポーリングのたびに書かない）
+    if not res["ok"] or code in ("ERROR", "TIMEOUT"):
+        status = f"ERROR,check_status,{res.get('status')}" if not res["ok"] else f"ERROR,check_status,GRAPH_{code}"
+        (JobUpdate(event["job"]["job_id"])
+            .status(status)
+            .set(error_detail=json.dumps(res["body"], ensure_ascii=False, default=str)[:500])
+            .timing("check_status", res["timings"].get("ttfb_ms"))
+            .commit())
+    out = {"ok": res["ok"], "status": res["status"], "code": code, "raw": res["body"], "poll": r["poll"]}
+    if not r["done"] and not r["timed_out"]:
+        out["wait_sec"] = r["wait_sec"]
+    return out
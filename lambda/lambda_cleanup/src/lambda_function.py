@@ -1,15 +1,22 @@
 import os
 import json
+import time
 import boto3
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from job_store import store
+from ddb_helpers import RANK_ERROR, status_rank
 
 REGION = os.getenv("AWS_REGION", "ap-northeast-1")
 JOBS_TABLE = os.getenv("JOBS_TABLE", "convert_jobs")
 IN_BUCKET = os.getenv("IN_BUCKET")
 OUT_BUCKET = os.getenv("OUT_BUCKET")
+DELETE_BATCH = 1000                                                   # DeleteObjects 1 回の上限
+SWEEP_MIN_AGE_SEC = int(os.getenv("SWEEP_MIN_AGE_SEC", "86400"))      # これより新しいオブジェクトは掃除しない
+SWEEP_PREFIXES = {"in": "in/", "out": "converted/"}
 
 s3 = boto3.client("s3", region_name=REGION)
-ddb = boto3.resource("dynamodb", region_name=REGION).Table(JOBS_TABLE)
+jobs = store(JOBS_TABLE)
 
 
 def _safe(fn, *a, **k):
@@ -31,10 +38,112 @@ def _extract_s3_key_from_url(url: str):
         return None
 
 
+def _delete_batch(targets):
+    """
+    [(bucket, key), ...] をバケットごとに 1000 件ずつ DeleteObjects で消す（バケット/チャンクは並行）。
+    戻り値: [{"bucket", "key", "deleted": bool, "error"?}, ...]（入力順、重複は 1 件にまとめる）
+    """
+    targets = list(dict.fromkeys((b, k) for b, k in targets if b and k))
+    by_bucket = {}
+    for b, k in targets:
+        by_bucket.setdefault(b, []).append(k)
+    chunks = [(b, keys[i:i + DELETE_BATCH]) for b, keys in by_bucket.items() for i in range(0, len(keys), DELETE_BATCH)]
+
+    def _run(chunk):
+        bucket, keys = chunk
+        try:
+            r = s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": k} for k in keys], "Quiet": False})
+        except Exception as e:
+            print("WARN: delete_objects failed:", bucket, len(keys), e)
+            return {k: str(e) for k in keys}
+        errors = {e["Key"]: f"{e.get('Code')}: {e.get('Message')}" for e in r.get("Errors", [])}
+        return {k: errors.get(k) for k in keys}
+
+    outcome = {}
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(8, len(chunks))) as pool:
+            for (bucket, _), res in zip(chunks, pool.map(_run, chunks)):
+                for k, err in res.items():
+                    outcome[(bucket, k)] = err
+
+    results = []
+    for b, k in targets:
+        err = outcome.get((b, k))
+        results.append({"bucket": b, "key": k, "deleted": err is None, **({"error": err} if err else {})})
+    print(f"[CLEANUP] keys={len(results)} buckets={len(by_bucket)} calls={len(chunks)} "
+          f"failed={sum(1 for r in results if not r['deleted'])}")
+    return results
+
+
+def _job_keys(item):
+    """convert_jobs の項目が参照している素材の (bucket, key)"""
+    keys = []
+    for url in item.get("media_urls", []) or []:
+        key = _extract_s3_key_from_url(url)
+        if key:
+            keys.append((IN_BUCKET, key))
+    if item.get("in_key"):
+        keys.append((item.get("in_bucket") or IN_BUCKET, item.get("in_key")))
+    if item.get("out_key"):
+        keys.append((item.get("out_bucket") or OUT_BUCKET, item.get("out_key")))
+    return keys
+
+
+def _transcode_upload(bucket, key) -> bool:
+    """presign がジョブ付きのアップロードにだけ付けるタグ（transcode=true）が付いているか"""
+    try:
+        tags = s3.get_object_tagging(Bucket=bucket, Key=key).get("TagSet", [])
+    except Exception as e:
+        print("WARN get_object_tagging:", e, bucket, key)
+        return False
+    return any(t.get("Key") == "transcode" and t.get("Value") == "true" for t in tags)
+
+
+def _sweep(min_age_sec, dry_run):
+    """
+    in/ と converted/ の中から、ジョブで使い終わったオブジェクトをまとめて消す。
+      - 完了（成功/エラー）したジョブの素材と、transcode=true のタグ付きで参照するジョブが無い（削除済み）入力が対象
+      - ジョブ無しのアップロード（presign に wp_id が無いもの）は WordPress が後で op=get で読むので消さない
+      - 処理中・予約中のジョブ（status_rank が ERROR より前）が参照しているもの、min_age_sec より新しいものは残す
+    """
+    keep, done = set(), set()
+    for item in jobs.scan(fields=["status", "media_urls", "in_bucket", "in_key", "out_bucket", "out_key"]):
+        active = status_rank(str(item.get("status", ""))) < RANK_ERROR
+        (keep if active else done).update(_job_keys(item))
+
+    cutoff = time.time() - min_age_sec
+    orphans, scanned = [], 0
+    for bucket, prefix in ((IN_BUCKET, SWEEP_PREFIXES["in"]), (OUT_BUCKET, SWEEP_PREFIXES["out"])):
+        if not bucket:
+            continue
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                scanned += 1
+                ref = (bucket, obj["Key"])
+                if ref in keep or obj["LastModified"].timestamp() > cutoff:
+                    continue
+                if ref in done or (bucket == IN_BUCKET and _transcode_upload(bucket, obj["Key"])):
+                    orphans.append(ref)
+
+    print(f"[SWEEP] scanned={scanned} orphans={len(orphans)} finished_refs={len(done)} active_refs={len(keep)} "
+          f"dry_run={dry_run}")
+    if dry_run:
+        return {"mode": "sweep", "dry_run": True, "scanned": scanned,
+                "orphans": [{"bucket": b, "key": k} for b, k in orphans]}
+    results = _delete_batch(orphans)
+    return {"mode": "sweep", "scanned": scanned, "deleted": sum(1 for r in results if r["deleted"]),
+            "results": results}
+
+
 def lambda_handler(event, ctx):
     """
     Step Functions および API Gateway 両対応
+    {"mode": "sweep"} で孤立オブジェクトの一括掃除（EventBridge の定期実行用。dry_run / min_age_sec 指定可）
     """
+    if event.get("mode") == "sweep":
+        min_age = event.get("min_age_sec")
+        return _sweep(SWEEP_MIN_AGE_SEC if min_age is None else int(min_age), bool(event.get("dry_run")))
+
     out_bucket = event.get("bucket") or OUT_BUCKET
     out_key = event.get("key")
     job = event.get("job") or {}
@@ -45,47 +154,53 @@ def lambda_handler(event, ctx):
 
     deleted = {"out": False, "src": False, "batch": []}
     failure = None
+    results = []
 
     try:
         # --- (1) 単発削除 ---
         if media_path:
             media_path = urllib.parse.unquote_plus(media_path)
-            _safe(s3.delete_object, Bucket=IN_BUCKET, Key=media_path)
+            results = _delete_batch([(IN_BUCKET, media_path)])
+            if not results[0]["deleted"]:
+                raise RuntimeError(results[0]["error"])
             deleted["src"] = True
             return {"deleted": deleted, "src_bucket": IN_BUCKET, "src_key": media_path}
 
-        # --- (2) DynamoDB参照モード ---
+        # --- (2) DynamoDB参照モード: 入力（X の media_urls / Insta の in_key）を集める ---
+        media_targets, src_targets = [], []
         if job_id:
             try:
-                r = ddb.get_item(Key={"job_id": job_id})
-                item = r.get("Item") or {}
-                media_urls = item.get("media_urls", [])
+                item = jobs.get(job_id, fields=["media_urls", "in_key"]) or {}
+                media_urls = item.get("media_urls", []) or []
                 print(f"JOB {job_id} media_urls:", media_urls)
                 # URL配列指定による削除（X投稿対応）
                 for url in media_urls:
                     key = _extract_s3_key_from_url(url)
-                    if not key:
-                        continue
-                    _safe(s3.delete_object, Bucket=IN_BUCKET, Key=key)
-                    deleted["batch"].append({"bucket": IN_BUCKET, "key": key})
+                    if key:
+                        media_targets.append((IN_BUCKET, key))
                 # in_key指定による削除（Insta対応）
                 in_key = item.get("in_key", '')
-                if in_key:
-                    _safe(s3.delete_object, Bucket=IN_BUCKET, Key=in_key)
-
-                deleted["src"] = True
-
+                src_targets = media_targets + ([(IN_BUCKET, in_key)] if in_key else [])
             except Exception as e:
-                failure = f"DDB read/delete failed: {e}"
+                failure = f"DDB read failed: {e}"
                 print("ERROR:", failure)
 
-        # --- (3) 出力側の削除 ---
-        if out_bucket and out_key:
-            try:
-                _safe(s3.delete_object, Bucket=out_bucket, Key=out_key)
-                deleted["out"] = True
-            except Exception as e:
-                failure = f"Delete output object failed: {e}"
+        # --- (3) 出力側も含めて 1 回の一括削除 ---
+        out_targets = [(out_bucket, out_key)] if out_bucket and out_key else []
+        results = _delete_batch(src_targets + out_targets)
+        status = {(r["bucket"], r["key"]): r for r in results}
+
+        src_failed = [t for t in src_targets if not status[t]["deleted"]]
+        if job_id and not failure:
+            deleted["batch"] = [{"bucket": b, "key": k} for b, k in media_targets if status[(b, k)]["deleted"]]
+            deleted["src"] = not src_failed
+            if src_failed:
+                failure = f"DDB read/delete failed: {[status[t]['error'] for t in src_failed]}"
+                print("ERROR:", failure)
+        if out_targets:
+            deleted["out"] = status[out_targets[0]]["deleted"]
+            if not deleted["out"]:
+                failure = f"Delete output object failed: {status[out_targets[0]]['error']}"
                 print("ERROR:", failure)
 
     except Exception as e:
@@ -98,6 +213,7 @@ def lambda_handler(event, ctx):
         "src_bucket": IN_BUCKET,
         "out_bucket": out_bucket,
         "job_id": job_id,
+        "results": results,
     }
     if failure:
         result["failure"] = failure
@@ -1,148 +1,203 @@
 # lambda_convert_notifier.py
-import os, json, base64, urllib.parse, urllib.request, time, socket, ssl
+import os, re, json, time, uuid, base64, urllib.parse
 import boto3
+from http_helpers import request
+from job_store import store, enqueue, dequeue
+from s3_records import run_records
 
 AWS_REGION   = os.getenv("AWS_REGION", "ap-northeast-1")
 GET_EXPIRES  = int(os.getenv("GET_EXPIRES", "3600"))
 UPLOAD_PREFIX= (os.getenv("UPLOAD_PREFIX") or "converted/").lstrip("/")
 SF_ARN       = os.getenv("SF_IG_POST_ARN")  # ← Step Functions の ARN（設定されていれば起動）
+RECORD_CONCURRENCY = int(os.getenv("RECORD_CONCURRENCY", "8"))  # 1 回の起動で同時に処理するレコード数
+WEBHOOK_QUEUE_URL = os.getenv("WEBHOOK_QUEUE_URL")  # 設定されていれば Webhook は送信キューに積むだけ（lambda_webhook_delivery が送る）
+JOBS_TABLE   = os.getenv("JOBS_TABLE", "convert_jobs")
+SCHEDULE_MIN_LEAD_SEC = int(os.getenv("SCHEDULE_MIN_LEAD_SEC", "60"))  # publish-at がこれより近ければ予約せずすぐ起動
 
 s3 = boto3.client("s3", region_name=AWS_REGION)
 sf = boto3.client("stepfunctions", region_name=AWS_REGION) if SF_ARN else None
-
-def _post_json(url: str, payload: dict, timeout=10, retries=2, backoff=1.5):
-    """Webhook へ JSON POST（シンプルな再試行付き + 例外の見える化）"""
-    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-    req = urllib.request.Request(url, data=data, method="POST")
-    req.add_header("Content-Type", "application/json; charset=utf-8")
-    req.add_header("User-Agent", "itmar-notifier/1.0")
-
-    last_err = None
-    for i in range(retries + 1):
-        try:
-            print(f"DEBUG _post_json try={i} url={url} bytes={len(data)} timeout={timeout}")
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                status = resp.status
-                body = (resp.read() or b"")[:500]
-                print("webhook response:", status, body)
-                return status, body
-
-        except urllib.error.HTTPError as e:
-            err_body = (e.read() or b"")[:500]
-            print("ERROR HTTPError:", e.code, e.reason, err_body)
-            if 400 <= e.code < 500:
-                raise
-            last_err = e
-
-        except urllib.error.URLError as e:
-            print("ERROR URLError:", repr(e.reason))
-            last_err = e
-
-        except (socket.timeout, ssl.SSLError) as e:
-            print("ERROR Timeout/SSL:", type(e).__name__, str(e))
-            last_err = e
-
-        except Exception as e:
-            print("ERROR Other:", type(e).__name__, str(e))
-            last_err = e
-
-        if i < retries:
-            time.sleep(backoff ** i)
-
-    raise last_err if last_err else RuntimeError("unknown webhook error")
-
-
-def lambda_handler(event, context):
-    for rec in event.get("Records", []):
-        bucket = rec["s3"]["bucket"]["name"]
-        key    = urllib.parse.unquote_plus(rec["s3"]["object"]["key"])
-
-        # 早期フィルタ
-        if UPLOAD_PREFIX and not key.startswith(UPLOAD_PREFIX):
-            print("skip not under prefix:", key); continue
-
-        # 出力オブジェクトのメタデータ取得
-        try:
-            head = s3.head_object(Bucket=bucket, Key=key)
-        except Exception as e:
-            print("ERROR head_object:", e, bucket, key)
-            continue
-
-        meta = head.get("Metadata", {})  # x-amz-meta-* は小文字化される
-        size         = head.get("ContentLength", 0)
-        content_type = head.get("ContentType", "")
-        etag         = (head.get("ETag") or "").strip('"')
-
-        # presign GET（Graph が取りに来る）
+sqs = boto3.client("sqs", region_name=AWS_REGION) if WEBHOOK_QUEUE_URL else None
+jobs = store(JOBS_TABLE)
+
+def _enqueue_webhook(url: str, payload: dict) -> str:
+    """配信レコードを送信キューに積む（送信・再試行は lambda_webhook_delivery 側）"""
+    record = {"id": str(uuid.uuid4()), "url": url, "payload": payload, "attempt": 0, "created_at": int(time.time())}
+    sqs.send_message(QueueUrl=WEBHOOK_QUEUE_URL, MessageBody=json.dumps(record, ensure_ascii=False))
+    return record["id"]
+
+def _post_json(url: str, payload: dict, timeout=10, retries=2):
+    """Webhook へ JSON POST（5xx/429/通信エラーは http_helpers がジッタ付きで再試行）"""
+    headers = {"User-Agent": "itmar-notifier/1.0"}
+    res = request("POST", url, json_body=payload, headers=headers, timeout=timeout, retries=retries, parse="bytes")
+
+    if res["ok"]:
+        body = (res["body"] or b"")[:500]
+        print("webhook response:", res["status"], body)
+        return res["status"], body
+
+    if res["status"] == 0:
+        print("ERROR network:", res["body"].get("error"))
+        raise RuntimeError(res["body"].get("error") or "unknown webhook error")
+
+    err_body = (res["body"] or b"")[:500]
+    print("ERROR HTTP:", res["status"], err_body)
+    raise RuntimeError(f"webhook HTTP {res['status']}")
+
+
+def _execution_name(job_id: str, etag: str) -> str:
+    """Step Functions の実行名（80 文字まで・英数字と - _ のみ）"""
+    return re.sub(r"[^0-9A-Za-z_-]", "_", f"{job_id}-{etag}" if etag else job_id)[:80]
+
+
+def _schedule(job_id: str, publish_at: int, bucket: str, key: str, obj: dict) -> dict:
+    """
+    予約投稿: 変換済みオブジェクトをジョブに記録して待ち行列に積む（起動は時刻が来てから lambda_publish_scheduler が行う）。
+    積み済み・取り出し済みのジョブには積み直さない（通知の再配信で二重に数えたり投稿したりしない）
+    """
+    try:
+        job = jobs.get(job_id, fields=["site_url", "ig_user_id"])
+        if job is None:
+            print("WARN: scheduled job not found:", job_id)
+            return {"ok": True, "key": key, "state": "skipped"}
+        qk = enqueue("ig", job.site_url or job.ig_user_id, publish_at)
+        ok = jobs.update(job_id, set={"status": "scheduled", "sched_queue": qk, "publish_at": publish_at,
+                                      "out_bucket": bucket, "out_key": key, "sched_object": obj,
+                                      "updated_at": int(time.time())}, add={"rev": 1},
+                         if_exists=True, if_missing=("sched_queue", "released_at"))
+        if not ok:
+            dequeue(qk)
+    except Exception as e:
+        print("ERROR schedule:", e, job_id)
+        return {"ok": False, "key": key, "error": f"schedule: {e}"}
+    print(f"[SCHED] job_id={job_id} queue={qk} publish_at={publish_at} queued={ok}")
+    return {"ok": True, "key": key, "state": "scheduled" if ok else "already_scheduled"}
+
+
+def _process_record(rec) -> dict:
+    """1 レコード分の処理。戻り値: {"ok": bool, "key": ..., "state"|"error": ...}"""
+    bucket = rec["s3"]["bucket"]["name"]
+    key    = urllib.parse.unquote_plus(rec["s3"]["object"]["key"])
+
+    # 早期フィルタ
+    if UPLOAD_PREFIX and not key.startswith(UPLOAD_PREFIX):
+        print("skip not under prefix:", key)
+        return {"ok": True, "key": key, "state": "skipped"}
+
+    # 出力オブジェクトのメタデータ取得
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        print("ERROR head_object:", e, bucket, key)
+        return {"ok": False, "key": key, "error": f"head_object: {e}"}
+
+    meta = head.get("Metadata", {})  # x-amz-meta-* は小文字化される
+    size         = head.get("ContentLength", 0)
+    content_type = head.get("ContentType", "")
+    etag         = (head.get("ETag") or "").strip('"')
+
+    # presign GET（Graph が取りに来る）
+    try:
+        get_url = s3.generate_presigned_url(
+            ClientMethod="get_object",
+            Params={"Bucket": bucket, "Key": key},
+            ExpiresIn=GET_EXPIRES
+        )
+    except Exception as e:
+        print("ERROR presign GET:", e)
+        return {"ok": False, "key": key, "error": f"presign: {e}"}
+
+    print("presign OK:", get_url, "meta:", meta)
+
+    # ---- Step Functions 起動 ----
+    job_id = meta.get("job-id")
+    try:
+        publish_at = int(meta.get("publish-at") or 0)
+    except ValueError:
+        publish_at = 0
+    if SF_ARN and job_id and sf and publish_at > time.time() + SCHEDULE_MIN_LEAD_SEC:
+        return _schedule(job_id, publish_at, bucket, key,
+                         {"size": size, "content_type": content_type, "etag": etag})
+
+    if SF_ARN and job_id and sf:
+        sf_input = {
+            "job_id": job_id,
+            "video_url": get_url,
+            "bucket": bucket,
+            "key": key,
+            "object": {
+                "size": size,
+                "content_type": content_type,
+                "etag": etag
+            }
+        }
         try:
-            get_url = s3.generate_presigned_url(
-                ClientMethod="get_object",
-                Params={"Bucket": bucket, "Key": key},
-                ExpiresIn=GET_EXPIRES
+            # 実行名を job_id + 出力の ETag に固定する（非同期リトライでイベント全体をやり直しても、
+            # 成功済みのレコードで 2 本目の投稿を起動しない）
+            resp = sf.start_execution(
+                stateMachineArn=SF_ARN,
+                name=_execution_name(job_id, etag),
+                input=json.dumps(sf_input, ensure_ascii=False)
             )
+            print("SF started:", resp.get("executionArn"))
+            return {"ok": True, "key": key, "state": "sf_started"}
+        except sf.exceptions.ExecutionAlreadyExists:
+            print("SF already started:", job_id, etag)
+            return {"ok": True, "key": key, "state": "sf_already_started"}
         except Exception as e:
-            print("ERROR presign GET:", e); continue
-
-        print("presign OK:", get_url, "meta:", meta)
-
-        # ---- Step Functions 起動 ----
-        job_id = meta.get("job-id")
-        if SF_ARN and job_id and sf:
-            sf_input = {
-                "job_id": job_id,
-                "video_url": get_url,
-                "bucket": bucket,
-                "key": key,
-                "object": {
-                    "size": size,
-                    "content_type": content_type,
-                    "etag": etag
-                }
-            }
-            try:
-                resp = sf.start_execution(
-                    stateMachineArn=SF_ARN,
-                    input=json.dumps(sf_input, ensure_ascii=False)
-                )
-                print("SF started:", resp.get("executionArn"))
-                continue
-            except Exception as e:
-                print("ERROR start_execution:", e, "sf_input:", sf_input)
-                continue
-
-        else:
-            if not job_id:
-                print("WARN: job-id not found in metadata; Step Functions skipped")
-
-        # ---- Webhook 通知（任意：cb-b64 があれば送る）----
-        cb_b64 = meta.get("cb-b64")
-        if not cb_b64:
-            print("no cb-b64 metadata; webhook skip. key=", key)
-            continue
-
+            print("ERROR start_execution:", e, "sf_input:", sf_input)
+            return {"ok": False, "key": key, "error": f"start_execution: {e}"}
+
+    else:
+        if not job_id:
+            print("WARN: job-id not found in metadata; Step Functions skipped")
+
+    # ---- Webhook 通知（任意：cb-b64 があれば送る）----
+    cb_b64 = meta.get("cb-b64")
+    if not cb_b64:
+        print("no cb-b64 metadata; webhook skip. key=", key)
+        return {"ok": True, "key": key, "state": "skipped"}
+
+    try:
+        webhook_url = base64.b64decode(cb_b64).decode("utf-8").strip()
+    except Exception as e:
+        print("ERROR decode cb-b64:", e)
+        return {"ok": True, "key": key, "state": "bad_callback"}  # 再試行しても直らない
+
+    if not webhook_url:
+        print("empty webhook_url; skip", key)
+        return {"ok": True, "key": key, "state": "skipped"}
+
+    payload = {
+        "event": "object_converted",
+        "bucket": bucket,
+        "key": key,
+        "url": get_url,
+        "expires_in": GET_EXPIRES,
+        "size": size,
+        "content_type": content_type,
+        "etag": etag,
+        "metadata": meta
+    }
+    print("payload:", payload)
+
+    if sqs:
         try:
-            webhook_url = base64.b64decode(cb_b64).decode("utf-8").strip()
+            print("Webhook queued:", _enqueue_webhook(webhook_url, payload), webhook_url)
+            return {"ok": True, "key": key, "state": "webhook_queued"}
         except Exception as e:
-            print("ERROR decode cb-b64:", e); continue
+            # その場では送らない（送信先の遅さで止まらないようキューに分けたため）。レコードごと再試行してもらう
+            print("ERROR enqueue webhook:", e, webhook_url)
+            return {"ok": False, "key": key, "error": f"enqueue webhook: {e}"}
 
-        if not webhook_url:
-            print("empty webhook_url; skip", key); continue
+    # 送信キューが無い構成だけ、従来通りその場で送る
+    try:
+        status, body = _post_json(webhook_url, payload)
+        print("Webhook OK:", status, webhook_url, "resp:", (body or b"")[:200])
+        return {"ok": True, "key": key, "state": "webhook_sent"}
+    except Exception as e:
+        print("ERROR webhook POST:", e, webhook_url)
+        return {"ok": False, "key": key, "error": f"webhook: {e}"}
 
-        payload = {
-            "event": "object_converted",
-            "bucket": bucket,
-            "key": key,
-            "url": get_url,
-            "expires_in": GET_EXPIRES,
-            "size": size,
-            "content_type": content_type,
-            "etag": etag,
-            "metadata": meta
-        }
-        print("payload:", payload)
 
-        try:
-            status, body = _post_json(webhook_url, payload)
-            print("Webhook OK:", status, webhook_url, "resp:", (body or b"")[:200])
-        except Exception as e:
-            print("ERROR webhook POST:", e, webhook_url)
+def lambda_handler(event, context):
+    return run_records(event, _process_record, RECORD_CONCURRENCY)
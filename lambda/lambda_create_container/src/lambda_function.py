@@ -1,26 +1,15 @@
-import json, urllib.parse, urllib.request
-from ddb_helpers import set_status
+import json
+from ddb_helpers import JobUpdate
+from http_helpers import request
+from rate_limiter import RateLimited, acquire, observe
 
 GRAPH = "https://graph.facebook.com/v20.0"
 
 def _post_form(url: str, data: dict, timeout=20):
-    body = urllib.parse.urlencode(data).encode("utf-8")
-    req = urllib.request.Request(url, data=body, method="POST")
-    req.add_header("Content-Type", "application/x-www-form-urlencoded")
-    try:
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            raw = resp.read()
-            return {"ok": True, "status": resp.status, "body": json.loads(raw.decode("utf-8"))}
-    except urllib.error.HTTPError as e:
-        # ★400/401/…でも本文を読み取って返す
-        err_body = (e.read() or b"").decode("utf-8", errors="replace")
-        try:
-            err_json = json.loads(err_body)
-        except Exception:
-            err_json = {"raw": err_body}
-        return {"ok": False, "status": e.code, "body": err_json}
-    except Exception as e:
-        return {"ok": False, "status": 0, "body": {"error": str(e)}}
+    # コンテナ作成は重複しても害が無いので 5xx/429 は http_helpers 側で再試行
+    res = request("POST", url, form=data, timeout=timeout)
+    return {"ok": res["ok"], "status": res["status"], "body": res["body"], "timings": res["timings"],
+            "headers": res["headers"]}
 
 def lambda_handler(event, ctx):
     """
@@ -37,6 +26,13 @@ def lambda_handler(event, ctx):
     caption   = job.get("caption", "")
     video_url = event["video_url"]
 
+    # 同じ ig_user_id の呼び出しが集中しているなら、すぐに空かない分は投げずに待ってもらう（status は書かない）
+    try:
+        acquire("ig", ig_user, "graph", reservation=event.get("rate_reservation"), context=ctx, call_timeout=20)
+    except RateLimited as e:
+        return {"ok": False, "status": 429, "body": {"error": "rate_limit"},
+                "wait_sec": int(e.wait_sec) + 1, "rate_reservation": e.reservation}
+
     url  = f"{GRAPH}/{ig_user}/media"
     data = {
         "media_type": "REELS",
@@ -46,11 +42,16 @@ def lambda_handler(event, ctx):
     }
 
     res = _post_form(url, data)
-    
+    observe("ig", ig_user, "graph", res["status"], res.pop("headers", {}), res["body"])
+
+    timings = res.pop("timings", {})
     if res["ok"]:
-        # ここでは最終確定しない（Publish までいく想定）
+        # ここでは最終確定しない（Publish までいく想定）。コンテナ ID は戻り値でステートマシンに渡すので書かない
         pass
     else:
-        set_status(job["job_id"], f"ERROR,create_container,{res.get('status')}")
+        (JobUpdate(job["job_id"]).status(f"ERROR,create_container,{res.get('status')}")
+            .set(error_detail=json.dumps(res["body"], ensure_ascii=False, default=str)[:500])
+            .timing("create_container", timings.get("ttfb_ms"))
+            .commit())
     return res
 
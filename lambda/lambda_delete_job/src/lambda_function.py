@@ -1,10 +1,11 @@
-import os, json, boto3, re, urllib.parse
+import os, json, re, urllib.parse
+from job_store import store
 
 REGION = os.getenv("AWS_REGION", "ap-northeast-1")
 TABLE  = os.getenv("JOBS_TABLE", "convert_jobs")
 API_TOKEN = os.getenv("API_TOKEN")  # 任意: ある場合は X-API-Token と一致すれば通す
 
-ddb   = boto3.resource("dynamodb", region_name=REGION).Table(TABLE)
+jobs  = store(TABLE)
 
 def _resp(code, body):
     return {
@@ -45,16 +46,15 @@ def lambda_handler(event, ctx):
 
     # 1) レコード取得
     try:
-        r = ddb.get_item(Key={"job_id": job_id})
-        item = r.get("Item")
-        if not item:
+        job = jobs.get(job_id, fields=["wp_id", "site_url"])
+        if not job:
             return _resp(404, {"error":"not found", "job_id": job_id})
     except Exception as e:
         return _resp(500, {"error": f"ddb get failed: {e}", "job_id": job_id})
 
     # レコード側の識別子（/presign 時に保存している前提）
-    rec_wp_id    = str(item.get("wp_id", ""))         # 例: "1262"
-    rec_site_url = _normalize_site_url(item.get("site_url", ""))
+    rec_wp_id    = str(job.wp_id)                     # 例: "1262"
+    rec_site_url = _normalize_site_url(job.site_url)
 
     # 2) 認可チェック
     # 2-1) マスターAPIトークン（任意）
@@ -76,7 +76,7 @@ def lambda_handler(event, ctx):
 
     # 3) 削除実行（冪等）
     try:
-        ddb.delete_item(Key={"job_id": job_id})
+        jobs.delete(job_id)
         return _resp(200, {"ok": True, "job_id": job_id})
     except Exception as e:
         return _resp(500, {"error": f"ddb delete failed: {e}", "job_id": job_id})
@@ -1,34 +1,66 @@
 # lambda_get_job_status.py (Python 3.11)
 import os
 import json
-import boto3
-from boto3.dynamodb.conditions import Key
+import base64
+import hashlib
+from decimal import Decimal
+from job_store import store
 
-REGION = os.getenv("AWS_REGION", "ap-northeast-1")
 TABLE = os.getenv("JOBS_TABLE", "convert_jobs")
 # site_urlベースのGSI（例: site_url-updated_at-index）
 GSI_SITEURL = os.getenv("JOBS_GSI_SITEURL", "site_url-updated_at-index")
 
-ddb = boto3.resource("dynamodb", region_name=REGION)
-table = ddb.Table(TABLE)
+jobs = store(TABLE)
 
-def _resp(code, body):
+MAX_LIMIT = 500
+# 返却する 6 項目だけ読む（job_id は常に付く）
+FIELDS = ["wp_id", "status", "updated_at", "media_id", "platform"]
+
+def _resp(code, body, headers=None):
     return {
         "statusCode": code,
         "headers": {
             "Content-Type": "application/json",
             "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "Content-Type",
-            "Access-Control-Allow-Methods": "GET, OPTIONS"
+            "Access-Control-Allow-Headers": "Content-Type, If-None-Match",
+            "Access-Control-Allow-Methods": "GET, OPTIONS",
+            "Access-Control-Expose-Headers": "ETag",
+            **(headers or {}),
         },
-        "body": json.dumps(body, ensure_ascii=False)
+        "body": json.dumps(body, ensure_ascii=False) if body is not None else ""
     }
 
+def _encode_cursor(last_key: dict) -> str:
+    """LastEvaluatedKey を不透明な文字列にする（Decimal は数値に戻す）"""
+    plain = {k: (int(v) if isinstance(v, Decimal) else v) for k, v in last_key.items()}
+    return base64.urlsafe_b64encode(json.dumps(plain, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str) -> dict:
+    pad = "=" * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(cursor + pad).decode("utf-8"))
+
+def _etag(result: dict) -> str:
+    """
+    返すページそのもの（射影した項目と next_cursor）のハッシュ。
+    先頭 1 件だけでは、削除や同じ秒の別ジョブの更新、2 ページ目以降の変化を見落とすため
+    """
+    raw = json.dumps(result, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return '"%s"' % hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def _header(event, name):
+    for k, v in (event.get("headers") or {}).items():
+        if k.lower() == name:
+            return v
+    return None
+
 def lambda_handler(event, ctx):
     """
     /jobs?site_url=https://example.com
-    または /jobs/{site_url} に対応。
-    site_url に一致する全ジョブを返す。
+    または /jobs/{site_url} に対応。更新日時降順で返す。
+      limit  : 1 ページの件数（省略時は全件）。続きがあれば next_cursor を返す
+      cursor : 前回の next_cursor
+      since  : updated_at がこれより新しいジョブだけ（差分ポーリング）
+    ETag（返すページのハッシュ）を返し、If-None-Match が一致すれば本文を省いて 304 を返す。
     """
     qp = event.get("queryStringParameters") or {}
     path = event.get("pathParameters") or {}
@@ -38,25 +70,28 @@ def lambda_handler(event, ctx):
         return _resp(400, {"error": "site_url required"})
 
     try:
-        # GSIを使ってsite_urlで絞り込み、全件取得（更新日時降順）
-        response = table.query(
-            IndexName=GSI_SITEURL,
-            KeyConditionExpression=Key("site_url").eq(site_url),
-            ScanIndexForward=False  # 降順（最新が最初）
-        )
-        items = response.get("Items", [])
-
-        # ページング対応：LastEvaluatedKeyがある場合は繰り返し取得
-        while "LastEvaluatedKey" in response:
-            response = table.query(
-                IndexName=GSI_SITEURL,
-                KeyConditionExpression=Key("site_url").eq(site_url),
-                ExclusiveStartKey=response["LastEvaluatedKey"],
-                ScanIndexForward=False
-            )
-            items.extend(response.get("Items", []))
-
-        if not items:
+        limit = min(MAX_LIMIT, int(qp["limit"])) if qp.get("limit") else None
+        since = int(qp["since"]) if qp.get("since") else None
+        cursor = qp.get("cursor") or None
+        start_key = _decode_cursor(cursor) if cursor else None
+        if limit is not None and limit <= 0:
+            raise ValueError("limit must be positive")
+    except Exception as e:
+        return _resp(400, {"error": f"invalid parameter: {e}"})
+
+    try:
+        items, last_key = [], start_key
+        while True:
+            # since は GSI のソートキーで差分だけ、降順（最新が最初）
+            page, last_key = jobs.query_page(GSI_SITEURL, "site_url", site_url, "updated_at", gt=since, desc=True,
+                                             limit=limit - len(items) if limit is not None else None,
+                                             start=last_key, fields=FIELDS)
+            items.extend(page)
+            # limit 指定時は件数が揃ったら止める。未指定なら従来通り全件
+            if not last_key or (limit is not None and len(items) >= limit):
+                break
+
+        if not items and since is None and not cursor:
             return _resp(404, {"error": "no jobs found for site_url", "site_url": site_url})
 
         # 必要なフィールドだけ返却
@@ -72,7 +107,13 @@ def lambda_handler(event, ctx):
             for it in items
         ]
 
-        return _resp(200, {"site_url": site_url, "jobs": body})
+        result = {"site_url": site_url, "jobs": body}
+        if last_key and limit is not None:
+            result["next_cursor"] = _encode_cursor(last_key)
+        etag = _etag(result)
+        if _header(event, "if-none-match") == etag:
+            return _resp(304, None, {"ETag": etag})
+        return _resp(200, result, {"ETag": etag})
 
     except Exception as e:
         return _resp(500, {"error": str(e)})
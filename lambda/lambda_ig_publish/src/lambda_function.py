@@ -1,25 +1,15 @@
-import json, urllib.parse, urllib.request
-from ddb_helpers import set_status
+import json
+from ddb_helpers import JobUpdate
+from http_helpers import request
+from rate_limiter import RateLimited, acquire, observe
 
 GRAPH = "https://graph.facebook.com/v20.0"
 
 def _post_form(url: str, data: dict, timeout=20):
-    body = urllib.parse.urlencode(data).encode("utf-8")
-    req = urllib.request.Request(url, data=body, method="POST")
-    req.add_header("Content-Type", "application/x-www-form-urlencoded")
-    try:
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            raw = resp.read()
-            return {"ok": True, "status": resp.status, "body": json.loads(raw.decode("utf-8"))}
-    except urllib.error.HTTPError as e:
-        err = (e.read() or b"").decode("utf-8", errors="replace")
-        try:
-            j = json.loads(err)
-        except Exception:
-            j = {"raw": err}
-        return {"ok": False, "status": e.code, "body": j}
-    except Exception as e:
-        return {"ok": False, "status": 0, "body": {"error": str(e)}}
+    # 公開は二重投稿になり得るので再試行しない
+    res = request("POST", url, form=data, timeout=timeout, retries=0)
+    return {"ok": res["ok"], "status": res["status"], "body": res["body"], "timings": res["timings"],
+            "headers": res["headers"]}
 
 def lambda_handler(event, ctx):
     """
@@ -33,16 +23,27 @@ def lambda_handler(event, ctx):
     ig    = event["job"]["ig_user_id"]
     cid   = event["cid"]["creation_id"]
 
+    # 公開は 24 時間あたりの件数に上限がある。すぐに空かない分は投げずに待ってもらう（status は書かない）
+    try:
+        acquire("ig", ig, "publish", reservation=event.get("rate_reservation"), context=ctx, call_timeout=20)
+    except RateLimited as e:
+        return {"ok": False, "status": 429, "media_id": None, "raw": {"error": "rate_limit"},
+                "wait_sec": int(e.wait_sec) + 1, "rate_reservation": e.reservation}
+
     url = f"{GRAPH}/{ig}/media_publish"
     data = {"creation_id": cid, "access_token": token}
     res = _post_form(url, data)
+    observe("ig", ig, "graph", res["status"], res.pop("headers", {}), res["body"])   # 使用率ヘッダは Graph API 全体のもの
 
+    upd = JobUpdate(event["job"]["job_id"]).timing("publish", res["timings"].get("ttfb_ms"))
     if res["ok"]:
         media_id = res.get("body", {}).get("id")
-        set_status(event["job"]["job_id"], str(media_id or ""))  # ← 成功は media_id をそのまま
+        upd.status(str(media_id or "")).set(media_id=str(media_id or "")).commit()  # ← 成功は media_id をそのまま
         return {"ok": True, "status": res["status"], "media_id": media_id, "raw": res["body"]}
     else:
-        set_status(event["job"]["job_id"], f"ERROR,publish,{res.get('status')}")
+        (upd.status(f"ERROR,publish,{res.get('status')}")
+            .set(error_detail=json.dumps(res["body"], ensure_ascii=False, default=str)[:500])
+            .commit())
         return {"ok": False, "status": res["status"], "media_id": None, "raw": res["body"]}
 
     
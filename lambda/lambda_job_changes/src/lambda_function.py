@@ -0,0 +1,150 @@
+# lambda_job_changes.py (Python 3.11)
+# /jobs/changes?site_url=...&watermark=...&wait=20
+# 前回の watermark 以降に更新されたジョブだけを返す差分フィード（site_url-updated_at-index のソートキーを使用）
+#  - 変化が無ければ wait 秒まで待って再確認する（ロングポーリング）
+#  - ddb_helpers.set_status / convert-worker の _update_status はどちらも updated_at を進めるので、ここに現れる
+#  - updated_at は秒単位なので、同じ秒に 2 回更新されたジョブは rev（更新のたびに +1）で見分ける
+import os
+import json
+import time
+import base64
+from job_store import store
+
+TABLE = os.getenv("JOBS_TABLE", "convert_jobs")
+GSI_SITEURL = os.getenv("JOBS_GSI_SITEURL", "site_url-updated_at-index")
+MAX_WAIT_SEC = int(os.getenv("MAX_WAIT_SEC", "20"))        # API Gateway の 29 秒制限より短く
+POLL_INTERVAL_SEC = float(os.getenv("POLL_INTERVAL_SEC", "2"))
+MAX_LIMIT = 200
+
+jobs = store(TABLE)
+
+FIELDS = ["wp_id", "status", "updated_at", "rev", "media_id", "platform", "convert_status"]
+
+def _resp(code, body):
+    return {
+        "statusCode": code,
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Headers": "Content-Type",
+            "Access-Control-Allow-Methods": "GET, OPTIONS"
+        },
+        "body": json.dumps(body, ensure_ascii=False)
+    }
+
+# watermark: 最後に返した updated_at と、その時刻で返し済みの {job_id: rev}
+# （updated_at は秒単位なので、同じ秒の更新を取りこぼさないよう >= で読み、同じ rev のまま返し済みのものだけ除く）
+def _rev(it) -> int:
+    return int(it.get("rev", 0))
+
+def _encode_watermark(ts: int, seen: dict) -> str:
+    raw = json.dumps({"t": int(ts), "seen": seen}, separators=(",", ":"), sort_keys=True)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_watermark(token: str):
+    pad = "=" * (-len(token) % 4)
+    wm = json.loads(base64.urlsafe_b64decode(token + pad).decode("utf-8"))
+    if "ids" in wm:
+        # 旧形式（rev 無し）: その秒の返し済みは rev を問わず除く
+        return int(wm["t"]), {i: None for i in wm["ids"] or []}
+    return int(wm["t"]), {k: int(v) for k, v in (wm.get("seen") or {}).items()}
+
+def _seen(it, ts: int, seen: dict) -> bool:
+    if int(it.get("updated_at", 0)) != ts or it.get("job_id") not in seen:
+        return False
+    rev = seen[it.get("job_id")]
+    return rev is None or rev == _rev(it)
+
+def _current_watermark(site_url: str):
+    """最新 1 件の時刻（初回呼び出し用。ここから先の変化だけを追う）"""
+    top, _ = jobs.query_page(GSI_SITEURL, "site_url", site_url, "updated_at", desc=True, limit=1,
+                             fields=["updated_at", "rev"])
+    if not top:
+        return 0, {}
+    return int(top[0].get("updated_at", 0)), {top[0].get("job_id"): _rev(top[0])}
+
+def _changes(site_url: str, ts: int, seen: dict, limit: int):
+    """updated_at >= ts を古い順に読み、返し済みを除いて最大 limit 件。戻り値: (items, has_more)"""
+    items, start = [], None
+    while True:
+        page, start = jobs.query_page(GSI_SITEURL, "site_url", site_url, "updated_at", gte=ts,
+                                      limit=limit + len(seen), start=start, fields=FIELDS)
+        for it in page:
+            if _seen(it, ts, seen):
+                continue
+            items.append(it)
+            if len(items) > limit:
+                return items[:limit], True
+        if not start:
+            return items, False
+
+def _advance(ts: int, seen: dict, items: list):
+    """返した items を反映した新しい watermark"""
+    for it in items:
+        u = int(it.get("updated_at", 0))
+        if u > ts:
+            ts, seen = u, {}
+        if u == ts:
+            seen = {**seen, it.get("job_id"): _rev(it)}
+    return ts, seen
+
+def lambda_handler(event, ctx):
+    """
+    クエリ:
+      site_url  : 必須
+      watermark : 前回のレスポンスの watermark（省略時は「今」から。since=<updated_at> でも指定可）
+      wait      : 変化が無いとき最大何秒待つか（0〜MAX_WAIT_SEC、既定 0 = 即時に返す）
+      limit     : 1 回に返す最大件数（既定/上限 200）。has_more=true ならすぐ次を呼ぶ
+    """
+    qp = event.get("queryStringParameters") or {}
+    site_url = qp.get("site_url")
+    if not site_url:
+        return _resp(400, {"error": "site_url required"})
+
+    try:
+        wait = max(0, min(MAX_WAIT_SEC, int(qp.get("wait") or 0)))
+        limit = max(1, min(MAX_LIMIT, int(qp.get("limit") or MAX_LIMIT)))
+        if qp.get("watermark"):
+            ts, seen = _decode_watermark(qp["watermark"])
+        elif qp.get("since"):
+            ts, seen = int(qp["since"]) + 1, {}
+        else:
+            ts, seen = None, {}
+    except Exception as e:
+        return _resp(400, {"error": f"invalid parameter: {e}"})
+
+    try:
+        if ts is None:
+            ts, seen = _current_watermark(site_url)
+            return _resp(200, {"site_url": site_url, "jobs": [], "has_more": False,
+                               "watermark": _encode_watermark(ts, seen)})
+
+        deadline = time.time() + wait
+        polls = 0
+        while True:
+            items, has_more = _changes(site_url, ts, seen, limit)
+            polls += 1
+            remaining_ms = ctx.get_remaining_time_in_millis() if ctx else 10 ** 9
+            if items or time.time() + POLL_INTERVAL_SEC > deadline or remaining_ms < (POLL_INTERVAL_SEC + 3) * 1000:
+                break
+            time.sleep(POLL_INTERVAL_SEC)
+
+        new_ts, new_seen = _advance(ts, seen, items)
+        print(f"[CHANGES] site={site_url} polls={polls} changes={len(items)} has_more={has_more}")
+        body = [
+            {
+                "job_id": it.get("job_id", ""),
+                "wp_id": it.get("wp_id", ""),
+                "status": it.get("status", ""),
+                "convert_status": it.get("convert_status", ""),
+                "updated_at": int(it.get("updated_at", 0)),
+                "media_id": it.get("media_id", ""),
+                "platform": it.get("platform", ""),
+            }
+            for it in items
+        ]
+        return _resp(200, {"site_url": site_url, "jobs": body, "has_more": has_more,
+                           "watermark": _encode_watermark(new_ts, new_seen)})
+
+    except Exception as e:
+        return _resp(500, {"error": str(e)})
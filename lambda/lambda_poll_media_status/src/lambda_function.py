@@ -1,9 +1,4 @@
-import os
-import json
-import urllib.request
-import urllib.error
-import urllib.parse
-import time
+from x_publisher import XPublisher
 
 def lambda_handler(event, context):
     """
@@ -12,58 +7,19 @@ def lambda_handler(event, context):
         "media_id": "...",
         "access_token": "...",
         "job_id": "...",
+        "max_wait_sec": 180,      // lambda_x_finalize が渡す締め切り
+        "poll": {...},            // 前回の戻り値の poll（初回は finalize が作ったもの / 無くても可）
         // 以前の処理で渡されたその他情報
     }
+    check_after_secs に従って（無ければ指数バックオフで）呼び出しの中で聞き直し、
+    残り時間に収まらない待ちになったら check_after 秒後に呼び直してもらう形で返す
+    （XPublisher.poll_status の薄いラッパー）
     """
     media_id = event.get("media_id")
     access_token = event.get("access_token")
-    job_id = event.get("job_id")
 
     if not media_id or not access_token:
         return {"complete": False, "error": "missing media_id or access_token"}
 
-    # URL に command=STATUS と media_id を付与
-    base_url = "https://api.x.com/2/media/upload"
-    query = urllib.parse.urlencode({
-        "command": "STATUS",
-        "media_id": media_id,
-    })
-    status_url = f"{base_url}?{query}"
-
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    print(f"status_url: {status_url}")
-    req = urllib.request.Request(status_url, headers=headers, method="GET")
-
-    try:
-        with urllib.request.urlopen(req, timeout=20) as resp:
-            raw = resp.read().decode("utf-8")
-            data = json.loads(raw)
-            # 例: { "data": { "processing_info": { "state": "...", "check_after_secs": ... } } }
-            processing_info = data.get("data", {}).get("processing_info") or {}
-            state = processing_info.get("state")
-            check_after = processing_info.get("check_after_secs")
-            print(f"state: {state}, check_after: {check_after}")
-            result = {
-                "complete": False,
-                "status": state,
-                "check_after": check_after,
-                "media_id": media_id,
-                "job_id": job_id,
-                "access_token": access_token
-            }
-
-            # 成功 or 失敗状態なら complete を True に
-            if state == "succeeded" or state == "failed":
-                result["complete"] = True
-
-            return result
-
-    except urllib.error.HTTPError as e:
-        body = e.read().decode()
-        return {"complete": False, "error": f"status_failed: HTTP {e.code}", "body": body, "media_id": media_id, "job_id": job_id}
-    except urllib.error.URLError as e:
-        return {"complete": False, "error": f"URLError: {e.reason}", "media_id": media_id, "job_id": job_id}
-    except Exception as e:
-        return {"complete": False, "error": str(e), "media_id": media_id, "job_id": job_id}
+    pub = XPublisher(access_token, event.get("job_id"))
+    return pub.poll_status(media_id, int(event.get("max_wait_sec", 180)), event.get("poll"), context)
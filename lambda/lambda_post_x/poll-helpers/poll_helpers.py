@@ -0,0 +1,138 @@
+# poll_helpers.py
+# 「処理が終わるまで状態を聞き直す」ポーリングの共通エンジン（レイヤで配布）
+#  - 次に聞くまでの間隔: サーバの指示（X の check_after_secs）があればそれに従い、無ければ上限付き指数バックオフ
+#  - 待ち時間が Lambda の残り時間に収まるなら呼び出しの中で待って聞き直す（ステートマシンの往復を減らす）
+#    収まらなければ wait_sec を返し、ステートマシンの Wait（SecondsPath）に任せる
+#  - 呼び出しをまたぐ状態は "poll" に入れて返す。次の呼び出しの event["poll"] にそのまま渡すこと
+#  - max_wait_sec の締め切りを過ぎる待ちになったら timed_out で打ち切る
+#  - simulate(): 仮想時計でポーリングを回し、呼び出し回数・問い合わせ回数を数える（ローカル検証用）
+import os, time, random
+
+BASE_DELAY_SEC   = float(os.getenv("POLL_BASE_DELAY", "2"))
+MAX_DELAY_SEC    = float(os.getenv("POLL_MAX_DELAY", "30"))
+INLINE_MAX_SEC   = float(os.getenv("POLL_INLINE_MAX_SEC", "40"))  # 1 回の呼び出しの中で待つ合計の上限
+RESERVE_SEC      = float(os.getenv("POLL_RESERVE_SEC", "12"))     # 待った後の問い合わせと戻りに残しておく時間
+DEFAULT_MAX_WAIT = int(os.getenv("POLL_MAX_WAIT", "600"))
+
+
+def start_state(max_wait_sec=None, now=None) -> dict:
+    """ポーリングの開始時刻と締め切り（最初の呼び出しの前に作っておけば、その時刻から数える）"""
+    now = time.time() if now is None else now
+    return {"started_at": now, "deadline": now + int(max_wait_sec or DEFAULT_MAX_WAIT),
+            "attempt": 0, "checks": 0, "invocations": 0}
+
+
+def next_delay(attempt: int, hint=None) -> float:
+    """hint（サーバが示した秒数）優先。無ければ BASE * 2^attempt を MAX で頭打ちにしてジッタ"""
+    if hint is not None:
+        try:
+            return max(0.0, float(hint))
+        except (TypeError, ValueError):
+            pass
+    d = min(MAX_DELAY_SEC, BASE_DELAY_SEC * (2 ** attempt))
+    return random.uniform(d / 2, d)
+
+
+def _remaining(context) -> float:
+    if context is None:
+        return INLINE_MAX_SEC + RESERVE_SEC
+    return context.get_remaining_time_in_millis() / 1000.0
+
+
+def poll(check, state=None, *, context=None, max_wait_sec=None, clock=time.time, sleep=time.sleep) -> dict:
+    """
+    check() -> (done: bool, hint_sec or None, result)
+    戻り値:
+      {"done": True,  "timed_out": False, "result": ..., "poll": state}
+      {"done": False, "timed_out": False, "result": ..., "poll": state, "wait_sec": n}  ← n 秒後にもう一度呼ぶ
+      {"done": False, "timed_out": True,  "result": ..., "poll": state}                ← max_wait_sec 超過
+    """
+    state = dict(state or start_state(max_wait_sec, clock()))
+    state["invocations"] = int(state.get("invocations", 0)) + 1
+    t_in = clock()
+    waited = 0.0
+
+    # 予定より早く呼ばれたら（Wait を短く設定した等）残りをここで待つ
+    early = float(state.get("next_at", 0)) - t_in
+    if early > 0 and early + RESERVE_SEC <= _remaining(context) and early <= INLINE_MAX_SEC:
+        sleep(early)
+        waited += early
+
+    while True:
+        done, hint, result = check()
+        state["checks"] = int(state.get("checks", 0)) + 1
+        now = clock()
+        if done:
+            state.pop("next_at", None)
+            print(f"[POLL] done checks={state['checks']} invocations={state['invocations']} "
+                  f"elapsed={round(now - state['started_at'], 1)}s")
+            return {"done": True, "timed_out": False, "result": result, "poll": state}
+
+        delay = next_delay(int(state.get("attempt", 0)), hint)
+        state["attempt"] = int(state.get("attempt", 0)) + 1
+        if now + delay > float(state["deadline"]):
+            print(f"[POLL] timed out checks={state['checks']} invocations={state['invocations']} "
+                  f"elapsed={round(now - state['started_at'], 1)}s")
+            return {"done": False, "timed_out": True, "result": result, "poll": state}
+
+        state["next_at"] = now + delay
+        if waited + delay <= INLINE_MAX_SEC and delay + RESERVE_SEC <= _remaining(context):
+            sleep(delay)
+            waited += delay
+            continue
+
+        print(f"[POLL] yield wait={round(delay, 1)}s checks={state['checks']} invocations={state['invocations']} "
+              f"inline_wait={round(waited, 1)}s")
+        return {"done": False, "timed_out": False, "result": result, "poll": state,
+                "wait_sec": max(1, int(round(delay)))}
+
+
+# ===== ローカル検証 =====
+class _VirtualClock:
+    def __init__(self):
+        self.t = 0.0
+
+    def now(self):
+        return self.t
+
+    def sleep(self, s):
+        self.t += s
+
+
+class _FakeContext:
+    def __init__(self, clock, timeout_sec):
+        self.clock, self.end = clock, clock.now() + timeout_sec
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0.0, self.end - self.clock.now()) * 1000)
+
+
+def simulate(ready_after_sec: float, *, hint=None, lambda_timeout_sec=60, max_wait_sec=600,
+             check_latency_sec=0.3, inline=True) -> dict:
+    """
+    仮想時計で 1 件分のポーリングを回す。ready_after_sec 経過で処理完了するサーバを想定。
+      hint: サーバが返す check_after_secs（None なら指数バックオフ）
+      inline=False で従来どおり 1 呼び出し 1 問い合わせ（Wait はステートマシン側）と比較できる
+    戻り値: {"done", "timed_out", "invocations", "checks", "elapsed"}
+    """
+    global INLINE_MAX_SEC
+    clock = _VirtualClock()
+    saved = INLINE_MAX_SEC
+    if not inline:
+        INLINE_MAX_SEC = 0.0
+    try:
+        def check():
+            clock.sleep(check_latency_sec)
+            return clock.now() >= ready_after_sec, hint, None
+
+        state = start_state(max_wait_sec, clock.now())
+        while True:
+            ctx = _FakeContext(clock, lambda_timeout_sec)
+            r = poll(check, state, context=ctx, clock=clock.now, sleep=clock.sleep)
+            state = r["poll"]
+            if r["done"] or r["timed_out"]:
+                return {"done": r["done"], "timed_out": r["timed_out"], "invocations": state["invocations"],
+                        "checks": state["checks"], "elapsed": round(clock.now(), 1)}
+            clock.sleep(r["wait_sec"])   # ステートマシンの Wait
+    finally:
+        INLINE_MAX_SEC = saved
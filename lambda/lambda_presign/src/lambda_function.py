@@ -3,6 +3,8 @@ import os, json, uuid, base64, time
 from urllib.parse import urlencode, quote
 import boto3
 from botocore.client import Config
+from token_cipher import encrypt_token
+from job_store import Job, store, parse_publish_at
 
 REGION          = os.getenv("REGION", "ap-northeast-1")     # AWS_REGION は予約キーなので使わない
 IN_BUCKET       = os.getenv("IN_BUCKET")                    # 例: itmar-video-upload-bucket
@@ -13,9 +15,7 @@ JOBS_TABLE      = os.getenv("JOBS_TABLE", "convert_jobs")
 KMS_KEY_ID      = os.getenv("KMS_KEY_ID")                   # IG 連携時のみ必須
 
 s3  = boto3.client("s3", region_name=REGION, config=Config(signature_version="s3v4"))
-ddb = boto3.resource("dynamodb", region_name=REGION)
-kms = boto3.client("kms", region_name=REGION)
-jobs = ddb.Table(JOBS_TABLE)
+jobs = store(JOBS_TABLE)
 
 MIME_MAP = {
     "mp4":"video/mp4","m4v":"video/mp4","mov":"video/quicktime","webm":"video/webm",
@@ -39,47 +39,227 @@ def _bound_expires(v: int) -> int:
     if v > 3600: v = 3600
     return v
 
-def lambda_handler(event, context):
-    headers = { (k or "").lower(): v for k, v in (event.get("headers") or {}).items() }
-    body_raw = event.get("body") or "{}"
-    body     = json.loads(body_raw) if isinstance(body_raw, str) else (body_raw or {})
+def _params_str(raw_params) -> str:
+    """変換パラメータを文字列に"""
+    if isinstance(raw_params, (dict, list)):
+        return json.dumps(raw_params, separators=(",", ":"), ensure_ascii=False)
+    if isinstance(raw_params, str):
+        return raw_params
+    return ""
 
-    # 共通
-    op = (body.get("op") or "put").lower()
-    site_url    = (headers.get("x-site-url") or body.get("site_url") or "").strip()
-    webhook_url = (headers.get("x-webhook-url") or "").strip()
+def _build_metadata(job_id, params_str: str, webhook_url: str, publish_at=None) -> dict:
+    """Metadata（後段へ job-id/params/webhook/publish-at を渡す）"""
+    metadata = {}
+    if job_id:
+        metadata["job-id"] = job_id
+        if publish_at:
+            metadata["publish-at"] = str(publish_at)   # 変換後、notifier がこの時刻まで待ち行列に積む
+    if params_str:
+        try:
+            params_str.encode("ascii")
+            metadata["params"] = params_str
+        except Exception:
+            metadata["params-b64"] = base64.b64encode(params_str.encode("utf-8")).decode("ascii")
+    if webhook_url:
+        metadata["cb-b64"] = base64.b64encode(webhook_url.encode("utf-8")).decode("ascii")
+    return metadata
 
-    # ===== op=get: 署名付き GET URL を返す =====
-    if op == "get":
-        # 例: { "op":"get", "bucket": "...", "key": "...", "expires": 600 }
-        bucket  = (body.get("bucket") or IN_BUCKET or "").strip()
-        key     = (body.get("key") or "").strip()
-        expires = _bound_expires(body.get("expires"))
+def _build_tagging(out_key: str) -> str:
+    """Tagging（変換/投稿の起動スイッチ）"""
+    tags = { "out_bucket": OUT_BUCKET, "out_key": out_key, "transcode": "true" }
+    return urlencode(tags, quote_via=quote, safe="")
+
+def _new_job(job_id, now, site_url, ig_user_id, wp_id, caption, token_cipher_b64, in_key, out_key,
+             publish_at=None) -> Job:
+    # ジョブ作成（GSI = wp_id-updated_at-index を使うため wp_id は非空前提）
+    return Job(
+        job_id=job_id,
+        platform="ig",
+        status="pending",
+        created_at=now,
+        updated_at=now,
+        site_url=site_url or "",
+        ig_user_id=ig_user_id,
+        wp_id=wp_id,
+        caption=caption,
+        token_cipher=token_cipher_b64,
+        in_bucket=IN_BUCKET,
+        in_key=in_key,
+        out_bucket=OUT_BUCKET,
+        out_key=out_key,
+        publish_at=publish_at,
+    )
+
+def _presign_put(in_key, content_type, metadata, tagging_str, expires) -> dict:
+    """PUT URL と、クライアントが付けるべきヘッダ一式"""
+    params = {
+        "Bucket": IN_BUCKET,
+        "Key": in_key,
+        "ContentType": content_type,
+        "Metadata": metadata or {},
+    }
+    if tagging_str:
+        params["Tagging"] = tagging_str
+
+    put_url = s3.generate_presigned_url("put_object", Params=params, ExpiresIn=expires)
+
+    required_headers = {"Content-Type": content_type}
+    if tagging_str:
+        required_headers["x-amz-tagging"] = tagging_str
+    for mk, mv in (metadata or {}).items():
+        required_headers[f"x-amz-meta-{mk}"] = mv
+
+    return {
+        "bucket": IN_BUCKET,
+        "key": in_key,
+        "put_url": put_url,
+        "required_headers": required_headers,
+        "x_amz_meta": metadata,
+        "x_amz_tagging": tagging_str or None,
+        "content_type": content_type,
+        "expires_in": expires,
+    }
+
+def _presign_get(bucket, key, expires) -> dict:
+    if not bucket or not key:
+        raise ValueError("bucket and key required")
+    # セキュリティ: 許可バケットのみに限定（必要に応じて調整）
+    allowed = {b for b in [IN_BUCKET, OUT_BUCKET] if b}
+    if bucket not in allowed:
+        raise PermissionError("bucket not allowed")
+    get_url = s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=expires
+    )
+    return {"bucket": bucket, "key": key, "get_url": get_url, "expires_in": expires}
+
+# ===== バッチ（ギャラリー等の複数ファイルを 1 リクエストで） =====
+MAX_BATCH = int(os.getenv("PRESIGN_MAX_BATCH", "50"))
+BATCH_NAMESPACE = uuid.UUID("5b0e6a52-3f1c-4d7e-9a55-0c2f8d1e7b34")
 
-        if not bucket or not key:
-            return _resp(400, {"error": "bucket and key required"})
+def _batch_ids(site_url: str, request_id: str, index: int):
+    """
+    request_id があれば job_id / in_key のファイル名をそこから決める（同じ要求の再送で同じ値になる）。
+    無ければ従来どおりランダム
+    """
+    if not request_id:
+        return str(uuid.uuid4()), str(uuid.uuid4())
+    base = f"{site_url}|{request_id}|{index}"
+    return str(uuid.uuid5(BATCH_NAMESPACE, "job|" + base)), str(uuid.uuid5(BATCH_NAMESPACE, "key|" + base))
 
-        # セキュリティ: 許可バケットのみに限定（必要に応じて調整）
-        allowed = {b for b in [IN_BUCKET, OUT_BUCKET] if b}
-        if bucket not in allowed:
-            return _resp(403, {"error": "bucket not allowed"})
+def _get_batch(body) -> dict:
+    """{ "op":"get_batch", "items":[{"bucket","key"}...], "expires":600 }"""
+    items = body.get("items") or []
+    if not isinstance(items, list) or not items:
+        return _resp(400, {"error": "items required"})
+    if len(items) > MAX_BATCH:
+        return _resp(400, {"error": f"too many items (max {MAX_BATCH})"})
+    expires = _bound_expires(body.get("expires"))
 
+    results = []
+    for it in items:
+        bucket = ((it or {}).get("bucket") or IN_BUCKET or "").strip()
+        key    = ((it or {}).get("key") or "").strip()
         try:
-            get_url = s3.generate_presigned_url(
-                "get_object",
-                Params={"Bucket": bucket, "Key": key},
-                ExpiresIn=expires
-            )
-            return _resp(200, {
-                "bucket": bucket,
-                "key": key,
-                "get_url": get_url,
-                "expires_in": expires
-            })
+            results.append(_presign_get(bucket, key, expires))
         except Exception as e:
-            return _resp(500, {"error": f"presign(get) failed: {e}"})
+            results.append({"bucket": bucket, "key": key, "error": str(e)})
+    return _resp(200, {"items": results, "expires_in": expires})
 
-    # ===== ここから op=put =====
+def _put_batch(body, headers, site_url, webhook_url) -> dict:
+    """
+    { "op":"put_batch", "request_id":"...", "wp_id":"..", "ig_user_id":"..", "caption":"..", "params":{..},
+      "publish_at":?, "files":[{"ext":"jpg", "type":?, "out_key":?, "caption":?, "params":?, "publish_at":?}, ...] }
+    files の各要素で省略した項目は上位の値を使う。publish_at（epoch 秒 / ISO 8601）があれば予約投稿。
+    トークンの暗号化は 1 回、ジョブは batch_write_item でまとめて書く。
+    request_id（X-Request-Id でも可）を付けた再送は同じ job_id / key を返し、ジョブを作り直さない。
+    """
+    if not IN_BUCKET:
+        return _resp(500, {"error":"IN_BUCKET not set"})
+
+    fb_token = (headers.get("x-fb-token") or headers.get("x-fb-access-token") or "").strip()
+    if not fb_token:
+        return _resp(401, {"error":"missing X-FB-Token"})
+
+    files = body.get("files") or []
+    if not isinstance(files, list) or not files:
+        return _resp(400, {"error": "files required"})
+    if len(files) > MAX_BATCH:
+        return _resp(400, {"error": f"too many files (max {MAX_BATCH})"})
+
+    request_id = (headers.get("x-request-id") or body.get("request_id") or "").strip()
+    try:
+        publish_ats = [parse_publish_at((f or {}).get("publish_at") or body.get("publish_at")) for f in files]
+    except (TypeError, ValueError):
+        return _resp(400, {"error": "publish_at must be epoch seconds or ISO 8601"})
+    ig_user_id = (body.get("ig_user_id") or "").strip()
+    wp_id      = (body.get("wp_id") or "").strip()
+    expires    = _bound_expires(body.get("expires"))
+    create_job = bool(wp_id)
+
+    if create_job:
+        if not KMS_KEY_ID:
+            return _resp(500, {"error":"KMS_KEY_ID not set"})
+        try:
+            token_cipher_b64 = encrypt_token(fb_token, KMS_KEY_ID)
+        except Exception as e:
+            return _resp(500, {"error": f"kms encrypt failed: {e}"})
+
+    now = int(time.time())
+    plans = []
+    for idx, f in enumerate(files):
+        f = f or {}
+        ext          = _sanitize_ext(f.get("ext") or body.get("ext") or "jpg")
+        content_type = (f.get("type") or _choose_mime(ext)).strip()
+        out_key      = (f.get("out_key") or "").strip()
+        caption      = (f.get("caption") or body.get("caption") or "").strip()
+        params_str   = _params_str(f.get("params") if f.get("params") is not None else body.get("params"))
+        job_id, name = _batch_ids(site_url, request_id, idx)
+        in_key       = f"{IN_PREFIX.rstrip('/')}/{name}.{ext}"
+        plans.append({
+            "job_id": job_id if create_job else None,
+            "in_key": in_key, "out_key": out_key, "caption": caption,
+            "content_type": content_type, "params_str": params_str, "publish_at": publish_ats[idx],
+        })
+
+    # ジョブ作成（request_id 付きの再送なら作成済みは飛ばす）
+    created = 0
+    if create_job:
+        try:
+            existing = jobs.get_many([p["job_id"] for p in plans], fields=["job_id"]) if request_id else {}
+            new_jobs = [
+                _new_job(p["job_id"], now, site_url, ig_user_id, wp_id, p["caption"],
+                         token_cipher_b64, p["in_key"], p["out_key"], p["publish_at"])
+                for p in plans if p["job_id"] not in existing
+            ]
+            jobs.put_many(new_jobs)
+            created = len(new_jobs)
+        except Exception as e:
+            return _resp(500, {"error": f"ddb batch write failed: {e}"})
+
+    results = []
+    try:
+        for p in plans:
+            tagging_str = _build_tagging(p["out_key"]) if create_job else ""
+            metadata = _build_metadata(p["job_id"], p["params_str"], webhook_url, p["publish_at"])
+            r = _presign_put(p["in_key"], p["content_type"], metadata, tagging_str, expires)
+            if create_job:
+                r.update({"job_id": p["job_id"], "out_bucket": OUT_BUCKET, "out_key": p["out_key"] or None})
+            results.append(r)
+    except Exception as e:
+        return _resp(500, {"error": f"presign(put) failed: {e}"})
+
+    print(f"[PRESIGN] put_batch files={len(plans)} created={created} request_id={request_id or '-'}")
+    return _resp(200, {"request_id": request_id or None, "files": results,
+                       "created": created, "replayed": create_job and created < len(plans)})
+
+
+def _prepare_put(body, headers, site_url, webhook_url) -> dict:
+    """
+    op=put / op=multipart_init 共通: 入力検証・ジョブ作成・Metadata/Tagging の組み立て。
+    エラー時は _resp(...) をそのまま返す（"statusCode" の有無で判別）
+    """
     if not IN_BUCKET:
         return _resp(500, {"error":"IN_BUCKET not set"})
 
@@ -91,6 +271,10 @@ def lambda_handler(event, context):
     ig_user_id  = (body.get("ig_user_id") or "").strip()
     wp_id       = (body.get("wp_id") or "").strip()   # 空なら“アップロードのみ”モード
     caption     = (body.get("caption") or "").strip()
+    try:
+        publish_at = parse_publish_at(body.get("publish_at"))   # 予約投稿（変換が終わってもこの時刻まで投稿しない）
+    except (TypeError, ValueError):
+        return _resp(400, {"error": "publish_at must be epoch seconds or ISO 8601"})
 
     ext          = _sanitize_ext(body.get("ext") or "jpg")
     content_type = (body.get("type") or _choose_mime(ext)).strip()
@@ -98,114 +282,273 @@ def lambda_handler(event, context):
     expires      = _bound_expires(body.get("expires"))
     in_key       = f"{IN_PREFIX.rstrip('/')}/{uuid.uuid4()}.{ext}"
 
-    # 変換パラメータを文字列に
-    raw_params = body.get("params")
-    if isinstance(raw_params, (dict, list)):
-        params_str = json.dumps(raw_params, separators=(",", ":"), ensure_ascii=False)
-    elif isinstance(raw_params, str):
-        params_str = raw_params
-    else:
-        params_str = ""
+    params_str = _params_str(body.get("params"))
 
     create_job = bool(wp_id)  # True: IG 連携（DDB保存/変換投稿フロー起動）
 
     tagging_str = ""
-    metadata    = {}
     job_id      = None
 
     if create_job:
         if not KMS_KEY_ID:
             return _resp(500, {"error":"KMS_KEY_ID not set"})
 
-        # FBトークン暗号化
+        # FBトークン暗号化（キャッシュしたデータキーでローカル暗号化。KMS 往復は鍵の更新時だけ）
         try:
-            enc = kms.encrypt(KeyId=KMS_KEY_ID, Plaintext=fb_token.encode("utf-8"))
-            token_cipher_b64 = base64.b64encode(enc["CiphertextBlob"]).decode("ascii")
+            token_cipher_b64 = encrypt_token(fb_token, KMS_KEY_ID)
         except Exception as e:
             return _resp(500, {"error": f"kms encrypt failed: {e}"})
 
-        # ジョブ作成（GSI = wp_id-updated_at-index を使うため wp_id は非空前提）
         job_id = str(uuid.uuid4())
-        now    = int(time.time())
-        item = {
-            "job_id": job_id,
-            "platform": "ig",
-            "status": "pending",
-            "created_at": now,
-            "updated_at": now,
-            "site_url": site_url or "",
-            "ig_user_id": ig_user_id,
-            "wp_id": wp_id,
-            "caption": caption,
-            "token_cipher": token_cipher_b64,
-            "in_bucket": IN_BUCKET,
-            "in_key": in_key,
-            "out_bucket": OUT_BUCKET,
-            "out_key": out_key,
-        }
+        job = _new_job(job_id, int(time.time()), site_url, ig_user_id, wp_id, caption,
+                       token_cipher_b64, in_key, out_key, publish_at)
         try:
-            jobs.put_item(Item=item)
+            jobs.put(job)
         except Exception as e:
             return _resp(500, {"error": f"ddb put failed: {e}"})
 
-        # Tagging（変換/投稿の起動スイッチ）
-        tags = { "out_bucket": OUT_BUCKET, "out_key": out_key, "transcode": "true" }
-        tagging_str = urlencode(tags, quote_via=quote, safe="")
+        tagging_str = _build_tagging(out_key)
 
-        # Metadata（後段へ job-id/params/webhook を渡す）
-        metadata["job-id"] = job_id
-        if params_str:
-            try:
-                params_str.encode("ascii")
-                metadata["params"] = params_str
-            except Exception:
-                metadata["params-b64"] = base64.b64encode(params_str.encode("utf-8")).decode("ascii")
-        if webhook_url:
-            metadata["cb-b64"] = base64.b64encode(webhook_url.encode("utf-8")).decode("ascii")
+    # アップロードのみのときは DDB保存・変換起動なし（job-id / Tagging を付けない）
+    metadata = _build_metadata(job_id, params_str, webhook_url, publish_at)
 
-    else:
-        # アップロードのみ：DDB保存・変換起動なし
-        if params_str:
-            try:
-                params_str.encode("ascii")
-                metadata["params"] = params_str
-            except Exception:
-                metadata["params-b64"] = base64.b64encode(params_str.encode("utf-8")).decode("ascii")
-        if webhook_url:
-            metadata["cb-b64"] = base64.b64encode(webhook_url.encode("utf-8")).decode("ascii")
+    return {"in_key": in_key, "content_type": content_type, "metadata": metadata, "tagging": tagging_str,
+            "expires": expires, "job_id": job_id, "out_key": out_key}
 
-    # presign (PUT)
+# ===== マルチパート =====
+# S3 の制約: パートは 5 MiB 以上（最後を除く）・最大 10000 個
+MP_MIN_PART   = 5 * 1024 * 1024
+MP_PART_SIZE  = int(os.getenv("MULTIPART_PART_SIZE", str(16 * 1024 * 1024)))
+MP_MAX_PARTS  = 10000
+MP_URL_BATCH  = 100      # 1 回の multipart_parts で返す URL の上限
+MP_MAX_SIZE   = 5 * 1024 ** 4   # S3 オブジェクトの上限 5 TiB
+
+def _part_plan(size: int):
+    """ファイルサイズからパートサイズと個数を決める（10000 個に収まるよう MiB 単位で切り上げ）"""
+    part = max(MP_MIN_PART, MP_PART_SIZE)
+    if size > part * MP_MAX_PARTS:
+        mib = 1024 * 1024
+        part = -(-size // MP_MAX_PARTS // mib) * mib
+    return part, max(1, -(-size // part))
+
+def _mp_target(body):
+    """multipart_parts/complete/abort 共通の key / upload_id 検証。戻り値: (key, upload_id, error_resp)"""
+    key       = (body.get("key") or "").strip()
+    upload_id = (body.get("upload_id") or "").strip()
+    if not key or not upload_id:
+        return key, upload_id, _resp(400, {"error": "key and upload_id required"})
+    # 入力プレフィックス以外のキーには触らせない
+    if not IN_BUCKET or not key.startswith(IN_PREFIX):
+        return key, upload_id, _resp(403, {"error": "key not allowed"})
+    return key, upload_id, None
+
+def _list_parts(key, upload_id) -> list:
+    parts, marker = [], 0
+    while True:
+        r = s3.list_parts(Bucket=IN_BUCKET, Key=key, UploadId=upload_id, PartNumberMarker=marker)
+        parts += [{"part_number": p["PartNumber"], "etag": p["ETag"], "size": p["Size"]} for p in r.get("Parts", [])]
+        if not r.get("IsTruncated"):
+            return parts
+        marker = r["NextPartNumberMarker"]
+
+def _part_urls(key, upload_id, numbers, expires) -> list:
+    return [
+        {"part_number": n,
+         "url": s3.generate_presigned_url("upload_part",
+                                          Params={"Bucket": IN_BUCKET, "Key": key, "UploadId": upload_id, "PartNumber": n},
+                                          ExpiresIn=expires)}
+        for n in numbers
+    ]
+
+def _multipart_init(body, headers, site_url, webhook_url) -> dict:
+    """
+    { "op":"multipart_init", "size": <bytes>, ...op=put と同じ項目 }
+    Metadata / Tagging は CreateMultipartUpload に付けるので、完成したオブジェクトは単発 PUT と同じになる
+    （ObjectCreated:CompleteMultipartUpload で convert-worker が同じように起動する）
+    """
     try:
-        params = {
-            "Bucket": IN_BUCKET,
-            "Key": in_key,
-            "ContentType": content_type,
-            "Metadata": metadata or {},
-        }
-        if tagging_str:
-            params["Tagging"] = tagging_str
-
-        put_url = s3.generate_presigned_url("put_object", Params=params, ExpiresIn=expires)
-    except Exception as e:
-        return _resp(500, {"error": f"presign(put) failed: {e}"})
+        size = int(body.get("size") or 0)
+    except (TypeError, ValueError):
+        return _resp(400, {"error": "size must be an integer"})
+    if size <= 0:
+        return _resp(400, {"error": "size required"})
+    if size > MP_MAX_SIZE:
+        return _resp(400, {"error": "file too large"})
+    part_size, part_count = _part_plan(size)
 
-    required_headers = {"Content-Type": content_type}
-    if tagging_str:
-        required_headers["x-amz-tagging"] = tagging_str
-    for mk, mv in (metadata or {}).items():
-        required_headers[f"x-amz-meta-{mk}"] = mv
+    # サイズ検証の後でジョブを作る
+    prep = _prepare_put(body, headers, site_url, webhook_url)
+    if "statusCode" in prep:
+        return prep
 
+    params = {"Bucket": IN_BUCKET, "Key": prep["in_key"], "ContentType": prep["content_type"],
+              "Metadata": prep["metadata"] or {}}
+    if prep["tagging"]:
+        params["Tagging"] = prep["tagging"]
+    try:
+        upload_id = s3.create_multipart_upload(**params)["UploadId"]
+        first = _part_urls(prep["in_key"], upload_id, range(1, min(part_count, MP_URL_BATCH) + 1), prep["expires"])
+    except Exception as e:
+        return _resp(500, {"error": f"multipart init failed: {e}"})
+
+    print(f"[PRESIGN] multipart_init key={prep['in_key']} size={size} parts={part_count} part_size={part_size}")
     resp = {
         "bucket": IN_BUCKET,
-        "key": in_key,
-        "put_url": put_url,
-        "required_headers": required_headers,
-        "x_amz_meta": metadata,
-        "x_amz_tagging": tagging_str or None,
-        "content_type": content_type,
-        "expires_in": expires,
+        "key": prep["in_key"],
+        "upload_id": upload_id,
+        "part_size": part_size,
+        "part_count": part_count,
+        "parts": first,
+        "content_type": prep["content_type"],
+        "x_amz_meta": prep["metadata"],
+        "x_amz_tagging": prep["tagging"] or None,
+        "expires_in": prep["expires"],
     }
+    if prep["job_id"]:
+        resp.update({"job_id": prep["job_id"], "out_bucket": OUT_BUCKET, "out_key": prep["out_key"] or None})
+    return _resp(200, resp)
+
+def _is_int(v) -> bool:
+    return isinstance(v, int) and not isinstance(v, bool)
+
+def _multipart_parts(body) -> dict:
+    """
+    { "op":"multipart_parts", "key", "upload_id", "part_numbers":[..] | "start":n, "count":m, "expires" }
+    パート URL の追加発行。"resume": true なら S3 に届いているパートも返す（再開時に送り直さない）
+    """
+    key, upload_id, err = _mp_target(body)
+    if err:
+        return err
+    expires = _bound_expires(body.get("expires"))
+    if body.get("part_numbers") is not None:
+        # 整数の配列だけ受け付ける（文字列は 1 文字ずつ、bool / 小数は int() で別の番号に化けるため）
+        if not isinstance(body["part_numbers"], list) or not all(_is_int(n) for n in body["part_numbers"]):
+            return _resp(400, {"error": "part_numbers must be a list of integers"})
+        numbers = sorted(set(body["part_numbers"]))
+    else:
+        try:
+            start = int(body.get("start") or 1)
+            numbers = list(range(start, start + int(body.get("count") or MP_URL_BATCH)))
+        except (TypeError, ValueError):
+            return _resp(400, {"error": "invalid part numbers"})
+    if not numbers or numbers[0] < 1 or numbers[-1] > MP_MAX_PARTS or len(numbers) > MP_URL_BATCH:
+        return _resp(400, {"error": f"part numbers must be 1..{MP_MAX_PARTS}, at most {MP_URL_BATCH} per call"})
+
+    try:
+        resp = {"key": key, "upload_id": upload_id, "expires_in": expires,
+                "parts": _part_urls(key, upload_id, numbers, expires)}
+        if body.get("resume"):
+            resp["uploaded"] = _list_parts(key, upload_id)
+    except Exception as e:
+        return _resp(500, {"error": f"presign(upload_part) failed: {e}"})
+    return _resp(200, resp)
+
+def _multipart_complete(body) -> dict:
+    """
+    { "op":"multipart_complete", "key", "upload_id", "parts":[{"part_number","etag"}...] }
+    parts を省略したら S3 に届いている全パートで完了する
+    """
+    key, upload_id, err = _mp_target(body)
+    if err:
+        return err
+    try:
+        if body.get("parts"):
+            parts = [{"PartNumber": int(p["part_number"]), "ETag": p["etag"]} for p in body["parts"]]
+        else:
+            parts = [{"PartNumber": p["part_number"], "ETag": p["etag"]} for p in _list_parts(key, upload_id)]
+    except (KeyError, TypeError, ValueError):
+        return _resp(400, {"error": "parts must be [{part_number, etag}]"})
+    except Exception as e:
+        return _resp(500, {"error": f"list parts failed: {e}"})
+    if not parts:
+        return _resp(400, {"error": "no parts uploaded"})
+    parts.sort(key=lambda p: p["PartNumber"])
+
+    try:
+        r = s3.complete_multipart_upload(Bucket=IN_BUCKET, Key=key, UploadId=upload_id,
+                                         MultipartUpload={"Parts": parts})
+    except Exception as e:
+        return _resp(500, {"error": f"multipart complete failed: {e}"})
+    print(f"[PRESIGN] multipart_complete key={key} parts={len(parts)}")
+    return _resp(200, {"bucket": IN_BUCKET, "key": key, "etag": r.get("ETag"), "parts": len(parts)})
+
+def _multipart_abort(body) -> dict:
+    """
+    { "op":"multipart_abort", "key", "upload_id", "job_id"? }
+    アップロード済みパートを破棄し、job_id があれば未処理のジョブをエラーにする
+    """
+    key, upload_id, err = _mp_target(body)
+    if err:
+        return err
+    try:
+        s3.abort_multipart_upload(Bucket=IN_BUCKET, Key=key, UploadId=upload_id)
+    except Exception as e:
+        return _resp(500, {"error": f"multipart abort failed: {e}"})
+
+    job_id = (body.get("job_id") or "").strip()
     if job_id:
-        resp.update({"job_id": job_id, "out_bucket": OUT_BUCKET, "out_key": out_key or None})
+        try:
+            jobs.update(job_id, set={"status": "ERROR,upload aborted", "updated_at": int(time.time())},
+                        add={"rev": 1}, expect={"status": "pending", "in_key": key})
+        except Exception as e:
+            print(f"[PRESIGN] abort: job update failed job_id={job_id}: {e}")
+    print(f"[PRESIGN] multipart_abort key={key}")
+    return _resp(200, {"key": key, "upload_id": upload_id, "aborted": True})
+
+def lambda_handler(event, context):
+    headers = { (k or "").lower(): v for k, v in (event.get("headers") or {}).items() }
+    body_raw = event.get("body") or "{}"
+    body     = json.loads(body_raw) if isinstance(body_raw, str) else (body_raw or {})
+
+    # 共通
+    op = (body.get("op") or "put").lower()
+    site_url    = (headers.get("x-site-url") or body.get("site_url") or "").strip()
+    webhook_url = (headers.get("x-webhook-url") or "").strip()
+
+    # ===== op=get: 署名付き GET URL を返す =====
+    if op == "get":
+        # 例: { "op":"get", "bucket": "...", "key": "...", "expires": 600 }
+        bucket  = (body.get("bucket") or IN_BUCKET or "").strip()
+        key     = (body.get("key") or "").strip()
+        expires = _bound_expires(body.get("expires"))
+
+        try:
+            return _resp(200, _presign_get(bucket, key, expires))
+        except ValueError as e:
+            return _resp(400, {"error": str(e)})
+        except PermissionError as e:
+            return _resp(403, {"error": str(e)})
+        except Exception as e:
+            return _resp(500, {"error": f"presign(get) failed: {e}"})
+
+    # ===== 複数ファイル =====
+    if op == "get_batch":
+        return _get_batch(body)
+    if op == "put_batch":
+        return _put_batch(body, headers, site_url, webhook_url)
+
+    # ===== マルチパート（大きな動画を分割・並行・再開可能にアップロード） =====
+    if op == "multipart_init":
+        return _multipart_init(body, headers, site_url, webhook_url)
+    if op == "multipart_parts":
+        return _multipart_parts(body)
+    if op == "multipart_complete":
+        return _multipart_complete(body)
+    if op == "multipart_abort":
+        return _multipart_abort(body)
+
+    # ===== ここから op=put =====
+    prep = _prepare_put(body, headers, site_url, webhook_url)
+    if "statusCode" in prep:
+        return prep
+
+    # presign (PUT)
+    try:
+        resp = _presign_put(prep["in_key"], prep["content_type"], prep["metadata"], prep["tagging"], prep["expires"])
+    except Exception as e:
+        return _resp(500, {"error": f"presign(put) failed: {e}"})
+
+    if prep["job_id"]:
+        resp.update({"job_id": prep["job_id"], "out_bucket": OUT_BUCKET, "out_key": prep["out_key"] or None})
 
     return _resp(200, resp)
@@ -0,0 +1,346 @@
+# lambda_publish_scheduler.py
+# 予約投稿（publish_at 付きのジョブ）を時刻が来たら少しずつステートマシンへ流す（EventBridge で 1 分ごとに起動）
+#  - 受け付け: lambda_start（X）/ lambda_convert_notifier（IG、変換が終わった後）が publish_at の先のジョブを
+#    job_store.enqueue() で publish_queues（プラットフォーム × アカウントの待ち行列）に積み、
+#    ジョブには sched_queue / publish_at を付ける。convert_jobs の GSI（sched_queue-publish_at-index）で
+#    アカウントごとに期限の早い順に読める（sched_queue は取り出すと消すので、GSI には予約中のジョブだけ載る）
+#  - 流す量: プラットフォームごとに実行中（RUNNING）の実行数が SCHED_MAX_INFLIGHT_* を超えない分だけ。
+#    1 回の起動で SCHED_BATCH 件まで、1 アカウントから SCHED_MAX_PER_QUEUE 件まで
+#  - 公平性: 空き枠はプラットフォームを交互に、その中ではアカウントを 1 件ずつ巡回して配る（plan()）。
+#    忙しいサイトが何千件積んでいても、他のサイトは 1 巡ごとに 1 件ずつ出ていく
+#  - 取り出しはリース: released_at を条件付きで入れてから起動し、起動できたら sched_queue を消す。
+#    起動の前後で落ちても sched_queue が残るので、RELEASE_LEASE_SEC 後の起動がやり直す。
+#    実行名は job_id なので、やり直しても同じジョブを二重に起動しない
+#  - X の予約で自社バケットの素材（media_objects）があれば、起動時に media_urls を署名し直す
+#  - simulate(): 合成負荷で公平配分と先着順（publish_at の早い順）を比べる（ローカル検証用）
+import os, json, time, random, heapq, bisect
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from job_store import store, PublishQueue, QUEUES_TABLE, DUE_INDEX, dequeue
+
+REGION        = os.getenv("AWS_REGION", "ap-northeast-1")
+JOBS_TABLE    = os.getenv("JOBS_TABLE", "convert_jobs")
+SF_ARNS       = {"x": os.getenv("SF_X_ARN"), "ig": os.getenv("SF_IG_POST_ARN")}
+MAX_INFLIGHT  = {"x": int(os.getenv("SCHED_MAX_INFLIGHT_X", "40")), "ig": int(os.getenv("SCHED_MAX_INFLIGHT_IG", "50"))}
+BATCH         = int(os.getenv("SCHED_BATCH", "200"))              # 1 回の起動で流す上限
+PER_QUEUE_MAX = int(os.getenv("SCHED_MAX_PER_QUEUE", "50"))       # 1 回の起動で 1 アカウントから流す上限
+IDLE_RECHECK_SEC = int(os.getenv("SCHED_IDLE_RECHECK_SEC", "900"))  # pending が残るのに何も読めなかった待ち行列を見直す間隔
+GET_EXPIRES   = int(os.getenv("GET_EXPIRES", "3600"))             # IG / X に渡す署名付き URL の有効期限
+RELEASE_LEASE_SEC = int(os.getenv("SCHED_RELEASE_LEASE_SEC", "180"))  # 取り出し中に落ちたジョブをやり直すまで（Timeout より長く）
+START_CONCURRENCY = int(os.getenv("SCHED_START_CONCURRENCY", "8"))
+
+jobs   = store(JOBS_TABLE)
+queues = store(QUEUES_TABLE, PublishQueue)
+sf = boto3.client("stepfunctions", region_name=REGION)
+s3 = boto3.client("s3", region_name=REGION)
+
+
+# ===== 配分 =====
+def _turns(qs, per_queue):
+    """1 巡ごとに、まだ残りのある待ち行列のキーを 1 回ずつ"""
+    for r in range(per_queue):
+        live = [q["queue_key"] for q in qs if int(q.get("pending") or 0) > r]
+        if not live:
+            return
+        yield from live
+
+
+def plan(due_queues, slots: dict, batch: int = BATCH, per_queue: int = PER_QUEUE_MAX) -> dict:
+    """
+    空き枠の配り方。
+      due_queues: [{"queue_key", "platform", "next_at", "pending"}]（next_at が来たもの）
+      slots     : {platform: 空き数}
+    戻り値: {queue_key: 流す件数}
+      - プラットフォームを交互に 1 件ずつ（片方に何千件たまっていても、もう片方の枠は削られない）
+      - プラットフォーム内ではアカウントを next_at の古い順に 1 件ずつ巡回（1 巡で 1 アカウント 1 件）
+    """
+    order = {}
+    for q in sorted(due_queues, key=lambda q: (q["next_at"], q["queue_key"])):
+        order.setdefault(q["platform"], []).append(q)
+    turns = {p: _turns(qs, per_queue) for p, qs in order.items()}
+    left = {p: int(slots.get(p, 0)) for p in order}
+    active = [p for p in sorted(order) if left[p] > 0]
+    alloc = {}
+    while batch > 0 and active:
+        for p in list(active):
+            qk = next(turns[p], None)
+            if qk is None:
+                active.remove(p)
+                continue
+            alloc[qk] = alloc.get(qk, 0) + 1
+            left[p] -= 1
+            batch -= 1
+            if left[p] <= 0:
+                active.remove(p)
+            if batch <= 0:
+                break
+    return alloc
+
+
+# ===== 起動 =====
+def _running(arn: str, cap: int) -> int:
+    """実行中の数（cap まで数えたら打ち切る）"""
+    n, kwargs = 0, {"stateMachineArn": arn, "statusFilter": "RUNNING", "maxResults": 1000}
+    while n < cap:
+        r = sf.list_executions(**kwargs)
+        n += len(r.get("executions", []))
+        if not r.get("nextToken"):
+            break
+        kwargs["nextToken"] = r["nextToken"]
+    return n
+
+
+def _plain(v):
+    if isinstance(v, Decimal):
+        return int(v) if v == v.to_integral_value() else float(v)
+    raise TypeError(type(v).__name__)
+
+
+def _media_urls(job) -> list:
+    """X: 自社バケットの素材は署名し直した URL に差し替える（受け付け時の URL は publish_at には期限切れ）"""
+    urls = list(job.media_urls or [])
+    for i, o in enumerate(job.media_objects or []):
+        if o and i < len(urls):
+            urls[i] = s3.generate_presigned_url("get_object", Params={"Bucket": o["bucket"], "Key": o["key"]},
+                                                ExpiresIn=GET_EXPIRES)
+    return urls
+
+
+def _start(platform: str, job):
+    """ステートマシンの入力は即時起動のとき（lambda_start / lambda_convert_notifier）と同じ形"""
+    if platform == "ig":
+        url = s3.generate_presigned_url("get_object", Params={"Bucket": job.out_bucket, "Key": job.out_key},
+                                        ExpiresIn=GET_EXPIRES)
+        sf_input = {"job_id": job.job_id, "video_url": url, "bucket": job.out_bucket, "key": job.out_key,
+                    "object": job.get("sched_object") or {}}
+    else:
+        sf_input = {"job_id": job.job_id}
+    try:
+        sf.start_execution(stateMachineArn=SF_ARNS[platform], name=job.job_id,
+                           input=json.dumps(sf_input, ensure_ascii=False, default=_plain))
+    except sf.exceptions.ExecutionAlreadyExists:
+        print(f"[SCHED] already started job_id={job.job_id}")
+
+
+def _release(q: PublishQueue, n: int, now: int) -> dict:
+    """
+    1 つの待ち行列から期限の来たジョブを n 件まで起動し、待ち行列の pending / next_at を進める。
+    戻り値: {"queue_key", "started", "next_at"（書けた next_at。enqueue と競合したら None）, "more"（まだ期限の来たジョブが残っている）}
+    """
+    qk = q.queue_key
+    head = jobs.query(DUE_INDEX, "sched_queue", qk, "publish_at", limit=n + 1, fields=["publish_at"])
+    ready = [it for it in head if it.publish_at <= now][:n]
+    full = jobs.get_many([it.job_id for it in ready]) if ready else {}
+
+    started, retry_at, lease_until = 0, None, None
+    for it in ready:
+        job = full.get(it.job_id)
+        # GSI の反映遅れで、別の起動がもう取り出したジョブが見えることがある
+        if job is None or job.sched_queue != qk:
+            continue
+        # リースを取る（他の起動が取り出し中なら飛ばす。期限切れのリースは取り直す）
+        lease = job.get("released_at")
+        if lease is not None and int(lease) > now - RELEASE_LEASE_SEC:
+            lease_until = min(lease_until or 2 ** 62, int(lease) + RELEASE_LEASE_SEC)
+            continue
+        claim = {"released_at": now}
+        if job.media_objects:
+            claim["media_urls"] = _media_urls(job)   # get_job（ステートマシンの最初の段）がここから読む
+        if lease is None:
+            ok = jobs.update(job.job_id, set=claim, if_missing=("released_at",), expect={"sched_queue": qk})
+        else:
+            print(f"[SCHED] lease expired job_id={job.job_id} released_at={lease}; retry")
+            ok = jobs.update(job.job_id, set=claim, expect={"sched_queue": qk, "released_at": lease})
+        if not ok:
+            continue
+        try:
+            _start(q.platform, job)
+        except Exception as e:
+            print(f"ERROR start_execution job_id={job.job_id}: {e}")
+            jobs.update(job.job_id, remove=("released_at",), expect={"released_at": now})
+            retry_at = it.publish_at
+            break
+        # 起動できたので待ち行列の GSI から外す（ここで落ちてもリース切れ後のやり直しは ExecutionAlreadyExists で終わる）
+        jobs.update(job.job_id, remove=("sched_queue",), expect={"released_at": now})
+        started += 1
+
+    # 次に見る時刻: 失敗したジョブ > 読んだ分の次のジョブ > （読み切ったのに pending が残るなら）少し後
+    # 取り出し中のまま止まったジョブがあれば、リースが切れる時刻より後にはしない
+    if retry_at is not None:
+        next_at = retry_at
+    elif len(head) > len(ready):
+        next_at = head[len(ready)].publish_at
+    else:
+        next_at = None
+    if lease_until is not None:
+        next_at = lease_until if next_at is None else min(next_at, lease_until)
+    pending = int(dequeue(qk, started)["pending"]) if started else q.pending
+    if next_at is None and pending > 0:
+        next_at = now + IDLE_RECHECK_SEC
+    # 取り出している間に enqueue が next_at を早めていたら、そちらを残す
+    if next_at is None:
+        written = queues.update(qk, remove=("next_at",), expect={"next_at": q.next_at, "pending": pending})
+    else:
+        written = queues.update(qk, set={"next_at": next_at}, expect={"next_at": q.next_at})
+    next_at = next_at if written else None
+    return {"queue_key": qk, "started": started, "next_at": next_at, "more": next_at is not None and next_at <= now}
+
+
+def tick(now=None, dry_run=False) -> dict:
+    t0 = time.time()
+    now = int(now if now is not None else t0)
+    due = {q.queue_key: q for q in queues.scan()
+           if q.next_at is not None and q.next_at <= now and SF_ARNS.get(q.platform)}
+    n_due = len(due)
+    slots = {p: max(0, MAX_INFLIGHT[p] - _running(arn, MAX_INFLIGHT[p])) for p, arn in SF_ARNS.items() if arn}
+    batch = BATCH
+    done = {}
+    results = []
+
+    # 待ち行列の pending は予約の総数（まだ先のものも含む）なので、割り当てより少ししか出なかった枠は 2 巡目で配り直す
+    with ThreadPoolExecutor(max_workers=START_CONCURRENCY) as pool:
+        for _ in range(2):
+            cands = [{"queue_key": qk, "platform": q.platform, "next_at": q.next_at,
+                      "pending": max(1, min(q.pending, PER_QUEUE_MAX) - done.get(qk, 0))}
+                     for qk, q in due.items() if done.get(qk, 0) < PER_QUEUE_MAX]
+            alloc = plan(cands, slots, batch, PER_QUEUE_MAX)
+            if dry_run or not alloc:
+                break
+            res = list(pool.map(lambda kv: _release(due[kv[0]], kv[1], now), alloc.items()))
+            results += res
+            for r in res:
+                p = due[r["queue_key"]].platform
+                slots[p] -= r["started"]
+                batch -= r["started"]
+                done[r["queue_key"]] = done.get(r["queue_key"], 0) + r["started"]
+            # 次の巡では、まだ期限の来たジョブが残っている待ち行列だけ（next_at は今書いた値）
+            due = {r["queue_key"]: due[r["queue_key"]] for r in res if r["more"]}
+            for r in res:
+                if r["more"]:
+                    due[r["queue_key"]].next_at = r["next_at"]
+            if batch <= 0 or not due or not any(v > 0 for v in slots.values()):
+                break
+
+    started = sum(r["started"] for r in results)
+    out = {"due_queues": n_due, "slots": slots, "started": started,
+           "accounts": sum(1 for v in done.values() if v), "elapsed_ms": int((time.time() - t0) * 1000)}
+    if dry_run:
+        out["plan"] = alloc
+    print(f"[SCHED] due_queues={n_due} started={started} accounts={out['accounts']} slots_left={slots} elapsed={out['elapsed_ms']}ms")
+    return out
+
+
+def lambda_handler(event, context):
+    """EventBridge（rate(1 minute)）から起動。{"dry_run": true} なら配分だけ計算して返す"""
+    return tick(dry_run=bool((event or {}).get("dry_run")))
+
+
+# ===== ローカル検証 =====
+def _pct(xs, q):
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(q * len(xs)))], 1)
+
+
+def simulate(n_jobs=10000, accounts=500, *, fair=True, hours=3, spikes=(0, 3600, 7200), spike_share=0.5,
+             ig_share=0.3, zipf=1.2, tick_sec=60, max_inflight=None, batch=BATCH, per_queue=PER_QUEUE_MAX,
+             x_exec_sec=20, ig_exec_sec=120, seed=1) -> dict:
+    """
+    仮想時計で予約投稿を流す。アカウントの件数は Zipf 分布（account 0 がいちばん忙しいサイト）。
+    半分は毎時ちょうどの前後に集中し（いちばん忙しいサイトはちょうどの時刻にまとめて、他は 2 分以内にばらけて）、
+    残りは hours の間に一様。実行時間は X が x_exec_sec、IG が ig_exec_sec の ±50%。
+      fair=True : plan() で配る（この関数と同じ）
+      fair=False: publish_at の早い順（先着順）に、同じ実行数の上限・batch で流す
+    戻り値: スループット（件/分）、待ち時間（起動 - publish_at、秒）の分位点、最大実行数。
+      待ち時間はサイトの大きさで分けても返す: busiest（account 0）/ top10（1〜9）/ small（予約が 20 件未満のサイト）
+    """
+    rnd = random.Random(seed)
+    caps = dict(max_inflight or MAX_INFLIGHT)
+    weights = [1 / (i + 1) ** zipf for i in range(accounts)]
+    load = []
+    for seq, a in enumerate(rnd.choices(range(accounts), weights, k=n_jobs)):
+        p = "ig" if rnd.random() < ig_share else "x"
+        if rnd.random() < spike_share:
+            t = rnd.choice(spikes) + (0.0 if a == 0 else rnd.uniform(0, 120))
+        else:
+            t = rnd.uniform(0, hours * 3600)
+        load.append((t, seq, p, a))
+    load.sort()
+
+    # 待ち行列: (platform, account) ごとの publish_at（昇順）と、取り出し済みの位置
+    per_q = {}
+    for t, seq, p, a in load:
+        per_q.setdefault((p, a), []).append(t)
+    pos = {k: 0 for k in per_q}
+    fifo = {p: [(t, seq, a) for t, seq, pp, a in load if pp == p] for p in caps}
+    fifo_pos = {p: 0 for p in caps}
+
+    running = {p: [] for p in caps}      # 終了時刻のヒープ
+    by_account = {}
+    max_running = {p: 0 for p in caps}
+    busy_ticks = busy_started = 0
+    now, released = 0.0, 0
+    while released < n_jobs:
+        for p in caps:
+            while running[p] and running[p][0] <= now:
+                heapq.heappop(running[p])
+        slots = {p: caps[p] - len(running[p]) for p in caps}
+        picked = []                      # (platform, account, publish_at)
+        if fair:
+            due = []
+            for (p, a), ts in per_q.items():
+                i = pos[(p, a)]
+                if i < len(ts) and ts[i] <= now:
+                    due.append({"queue_key": (p, a), "platform": p, "next_at": ts[i],
+                                "pending": bisect.bisect_right(ts, now) - i})
+            for (p, a), k in plan(due, slots, batch, per_queue).items():
+                i = pos[(p, a)]
+                picked += [(p, a, t) for t in per_q[(p, a)][i:i + k]]
+                pos[(p, a)] = i + k
+            backlog = sum(d["pending"] for d in due) > len(picked)
+        else:
+            taken = {p: 0 for p in caps}
+            while len(picked) < batch:
+                heads = [(fifo[p][fifo_pos[p]][0], p) for p in caps
+                         if taken[p] < slots[p] and fifo_pos[p] < len(fifo[p]) and fifo[p][fifo_pos[p]][0] <= now]
+                if not heads:
+                    break
+                t, p = min(heads)
+                picked.append((p, fifo[p][fifo_pos[p]][2], t))
+                fifo_pos[p] += 1
+                taken[p] += 1
+            backlog = any(fifo_pos[p] < len(fifo[p]) and fifo[p][fifo_pos[p]][0] <= now for p in caps)
+
+        for p, a, t in picked:
+            by_account.setdefault(a, []).append(now - t)
+            mean = x_exec_sec if p == "x" else ig_exec_sec
+            heapq.heappush(running[p], now + mean * rnd.uniform(0.5, 1.5))
+        for p in caps:
+            max_running[p] = max(max_running[p], len(running[p]))
+        released += len(picked)
+        if backlog:
+            busy_ticks += 1
+            busy_started += len(picked)
+        now += tick_sec
+
+    span_min = max(1.0, (now - load[0][0]) / 60)
+    groups = {
+        "all": [d for ds in by_account.values() for d in ds],
+        "busiest": by_account.get(0, []),
+        "top10": [d for a, ds in by_account.items() if 1 <= a < 10 for d in ds],
+        "small": [d for a, ds in by_account.items() if len(ds) < 20 for d in ds],
+    }
+    out = {
+        "mode": "fair" if fair else "fifo",
+        "jobs": n_jobs, "accounts": len(by_account),
+        "busiest_account_jobs": len(groups["busiest"]),
+        "small_accounts": sum(1 for ds in by_account.values() if len(ds) < 20),
+        "throughput_per_min": round(released / span_min, 1),
+        "backlog_throughput_per_min": round(busy_started / max(1, busy_ticks) * 60 / tick_sec, 1),
+        "max_running": max_running,
+    }
+    for g, ds in groups.items():
+        out[f"{g}_p50"], out[f"{g}_p95"], out[f"{g}_max"] = _pct(ds, 0.5), _pct(ds, 0.95), _pct(ds, 1.0)
+    return out
@@ -1,18 +1,36 @@
 
-import os, json, uuid, base64, time, boto3
+import os, re, json, uuid, time, urllib.parse, boto3
 from botocore.client import Config
+from token_cipher import encrypt_token
+from job_store import Job, store, enqueue, parse_publish_at
 
 REGION     = os.getenv("REGION", "ap-northeast-1")
 JOBS_TABLE = os.getenv("JOBS_TABLE", "convert_jobs")
 KMS_KEY_ID = os.getenv("KMS_KEY_ID")
 STATE_MACHINE_ARN = os.getenv("STATE_MACHINE_ARN")
+SCHEDULE_MIN_LEAD_SEC = int(os.getenv("SCHEDULE_MIN_LEAD_SEC", "60"))  # publish_at がこれより近ければ予約せずすぐ起動
+# 予約投稿で media_urls がこのバケットの署名付き URL なら bucket/key も保存し、起動時に署名し直す（期限切れ対策）
+OWN_BUCKETS = {b.strip() for b in (os.getenv("OWN_BUCKETS") or "").split(",") if b.strip()}
 
-ddb = boto3.resource("dynamodb", region_name=REGION).Table(JOBS_TABLE)
-kms = boto3.client("kms", region_name=REGION)
+jobs = store(JOBS_TABLE)
 sf = boto3.client("stepfunctions")
 
 def _resp(c,b): return {"statusCode":c,"headers":{"Content-Type":"application/json"},"body":json.dumps(b,ensure_ascii=False)}
 
+def _s3_object(url):
+    """自社バケットの URL なら {"bucket", "key"}（virtual-hosted / path 形式の両対応）、それ以外は None"""
+    p = urllib.parse.urlparse(url or "")
+    host = p.netloc.split(":")[0].lower()
+    path = urllib.parse.unquote(p.path.lstrip("/"))
+    m = re.match(r"^(.+)\.s3[.-]([a-z0-9-]+\.)?amazonaws\.com$", host)
+    if m:
+        bucket, key = m.group(1), path
+    elif re.match(r"^s3[.-]([a-z0-9-]+\.)?amazonaws\.com$", host) and "/" in path:
+        bucket, key = path.split("/", 1)
+    else:
+        return None
+    return {"bucket": bucket, "key": key} if bucket in OWN_BUCKETS and key else None
+
 def lambda_handler(event, ctx):
     headers = {(k or "").lower(): v for k,v in (event.get("headers") or {}).items()}
     body = event.get("body") or "{}"
@@ -27,34 +45,47 @@ def lambda_handler(event, ctx):
     if not KMS_KEY_ID: return _resp(500, {"error":"KMS_KEY_ID not set"})
     if not wp_id:      return _resp(400, {"error":"wp_id required"})
     if not x_token:    return _resp(401, {"error":"missing X-X-Token"})
+    try:
+        publish_at = parse_publish_at(body.get("publish_at"))
+    except (TypeError, ValueError):
+        return _resp(400, {"error": "publish_at must be epoch seconds or ISO 8601"})
 
     # 1) アクセストークンを即暗号化（保存は常に暗号化体のみ）
     try:
-        enc = kms.encrypt(KeyId=KMS_KEY_ID, Plaintext=x_token.encode("utf-8"))
-        token_cipher_b64 = base64.b64encode(enc["CiphertextBlob"]).decode("ascii")
+        token_cipher_b64 = encrypt_token(x_token, KMS_KEY_ID)
     except Exception as e:
         return _resp(500, {"error": f"kms encrypt failed: {e}"})
 
     # 2) ジョブ作成
     job_id = str(uuid.uuid4())
     now    = int(time.time())
-    item = {
-        "job_id": job_id,
-        "platform": "X",
-        "status": "pending",
-        "created_at": now,
-        "updated_at": now,
-        "wp_id": wp_id,
-        "text": text,
-        "media_urls": media_urls,     # 最初の Lambda が S3 へ取り込み
-        "token_cipher": token_cipher_b64,  # ← 平文は保存しない
-        "site_url": site_url
-    }
-    print(f"item: {item}")
+    scheduled = publish_at is not None and publish_at > now + SCHEDULE_MIN_LEAD_SEC
+    job = Job(
+        job_id=job_id,
+        platform="X",
+        status="scheduled" if scheduled else "pending",
+        created_at=now,
+        updated_at=now,
+        wp_id=wp_id,
+        text=text,
+        media_urls=media_urls,          # 最初の Lambda が S3 へ取り込み
+        token_cipher=token_cipher_b64,  # ← 平文は保存しない
+        site_url=site_url,
+        publish_at=publish_at
+    )
+    print(f"item: {job}")
     try:
-        ddb.put_item(Item=item)
+        if scheduled:
+            # 予約投稿: 待ち行列に積むだけ（時刻が来たら lambda_publish_scheduler が起動する）
+            objects = [_s3_object(u) for u in media_urls]
+            if any(objects):
+                job.media_objects = objects
+            job.sched_queue = enqueue("x", site_url, publish_at)
+        jobs.put(job)
     except Exception as e:
         return _resp(500, {"error": f"ddb put failed: {e}"})
+    if scheduled:
+        return _resp(200, {"ok": True, "job_id": job_id, "scheduled": True, "publish_at": publish_at})
 
     # 3) Step Functions をここで起動
     sf.start_execution(
@@ -0,0 +1,102 @@
+# token_cipher.py
+# アクセストークンの暗号化/復号（エンベロープ暗号化。レイヤで配布）
+#  - KMS GenerateDataKey で作ったデータキーをモジュールスコープにキャッシュし、トークンは AES-GCM でローカル暗号化
+#    （キャッシュは最大経過秒・最大使用回数で更新。ウォームスタート間で KMS 往復を省く）
+#  - 復号側もラップ済みデータキー → 平文キーをキャッシュするので、同じキーで暗号化されたトークンは KMS を呼ばない
+#  - 暗号化体: "env1:" + base64(ラップ済みデータキー) + ":" + base64(nonce + 暗号文 + tag)
+#    "env1:" で始まらないものは従来の kms.encrypt の CiphertextBlob（base64）として kms.decrypt で復号する
+#  - cryptography はレイヤに同梱する（各 token-cipher/requirements.txt、レイヤは BuildMethod: python3.11 でビルド）。
+#    無ければコールドスタートで ImportError にする（黙って kms.encrypt に戻ると KMS の呼び出しが件数分に増える）
+import os, time, base64, threading
+import boto3
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError as e:
+    raise ImportError("token_cipher: cryptography is not bundled in the token-cipher layer "
+                      "(requirements.txt + BuildMethod: python3.11)") from e
+
+REGION        = os.getenv("REGION") or os.getenv("AWS_REGION", "ap-northeast-1")
+KMS_KEY_ID    = os.getenv("KMS_KEY_ID")
+KEY_MAX_AGE   = float(os.getenv("TOKEN_KEY_MAX_AGE", "300"))     # データキーを使い続ける最大秒数
+KEY_MAX_USES  = int(os.getenv("TOKEN_KEY_MAX_USES", "1000"))     # 1 つのデータキーで暗号化する最大件数
+DECRYPT_CACHE = int(os.getenv("TOKEN_DECRYPT_CACHE", "32"))      # 保持する復号済みデータキーの数
+PREFIX        = "env1:"
+_AAD          = b"token_cipher/env1"
+
+_kms = None
+_lock = threading.Lock()
+_enc_key = None        # {"plain", "wrapped", "created", "uses", "key_id"}
+_dec_keys = {}         # wrapped(bytes) -> (plain, created)   挿入順 = 古い順
+stats = {"generate_data_key": 0, "kms_decrypt": 0, "local_encrypt": 0, "local_decrypt": 0}
+
+
+def _client():
+    global _kms
+    if _kms is None:
+        _kms = boto3.client("kms", region_name=REGION)
+    return _kms
+
+
+def _b64(b: bytes) -> str:
+    return base64.b64encode(b).decode("ascii")
+
+
+def _data_key(key_id: str):
+    """暗号化用データキー（期限切れ・使用回数超過・キー ID 変更なら作り直す）"""
+    global _enc_key
+    now = time.time()
+    with _lock:
+        k = _enc_key
+        if (k is None or k["key_id"] != key_id or now - k["created"] > KEY_MAX_AGE
+                or k["uses"] >= KEY_MAX_USES):
+            r = _client().generate_data_key(KeyId=key_id, KeySpec="AES_256")
+            stats["generate_data_key"] += 1
+            k = _enc_key = {"plain": r["Plaintext"], "wrapped": r["CiphertextBlob"],
+                            "created": now, "uses": 0, "key_id": key_id}
+            print(f"[TOKEN] new data key key_id={key_id}")
+        k["uses"] += 1
+        return k["plain"], k["wrapped"]
+
+
+def _unwrap(wrapped: bytes) -> bytes:
+    """ラップ済みデータキーの復号（キャッシュ優先）"""
+    now = time.time()
+    with _lock:
+        hit = _dec_keys.get(wrapped)
+        if hit and now - hit[1] <= KEY_MAX_AGE:
+            return hit[0]
+    plain = _client().decrypt(CiphertextBlob=wrapped)["Plaintext"]
+    with _lock:
+        stats["kms_decrypt"] += 1
+        _dec_keys.pop(wrapped, None)
+        _dec_keys[wrapped] = (plain, now)
+        while len(_dec_keys) > DECRYPT_CACHE:
+            _dec_keys.pop(next(iter(_dec_keys)))
+    return plain
+
+
+def encrypt_token(plaintext: str, key_id: str = None) -> str:
+    """トークンを暗号化して token_cipher に保存する文字列を返す"""
+    key_id = key_id or KMS_KEY_ID
+    if not key_id:
+        raise RuntimeError("KMS_KEY_ID not set")
+    data = plaintext.encode("utf-8")
+    plain_key, wrapped = _data_key(key_id)
+    nonce = os.urandom(12)
+    sealed = AESGCM(plain_key).encrypt(nonce, data, _AAD)
+    stats["local_encrypt"] += 1
+    return f"{PREFIX}{_b64(wrapped)}:{_b64(nonce + sealed)}"
+
+
+def decrypt_token(cipher: str) -> str:
+    """encrypt_token の結果、または従来の kms.encrypt の base64 を平文に戻す"""
+    if not cipher.startswith(PREFIX):
+        stats["kms_decrypt"] += 1
+        return _client().decrypt(CiphertextBlob=base64.b64decode(cipher))["Plaintext"].decode("utf-8")
+
+    wrapped_b64, sealed_b64 = cipher[len(PREFIX):].split(":", 1)
+    sealed = base64.b64decode(sealed_b64)
+    plain_key = _unwrap(base64.b64decode(wrapped_b64))
+    stats["local_decrypt"] += 1
+    return AESGCM(plain_key).decrypt(sealed[:12], sealed[12:], _AAD).decode("utf-8")
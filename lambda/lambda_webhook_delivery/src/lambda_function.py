@@ -0,0 +1,155 @@
+# lambda_webhook_delivery.py
+# Webhook の送信ワーカー（lambda_convert_notifier が積んだ配信レコードを SQS から受け取って送る）
+#  - 1 バッチ内のレコードを asyncio で並行送信（宛先ホストごとに同時実行数を制限）
+#  - 失敗は DelaySeconds 付きで再投入（指数バックオフ + ジッタ）、上限回数や 4xx は dead-letter へ
+#  - WEBHOOK_QUEUE_URL が無いときはメモリ上のキュー（ローカル検証用）
+import os, json, time, random, asyncio, threading, urllib.parse
+import boto3
+from http_helpers import request, retry_after_sec
+
+AWS_REGION        = os.getenv("AWS_REGION", "ap-northeast-1")
+QUEUE_URL         = os.getenv("WEBHOOK_QUEUE_URL")
+DEAD_LETTER_URL   = os.getenv("WEBHOOK_DLQ_URL")
+PER_HOST_LIMIT    = int(os.getenv("WEBHOOK_PER_HOST", "2"))     # 同じサイトへの同時送信数
+MAX_ATTEMPTS      = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+BASE_DELAY_SEC    = int(os.getenv("WEBHOOK_BASE_DELAY", "10"))
+MAX_DELAY_SEC     = 900                                        # SQS DelaySeconds の上限
+TIMEOUT_SEC       = float(os.getenv("WEBHOOK_TIMEOUT", "10"))
+USER_AGENT        = "itmar-notifier/1.0"
+
+
+class SqsQueue:
+    def __init__(self, url):
+        self.url = url
+        self.client = boto3.client("sqs", region_name=AWS_REGION)
+
+    def send(self, record: dict, delay: int = 0):
+        self.client.send_message(QueueUrl=self.url, MessageBody=json.dumps(record, ensure_ascii=False),
+                                 DelaySeconds=int(delay))
+
+
+class MemoryQueue:
+    """SQS の代わりに使うメモリ上のキュー（遅延は可視になる時刻で表現）"""
+
+    def __init__(self):
+        self.items = []   # [(visible_at, record)]
+        self._lock = threading.Lock()
+
+    def send(self, record: dict, delay: int = 0):
+        with self._lock:
+            self.items.append((time.time() + delay, json.loads(json.dumps(record))))
+
+    def receive(self, max_items=10, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            ready = [it for it in self.items if it[0] <= now][:max_items]
+            for it in ready:
+                self.items.remove(it)
+        return [r for _, r in ready]
+
+
+_queues = {}
+
+def _queue(url):
+    """url が無ければプロセス内で共有するメモリキュー"""
+    if url not in _queues:
+        _queues[url] = SqsQueue(url) if url else MemoryQueue()
+    return _queues[url]
+
+
+def _backoff(attempt: int) -> int:
+    delay = min(MAX_DELAY_SEC, BASE_DELAY_SEC * (2 ** attempt))
+    return int(random.uniform(delay / 2, delay))
+
+
+def _deliver_once(record: dict) -> dict:
+    res = request("POST", record["url"], json_body=record["payload"], headers={"User-Agent": USER_AGENT},
+                  timeout=TIMEOUT_SEC, retries=0, parse="bytes")
+    return {"ok": res["ok"], "status": res["status"],
+            "body": res["body"] if res["status"] == 0 else (res["body"] or b"")[:200].decode("utf-8", "replace"),
+            "retry_after": res["headers"].get("retry-after")}
+
+
+def _settle(record: dict, result: dict, queue, dead_letter):
+    """結果に応じて完了 / 再投入 / dead-letter を決める。戻り値は状態名"""
+    attempt = int(record.get("attempt", 0)) + 1
+    status = result["status"]
+    if result["ok"]:
+        print(f"[WEBHOOK] delivered id={record['id']} status={status} attempt={attempt}")
+        return "delivered"
+
+    # 4xx（408/429 を除く）は再送しても変わらない
+    permanent = 400 <= status < 500 and status not in (408, 429)
+    if permanent or attempt >= MAX_ATTEMPTS:
+        dead = {**record, "attempt": attempt, "state": "dead", "last_status": status,
+                "last_error": str(result["body"])[:500], "dead_at": int(time.time())}
+        dead_letter.send(dead)
+        print(f"[WEBHOOK] dead id={record['id']} status={status} attempt={attempt} url={record['url']}")
+        return "dead"
+
+    delay = _backoff(attempt - 1)
+    hint = retry_after_sec(result.get("retry_after"))
+    if hint is not None:
+        delay = max(delay, min(MAX_DELAY_SEC, int(hint)))
+    queue.send({**record, "attempt": attempt, "last_status": status}, delay)
+    print(f"[WEBHOOK] retry id={record['id']} status={status} attempt={attempt} delay={delay}s")
+    return "retry"
+
+
+async def _deliver_all(records: list, queue, dead_letter) -> list:
+    sems = {}
+
+    async def _one(rec):
+        host = urllib.parse.urlsplit(rec["url"]).hostname or ""
+        sem = sems.setdefault(host, asyncio.Semaphore(PER_HOST_LIMIT))
+        async with sem:
+            result = await asyncio.to_thread(_deliver_once, rec)
+        return _settle(rec, result, queue, dead_letter)
+
+    return await asyncio.gather(*[_one(r) for r in records], return_exceptions=True)
+
+
+def deliver(records: list, queue=None, dead_letter=None) -> list:
+    """配信レコードをまとめて送る。戻り値はレコードごとの状態（例外はそのまま入る）"""
+    queue = queue or _queue(QUEUE_URL)
+    dead_letter = dead_letter or _queue(DEAD_LETTER_URL)
+    t0 = time.time()
+    states = asyncio.run(_deliver_all(records, queue, dead_letter))
+    print(f"[WEBHOOK] batch={len(records)} elapsed={round(time.time() - t0, 2)}s states={states}")
+    return states
+
+
+def run_local(queue: MemoryQueue, dead_letter: MemoryQueue, rounds=20, batch=10):
+    """
+    ローカル検証用: メモリキューを空になるまで配信する。遅延は待たずに時計を進めて扱う。
+    戻り値: 各ラウンドの状態リスト
+    """
+    log, clock = [], time.time()
+    for _ in range(rounds):
+        recs = queue.receive(batch, now=clock)
+        if not recs:
+            if not queue.items:
+                break
+            clock = min(v for v, _ in queue.items)
+            continue
+        log.append(deliver(recs, queue, dead_letter))
+    return log
+
+
+def lambda_handler(event, context):
+    """SQS イベント。再投入に失敗したレコードだけ batchItemFailures で返して SQS に再配信させる"""
+    records, ids = [], []
+    failures = []
+    for rec in event.get("Records", []):
+        try:
+            records.append(json.loads(rec["body"]))
+            ids.append(rec["messageId"])
+        except Exception as e:
+            print("ERROR bad record:", e, rec.get("body", "")[:200])
+
+    states = deliver(records) if records else []
+    for mid, state in zip(ids, states):
+        if isinstance(state, Exception):
+            print("ERROR settle:", state)
+            failures.append({"itemIdentifier": mid})
+    return {"batchItemFailures": failures}
@@ -0,0 +1,223 @@
+# http_helpers.py
+# Graph API / X API / Webhook 呼び出し用の共通 HTTP クライアント（レイヤで配布）
+#  - ホストごとの keep-alive 接続プールをモジュールスコープに持ち、ウォームスタート間で再利用する
+#  - タイムアウト / ジッタ付きリトライ / Retry-After・x-rate-limit-reset の尊重
+#  - DNS・接続・TLS・応答待ち・本文受信の所要時間を記録する
+import os, json, math, time, random, socket, ssl, threading, http.client, urllib.parse, email.utils
+
+DEFAULT_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "20"))
+DEFAULT_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+MAX_RETRY_WAIT  = float(os.getenv("HTTP_MAX_RETRY_WAIT", "10"))   # これより長い待機指示ならリトライせずに返す
+POOL_SIZE       = int(os.getenv("HTTP_POOL_SIZE", "8"))           # ホストごとに保持するアイドル接続数
+POOL_IDLE_SEC   = float(os.getenv("HTTP_POOL_IDLE_SEC", "50"))    # これより長く使っていない接続は捨てる
+LOG_TIMINGS     = os.getenv("HTTP_LOG_TIMINGS", "1") == "1"
+RETRY_STATUSES  = (429, 500, 502, 503, 504)
+IDEMPOTENT      = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")         # retries 未指定で再送してよいメソッド
+
+_pools = {}   # (scheme, host, port) -> [(conn, last_used), ...]
+_lock = threading.Lock()
+_ssl_ctx = ssl.create_default_context()
+
+# 再利用した接続がサーバ側で既に閉じられていたときに出る例外
+_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError)
+
+
+class _TimedConnectionMixin:
+    """connect() を DNS / TCP / TLS に分けて計測する"""
+    handshake = None
+
+    def connect(self):
+        t0 = time.perf_counter()
+        infos = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        t1 = time.perf_counter()
+        err = None
+        for af, socktype, proto, _, addr in infos:
+            sock = socket.socket(af, socktype, proto)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(addr)
+                break
+            except OSError as e:
+                sock.close()
+                err = e
+        else:
+            raise err or OSError(f"cannot connect to {self.host}")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        t2 = time.perf_counter()
+        if self._tls:
+            sock = _ssl_ctx.wrap_socket(sock, server_hostname=self.host)
+        t3 = time.perf_counter()
+        self.sock = sock
+        self.handshake = {
+            "dns_ms": round((t1 - t0) * 1000, 1),
+            "connect_ms": round((t2 - t1) * 1000, 1),
+            "tls_ms": round((t3 - t2) * 1000, 1),
+        }
+
+
+class _HTTPConnection(_TimedConnectionMixin, http.client.HTTPConnection):
+    _tls = False
+
+
+class _HTTPSConnection(_TimedConnectionMixin, http.client.HTTPSConnection):
+    _tls = True
+
+
+def _checkout(scheme, host, port, timeout):
+    key = (scheme, host, port)
+    now = time.monotonic()
+    with _lock:
+        idle = _pools.get(key) or []
+        while idle:
+            conn, last_used = idle.pop()
+            if now - last_used <= POOL_IDLE_SEC:
+                conn.timeout = timeout
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            conn.close()
+    cls = _HTTPSConnection if scheme == "https" else _HTTPConnection
+    return cls(host, port, timeout=timeout), False
+
+
+def _checkin(scheme, host, port, conn, reusable):
+    if reusable:
+        with _lock:
+            idle = _pools.setdefault((scheme, host, port), [])
+            if len(idle) < POOL_SIZE:
+                idle.append((conn, time.monotonic()))
+                return
+    conn.close()
+
+
+def retry_after_sec(value, now=None):
+    """
+    Retry-After（秒数 / HTTP-date）を待ち秒数にする。無い・壊れている・inf/nan なら None。
+    rate_limiter / webhook_delivery もこれを使う（ヘッダの解釈を 1 か所にまとめる）
+    """
+    if not value:
+        return None
+    try:
+        wait = float(value)
+    except (TypeError, ValueError):
+        try:
+            wait = email.utils.parsedate_to_datetime(value).timestamp() - (time.time() if now is None else now)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return None
+    return max(0.0, wait) if math.isfinite(wait) else None
+
+
+def _retry_wait(status, headers, attempt):
+    """サーバ指示（Retry-After / x-rate-limit-reset）があればそれを、無ければ指数バックオフ + ジッタ"""
+    wait = retry_after_sec(headers.get("retry-after"))
+    if wait is not None:
+        return wait
+    if status == 429 and headers.get("x-rate-limit-reset"):
+        try:
+            return max(0.0, int(headers["x-rate-limit-reset"]) - time.time())
+        except ValueError:
+            pass
+    return random.uniform(0, 0.5 * (2 ** attempt))
+
+
+def _send_once(method, url, headers, body, timeout):
+    """1 回分の送受信。戻り値: (status, headers(dict, 小文字キー), data(bytes), timings)"""
+    p = urllib.parse.urlsplit(url)
+    scheme = p.scheme.lower()
+    port = p.port or (443 if scheme == "https" else 80)
+    path = (p.path or "/") + (f"?{p.query}" if p.query else "")
+
+    for fresh_retry in (False, True):
+        conn, reused = _checkout(scheme, p.hostname, port, timeout)
+        t0 = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+        except _STALE_ERRORS:
+            conn.close()
+            if reused and not fresh_retry:
+                continue  # 古い keep-alive 接続だったので新しい接続でやり直す
+            raise
+        except Exception:
+            conn.close()
+            raise
+        t1 = time.perf_counter()
+        try:
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        t2 = time.perf_counter()
+        _checkin(scheme, p.hostname, port, conn, not resp.will_close)
+
+        timings = {"reused": reused, **({} if reused else (conn.handshake or {}))}
+        timings["ttfb_ms"] = round((t1 - t0) * 1000, 1)
+        timings["body_ms"] = round((t2 - t1) * 1000, 1)
+        return resp.status, {k.lower(): v for k, v in resp.getheaders()}, data, timings
+
+
+def _parse(data, parse):
+    if parse == "bytes":
+        return data
+    text = (data or b"").decode("utf-8", errors="replace")
+    if parse == "text":
+        return text
+    try:
+        return json.loads(text) if text else {}
+    except Exception:
+        return {"raw": text}
+
+
+def request(method, url, *, headers=None, body=None, json_body=None, form=None,
+            timeout=None, retries=None, parse="json"):
+    """
+    共通リクエスト API。戻り値は常に dict:
+      {"ok": bool, "status": int, "body": ..., "headers": {...}, "timings": {...}, "attempts": n}
+    通信エラー時は status=0, body={"error": "..."}。
+    body には bytes のほか、bytes の iterable も渡せる（Content-Length は呼び出し側で指定）。
+    parse: "json"（既定, 解析できなければ {"raw": text}）/ "text" / "bytes"
+    retries 未指定なら冪等なメソッドだけ HTTP_RETRIES 回まで再送する。
+    POST は届いたかどうか分からない失敗を再送すると二重に作成されるので、再送してよい呼び出し側が明示する。
+    """
+    headers = dict(headers or {})
+    if json_body is not None:
+        body = json.dumps(json_body, ensure_ascii=False).encode("utf-8")
+        headers.setdefault("Content-Type", "application/json; charset=utf-8")
+    elif form is not None:
+        body = urllib.parse.urlencode(form).encode("utf-8")
+        headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+    if isinstance(body, (bytes, bytearray)):
+        headers.setdefault("Content-Length", str(len(body)))
+    timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+    if retries is None:
+        retries = DEFAULT_RETRIES if method.upper() in IDEMPOTENT else 0
+    host = urllib.parse.urlsplit(url).hostname
+
+    result = None
+    for attempt in range(retries + 1):
+        try:
+            status, resp_headers, data, timings = _send_once(method, url, headers, body, timeout)
+        except Exception as e:
+            result = {"ok": False, "status": 0, "body": {"error": f"{type(e).__name__}: {e}"},
+                      "headers": {}, "timings": {}, "attempts": attempt + 1}
+            print(f"[HTTP] {method} {host} error={type(e).__name__}: {e} attempt={attempt + 1}")
+            if attempt < retries:
+                time.sleep(random.uniform(0, 0.5 * (2 ** attempt)))
+                continue
+            return result
+
+        if LOG_TIMINGS:
+            print(f"[HTTP] {method} {host} status={status} attempt={attempt + 1} "
+                  + " ".join(f"{k}={v}" for k, v in timings.items()))
+        result = {"ok": 200 <= status < 300, "status": status, "body": _parse(data, parse),
+                  "headers": resp_headers, "timings": timings, "attempts": attempt + 1}
+        if result["ok"] or status not in RETRY_STATUSES:
+            return result
+
+        wait = _retry_wait(status, resp_headers, attempt)
+        result["retry_after"] = round(wait, 1)
+        if attempt >= retries or wait > MAX_RETRY_WAIT:
+            return result
+        time.sleep(wait)
+
+    return result
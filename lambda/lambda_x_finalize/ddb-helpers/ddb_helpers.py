@@ -0,0 +1,215 @@
+# ddb_helpers.py
+import os, time, hashlib, urllib.parse, boto3
+
+REGION = os.getenv("AWS_REGION", "ap-northeast-1")
+JOBS_TABLE = os.getenv("JOBS_TABLE", "convert_jobs")
+_ddb = boto3.resource("dynamodb", region_name=REGION).Table(JOBS_TABLE)
+
+# ===== ジョブの status（状態遷移を条件付き・1 回の UpdateItem で書く） =====
+# status の値と段階（status_rank）:
+#   0 pending          : presign / start が作成（scheduled: 予約投稿の待ち中も同じ段階）
+#   1 processing 等     : 途中経過（同じ段階内で値が変わるのは可）
+#   2 ERROR,<stage>,.. : 失敗
+#   3 それ以外          : 成功（IG の media_id / X の投稿 id をそのまま入れる）
+# 遷移は段階が上がる方向だけ許す。同じ値の再書き込み（ポーリングの繰り返し）や、
+# 遅れて届いた実行による後退（成功 → エラー など）は ConditionExpression で弾く。
+RANK_PENDING, RANK_PROGRESS, RANK_ERROR, RANK_DONE = 0, 1, 2, 3
+PROGRESS_STATUSES = {"processing", "uploading", "converting", "publishing"}
+HISTORY_MAX = int(os.getenv("STATUS_HISTORY_MAX", "20"))   # status_history に残す件数
+
+def status_rank(status: str) -> int:
+    s = (status or "").strip()
+    if s == "" or s == "pending" or s == "scheduled":
+        return RANK_PENDING
+    if s in PROGRESS_STATUSES:
+        return RANK_PROGRESS
+    if s.upper().startswith("ERROR"):
+        return RANK_ERROR
+    return RANK_DONE
+
+class JobUpdate:
+    """
+    1 回の実行で決まった属性変更をためて、commit() でまとめて 1 回の UpdateItem にする。
+      JobUpdate(job_id).status("ERROR,publish,400").set(error_detail=...).timing("publish", 812).commit()
+    status を含むときは状態遷移の条件付き（弾かれたら何も書かずに False）。
+    status を含まないときは無条件で書く。
+    どちらも updated_at と rev（書くたびに +1。/jobs/changes が同じ秒の 2 回目の更新を見分ける）を進める。
+    """
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self._status = None
+        self._attrs = {}
+
+    def status(self, status: str, force: bool = False):
+        self._status = (str(status), bool(force))
+        return self
+
+    def set(self, **attrs):
+        self._attrs.update({k: v for k, v in attrs.items() if v is not None})
+        return self
+
+    def timing(self, stage: str, ms):
+        if ms is not None:
+            self._attrs[f"timing_{stage}_ms"] = int(round(float(ms)))
+        return self
+
+    def commit(self) -> bool:
+        if not self.job_id or (self._status is None and not self._attrs):
+            return False
+        now = int(time.time())
+        names, values, sets = {}, {":u": now}, ["updated_at = :u"]
+        for i, (k, v) in enumerate(sorted(self._attrs.items())):
+            names[f"#a{i}"] = k
+            values[f":a{i}"] = v
+            sets.append(f"#a{i} = :a{i}")
+
+        kwargs = {"Key": {"job_id": self.job_id}}
+        if self._status is not None:
+            status, force = self._status
+            rank = status_rank(status)
+            names.update({"#s": "status", "#r": "status_rank", "#h": "status_history"})
+            values.update({":s": status, ":r": rank, ":h": [{"status": status, "at": now}], ":e": []})
+            sets += ["#s = :s", "#r = :r", "#h = list_append(if_not_exists(#h, :e), :h)"]
+            if not force:
+                # status_rank が無い項目（presign/start で作ったまま）は pending 扱い
+                cond = "(attribute_not_exists(#r) OR #r < :r)"
+                if rank == RANK_PROGRESS:
+                    cond += " OR (#r = :r AND #s <> :s)"
+                kwargs["ConditionExpression"] = cond
+            kwargs["ReturnValues"] = "UPDATED_NEW"
+
+        names["#v"], values[":one"] = "rev", 1
+        kwargs.update({"UpdateExpression": "SET " + ", ".join(sets) + " ADD #v :one",
+                       "ExpressionAttributeNames": names, "ExpressionAttributeValues": values})
+        try:
+            r = _ddb.update_item(**kwargs)
+        except _ddb.meta.client.exceptions.ConditionalCheckFailedException:
+            print(f"[STATUS] skip job_id={self.job_id} status={self._status[0]} (no-op or backward)")
+            return False
+
+        history = (r.get("Attributes") or {}).get("status_history") or []
+        if len(history) > HISTORY_MAX:
+            _trim_history(self.job_id, len(history) - HISTORY_MAX)
+        return True
+
+def _trim_history(job_id: str, n: int):
+    """status_history の古い側を n 件削る（上限を超えたときだけの追加書き込み）"""
+    try:
+        _ddb.update_item(
+            Key={"job_id": job_id},
+            UpdateExpression="REMOVE " + ", ".join(f"#h[{i}]" for i in range(n)),
+            ExpressionAttributeNames={"#h": "status_history"},
+        )
+    except Exception as e:
+        print(f"[STATUS] history trim failed job_id={job_id}: {e}")
+
+def set_status(job_id: str, status: str, force: bool = False, **attrs) -> bool:
+    """convert_jobs[job_id].status を更新（updated_at も付与）。attrs も同じ UpdateItem で書く"""
+    return JobUpdate(job_id).status(status, force=force).set(**attrs).commit()
+
+# ===== X アップロードセッション（append の再開用チェックポイント） =====
+# 1 ジョブに複数メディアがあり得るので、属性名はソース URL ごとに分ける
+#   xup_<sid>  : {"media_id", "total_bytes", "etag", "expires_at", "state"}
+#                state は finalize 後の処理結果（"succeeded" / "failed"、未確定なら無し）
+#   xseg_<sid> : 送信済み segment_index の数値セット（ADD で追記）
+
+def source_id(media_url: str) -> str:
+    """presigned URL のクエリ（署名）を除いた host+path から安定した識別子を作る"""
+    p = urllib.parse.urlparse(media_url or "")
+    return hashlib.sha1(f"{p.netloc}{p.path}".encode("utf-8")).hexdigest()[:12]
+
+def get_x_upload(job_id: str, media_url: str):
+    """保存済みセッションを返す。無ければ None"""
+    if not job_id:
+        return None
+    sid = source_id(media_url)
+    r = _ddb.get_item(
+        Key={"job_id": job_id},
+        ProjectionExpression="#u, #g",
+        ExpressionAttributeNames={"#u": f"xup_{sid}", "#g": f"xseg_{sid}"},
+    )
+    item = r.get("Item") or {}
+    sess = item.get(f"xup_{sid}")
+    if not sess:
+        return None
+    return {
+        "media_id": str(sess.get("media_id", "")),
+        "total_bytes": int(sess.get("total_bytes", 0)),
+        "etag": sess.get("etag", ""),
+        "expires_at": int(sess.get("expires_at", 0)),
+        "state": sess.get("state", ""),
+        "segments": {int(i) for i in item.get(f"xseg_{sid}", set())},
+    }
+
+def start_x_upload(job_id: str, media_url: str, media_id: str, total_bytes: int, etag: str, expires_at: int):
+    """新しい media_id でセッションを作り直す（送信済みセグメントはリセット）"""
+    if not job_id:
+        return
+    sid = source_id(media_url)
+    _ddb.update_item(
+        Key={"job_id": job_id},
+        UpdateExpression="SET #u = :u, updated_at = :t REMOVE #g",
+        ExpressionAttributeNames={"#u": f"xup_{sid}", "#g": f"xseg_{sid}"},
+        ExpressionAttributeValues={
+            ":u": {"media_id": media_id, "total_bytes": int(total_bytes), "etag": etag or "", "expires_at": int(expires_at)},
+            ":t": int(time.time()),
+        },
+    )
+
+def ack_x_segments(job_id: str, media_url: str, segments):
+    """送信が確認できた segment_index を記録する"""
+    segments = {int(i) for i in segments}
+    if not job_id or not segments:
+        return
+    sid = source_id(media_url)
+    _ddb.update_item(
+        Key={"job_id": job_id},
+        UpdateExpression="ADD #g :s",
+        ExpressionAttributeNames={"#g": f"xseg_{sid}"},
+        ExpressionAttributeValues={":s": segments},
+    )
+
+def finish_x_upload(job_id: str, media_url: str, media_id: str, state: str):
+    """finalize 後の処理結果を記録する（同じ media_id のセッションにだけ書く）"""
+    if not job_id:
+        return
+    sid = source_id(media_url)
+    try:
+        _ddb.update_item(
+            Key={"job_id": job_id},
+            UpdateExpression="SET #u.#st = :s",
+            ConditionExpression="#u.media_id = :m",
+            ExpressionAttributeNames={"#u": f"xup_{sid}", "#st": "state"},
+            ExpressionAttributeValues={":s": state, ":m": str(media_id)},
+        )
+    except _ddb.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+
+# ===== メディアのサイズ/MIME キャッシュ（initialize が調べた結果を append で再利用） =====
+#   probe_<sid> : {"size", "mime", "etag"}
+
+def get_media_probe(job_id: str, media_url: str):
+    if not job_id:
+        return None
+    sid = source_id(media_url)
+    r = _ddb.get_item(
+        Key={"job_id": job_id},
+        ProjectionExpression="#p",
+        ExpressionAttributeNames={"#p": f"probe_{sid}"},
+    )
+    probe = (r.get("Item") or {}).get(f"probe_{sid}")
+    if not probe:
+        return None
+    return {"size": int(probe.get("size", 0)), "mime": probe.get("mime", ""), "etag": probe.get("etag", "")}
+
+def put_media_probe(job_id: str, media_url: str, size: int, mime: str, etag: str):
+    if not job_id:
+        return
+    sid = source_id(media_url)
+    _ddb.update_item(
+        Key={"job_id": job_id},
+        UpdateExpression="SET #p = :p",
+        ExpressionAttributeNames={"#p": f"probe_{sid}"},
+        ExpressionAttributeValues={":p": {"size": int(size), "mime": mime or "", "etag": etag or ""}},
+    )
@@ -0,0 +1,416 @@
+# rate_limiter.py
+# X / Graph API 呼び出しの実行をまたいだレート制御（レイヤで配布）
+#  - キーは (platform, account, endpoint)。X は account にトークンのハッシュ（account_key）、IG は ig_user_id を使う
+#  - 予約型のトークンバケット: acquire() は容量を先に予約し、足りない分だけ待つ
+#    待ちが max_wait を超えるなら RateLimited（wait_sec と reservation 付き）。呼び出し側はステートマシンの Wait で
+#    wait_sec 待ち、次の呼び出しで reservation を acquire() に渡す（予約済みの順番で呼べるので、待った実行が一斉に来て
+#    また弾かれる、ということが起きない）。MAX_RESERVE_SEC より先は予約しない（reservation=None）
+#    複数の実行が同時に来ても、先に予約した順に間隔が空くので 429 の連鎖にならない
+#  - 補充速度は上限 × RATE_LIMIT_HEADROOM（既定 0.9）。上限ちょうどまで使い切らず、少し手前で頭打ちにする
+#  - observe() で応答ヘッダから学習する:
+#      X    : x-rate-limit-limit / x-rate-limit-remaining / x-rate-limit-reset
+#      Meta : X-App-Usage / X-Business-Use-Case-Usage（使用率 %、estimated_time_to_regain_access）
+#      429  : reset / Retry-After まで全体を止める（Graph API の error.code 4 / 17 / 32 / 613 等も 429 とみなす）
+#  - バックエンドは差し替え可能: RATE_LIMIT_BACKEND=dynamodb（既定、テーブル rate_limits） / memory（ローカル検証用）
+#    状態の更新は version による条件付き書き込み（競合したら読み直してやり直す）
+#  - simulate(): 仮想時計で「制限ありの API に多数の実行が同時に投稿する」状況を回し、429 の数とスループットを比べる
+import os, json, math, time, random, hashlib, threading
+from decimal import Decimal
+from http_helpers import retry_after_sec
+
+REGION       = os.getenv("AWS_REGION", "ap-northeast-1")
+BACKEND      = os.getenv("RATE_LIMIT_BACKEND", "dynamodb")
+TABLE        = os.getenv("RATE_LIMIT_TABLE", "rate_limits")
+HEADROOM     = float(os.getenv("RATE_LIMIT_HEADROOM", "0.9"))
+MAX_WAIT_SEC = float(os.getenv("RATE_LIMIT_MAX_WAIT", "20"))    # これより長く待つ必要があれば呼び出し側に返す
+MAX_RESERVE_SEC = float(os.getenv("RATE_LIMIT_MAX_RESERVE", "86400"))  # この先までは予約して順番を確保する（それより先は予約しない）
+CAS_RETRIES  = 16
+GRAPH_LIMIT_CODES = (4, 17, 32, 613, 80001, 80002)   # Graph API がレート制限を 400/403 で返すときの error.code
+
+# (platform, endpoint) -> (上限回数, 窓の秒数)。ヘッダから学習した上限で上書きされる
+LIMITS = {
+    ("x", "post"):      (100, 900),       # POST /2/posts（ユーザー単位 15 分）
+    ("x", "media"):     (500, 900),       # POST /2/media/upload/initialize
+    ("ig", "graph"):    (200, 3600),      # Graph API（ユーザー単位 1 時間）
+    ("ig", "publish"):  (50, 86400),      # content publishing（24 時間）
+}
+DEFAULT_LIMIT = (60, 60)
+
+
+class RateLimited(Exception):
+    def __init__(self, key, wait_sec, reservation=None):
+        super().__init__(f"rate limited: {key} wait={round(wait_sec, 1)}s")
+        self.key = key
+        self.wait_sec = wait_sec
+        self.reservation = reservation   # {"key", "at", "shift"}: 次の呼び出しで acquire(reservation=...) に渡す
+
+
+def account_key(access_token: str) -> str:
+    """X のようにユーザー ID を持たない呼び出し元向け: トークンから安定したアカウント識別子を作る"""
+    return hashlib.sha256((access_token or "").encode("utf-8")).hexdigest()[:16]
+
+
+def _key(platform, account, endpoint):
+    return f"{platform}#{account}#{endpoint}"
+
+
+# ===== バケットの計算（バックエンド共通） =====
+# GCRA（仮想到着時刻 tat）で持つ。1 回ぶんの間隔 T = window / (capacity × HEADROOM)、
+# まとめて使える回数は capacity × HEADROOM。予約は tat を T ずつ進めるだけなので 1 回の書き込みで済む
+#   blocked_until: 学習で分かった「この時刻までは通らない」時刻
+#   shift        : 学習で予約済みの順番を後ろへずらした秒数の累計（予約時の値との差を acquire が足す）
+def _new_state(platform, endpoint, now):
+    capacity, window = LIMITS.get((platform, endpoint), DEFAULT_LIMIT)
+    return {"tat": now, "blocked_until": 0.0, "shift": 0.0, "capacity": capacity, "window": window,
+            "updated_at": now, "version": 0}
+
+
+def _interval(state):
+    return state["window"] / (state["capacity"] * HEADROOM)
+
+
+def _burst(state):
+    return (state["capacity"] * HEADROOM - 1) * _interval(state)
+
+
+def _reserve(state, n, now, horizon):
+    """n 回分を予約した新しい状態と待ち秒数。待ちが horizon を超えるなら (None, 待ち秒数)"""
+    t = _interval(state)
+    tat = max(state["tat"], now)
+    allowed = max(tat + (n - 1) * t - _burst(state), state["blocked_until"])
+    wait = max(0.0, allowed - now)
+    if wait > horizon:
+        return None, wait
+    return {**state, "tat": max(tat, allowed) + n * t, "updated_at": now}, wait
+
+
+def _push(state, delta, now):
+    """予約済みの順番も含めて delta 秒後ろへずらす"""
+    return {**state, "tat": max(state["tat"], now) + delta, "shift": state["shift"] + delta, "updated_at": now}
+
+
+def _clamp(state, available, now):
+    """今すぐ使える回数を available 以下にする（見積もりのほうが多いときだけ）"""
+    t = _interval(state)
+    target = now + _burst(state) + t - max(0.0, available) * t
+    delta = target - max(state["tat"], now)
+    return _push(state, delta, now) if delta > 1e-6 else state
+
+
+def _block(state, until, now):
+    """until まで止める。同じ締め切りを何度受け取っても一度だけずらす"""
+    start = max(now, state["blocked_until"])
+    if not math.isfinite(until) or until <= start:
+        return state
+    return {**_push(state, until - start, now), "blocked_until": until}
+
+
+def _num(headers, name):
+    try:
+        v = float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+    return v if math.isfinite(v) else None
+
+
+def _retry_after(headers, now):
+    wait = retry_after_sec(headers.get("retry-after"), now)
+    return None if wait is None else now + wait
+
+
+def _meta_usage(headers):
+    """X-App-Usage / X-Business-Use-Case-Usage から (最大使用率 %, 回復までの秒数)"""
+    pct, regain = 0.0, 0.0
+    raw = headers.get("x-app-usage")
+    if raw:
+        try:
+            pct = max([pct] + [float(v) for v in json.loads(raw).values()])
+        except (ValueError, TypeError, AttributeError):
+            pass
+    raw = headers.get("x-business-use-case-usage")
+    if raw:
+        try:
+            for entries in json.loads(raw).values():
+                for e in entries:
+                    pct = max(pct, float(e.get("call_count", 0)), float(e.get("total_cputime", 0)),
+                              float(e.get("total_time", 0)))
+                    regain = max(regain, float(e.get("estimated_time_to_regain_access", 0)) * 60)
+        except (ValueError, TypeError, AttributeError):
+            pass
+    return pct, regain
+
+
+def _graph_limited(body):
+    err = body.get("error") if isinstance(body, dict) else None
+    return isinstance(err, dict) and err.get("code") in GRAPH_LIMIT_CODES
+
+
+def _learn(state, status, headers, now):
+    """応答から状態を補正する。変化が無ければ None"""
+    new = dict(state)
+    limit = _num(headers, "x-rate-limit-limit")
+    remaining = _num(headers, "x-rate-limit-remaining")
+    reset = _num(headers, "x-rate-limit-reset")
+    if limit and limit > 0 and limit != new["capacity"]:
+        new["capacity"] = limit
+    if remaining is not None:
+        if remaining < 1 and reset:
+            new = _block(new, reset, now)
+        else:
+            new = _clamp(new, remaining * HEADROOM, now)
+
+    pct, regain = _meta_usage(headers)
+    if regain > 0:
+        new = _block(new, now + regain, now)
+    elif pct > 0:
+        # 窓の使用率から残りを見積もる（HEADROOM を超えていたら、超えた分が戻るまで止める）
+        left = new["capacity"] * (HEADROOM - pct / 100.0)
+        if left < 0:
+            new = _block(new, now + new["window"] * (pct / 100.0 - HEADROOM), now)
+        else:
+            new = _clamp(new, left, now)
+
+    if status == 429:
+        until = reset or _retry_after(headers, now) or now + _interval(new) * 10
+        new = _block(new, until, now)
+
+    # ずらした・上限が変わったときだけ書く（毎回の応答で書き込みを増やさない）
+    if any(new[k] != state[k] for k in ("tat", "blocked_until", "capacity")):
+        return new
+    return None
+
+
+# ===== バックエンド =====
+class DynamoBackend:
+    def __init__(self, table=TABLE):
+        import boto3
+        self._table = boto3.resource("dynamodb", region_name=REGION).Table(table)
+        self._errors = self._table.meta.client.exceptions
+
+    def get(self, key):
+        item = self._table.get_item(Key={"bucket_key": key}, ConsistentRead=True).get("Item")
+        if not item:
+            return None
+        return {k: (float(v) if isinstance(v, Decimal) else v) for k, v in item.items() if k != "bucket_key"}
+
+    def cas(self, key, state, version) -> bool:
+        item = {k: (Decimal(str(round(v, 4))) if isinstance(v, float) else v) for k, v in state.items()}
+        item.update(bucket_key=key, version=int(version) + 1,
+                    expires_at=int(max(state["tat"], state["blocked_until"]) + state["window"] + 86400))
+        try:
+            if version:
+                self._table.put_item(Item=item, ConditionExpression="version = :v",
+                                     ExpressionAttributeValues={":v": int(version)})
+            else:
+                self._table.put_item(Item=item, ConditionExpression="attribute_not_exists(bucket_key)")
+            return True
+        except self._errors.ConditionalCheckFailedException:
+            return False
+
+
+class MemoryBackend:
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            return dict(item) if item else None
+
+    def cas(self, key, state, version) -> bool:
+        with self._lock:
+            cur = self._items.get(key)
+            if int(cur["version"] if cur else 0) != int(version):
+                return False
+            self._items[key] = {**state, "version": int(version) + 1}
+            return True
+
+
+class RateLimiter:
+    def __init__(self, backend=None, clock=time.time, sleep=time.sleep):
+        self.backend = backend
+        self.clock = clock
+        self.sleep = sleep
+
+    def _update(self, platform, account, endpoint, fn):
+        """状態を読み、fn(state, now) の結果を条件付きで書く（競合したらやり直す）。戻り値は fn の 2 番目"""
+        key = _key(platform, account, endpoint)
+        for i in range(CAS_RETRIES):
+            now = self.clock()
+            state = self.backend.get(key) or _new_state(platform, endpoint, now)
+            new, extra = fn(state, now)
+            if new is None or self.backend.cas(key, new, state.get("version", 0)):
+                return extra
+            self.sleep(random.uniform(0, min(0.5, 0.01 * (2 ** i))))   # 競合時は指数バックオフ（フルジッタ）
+        raise RuntimeError(f"rate limiter: too much contention on {key}")
+
+    def acquire(self, platform, account, endpoint, n=1, max_wait=None, reservation=None, reserve=True):
+        """
+        n 回分の容量を予約し、必要なら待ってから返る（戻り値: 待った秒数）。
+        max_wait（既定 RATE_LIMIT_MAX_WAIT）より長く待つ必要があるなら RateLimited を投げる。
+        reservation: 前回の RateLimited.reservation。予約済みの時刻まで待つだけで、新たには予約しない
+        reserve=False: 待ちが max_wait を超えるときは予約しない（ポーリングのように、後で同じ呼び出しをし直さないもの）
+        """
+        max_wait = MAX_WAIT_SEC if max_wait is None else max_wait
+        key = _key(platform, account, endpoint)
+
+        if reservation and reservation.get("key") == key:
+            # 予約後に学習で止められていれば、その分だけ後ろへずれる
+            state = self.backend.get(key) or {}
+            shift = float(state.get("shift", 0))
+            at = float(reservation.get("at", 0)) + shift - float(reservation.get("shift", 0))
+            wait = max(0.0, at - self.clock())
+            if wait > max_wait:
+                raise RateLimited(key, wait, {"key": key, "at": round(at, 3), "shift": shift})
+        else:
+            horizon = max(max_wait, MAX_RESERVE_SEC) if reserve else max_wait
+            got = {}
+
+            def fn(state, now):
+                got["shift"] = float(state.get("shift", 0))
+                return _reserve(state, n, now, horizon)
+
+            wait = self._update(platform, account, endpoint, fn)
+            if wait > max_wait:
+                # horizon 以内なら予約は済んでいる: その時刻に来てもらう
+                held = ({"key": key, "at": round(self.clock() + wait, 3), "shift": got["shift"]}
+                        if wait <= horizon else None)
+                print(f"[RATE] limited key={key} wait={round(wait, 1)}s reserved={bool(held)}")
+                raise RateLimited(key, wait, held)
+        if wait > 0:
+            print(f"[RATE] wait key={key} {round(wait, 2)}s")
+            self.sleep(wait)
+        return wait
+
+    def observe(self, platform, account, endpoint, status, headers, body=None):
+        """応答（status・ヘッダ・本文）から上限・残量を学習する"""
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        if _graph_limited(body):
+            status = 429
+        self._update(platform, account, endpoint, lambda state, now: (_learn(state, status, headers, now), None))
+
+
+_default = None
+
+
+def limiter() -> RateLimiter:
+    """プロセス内で共有する RateLimiter（バックエンドは RATE_LIMIT_BACKEND）"""
+    global _default
+    if _default is None:
+        _default = RateLimiter(DynamoBackend() if BACKEND == "dynamodb" else MemoryBackend())
+    return _default
+
+
+def max_wait_for(context, call_timeout) -> float:
+    """
+    acquire() の中で待ってよい秒数: Lambda の残り時間から呼び出し本体（call_timeout 秒）の分を引いたもの（上限 MAX_WAIT_SEC）。
+    待っている間にタイムアウトで落ちると、予約した枠を使わないまま再試行が別の枠を取ってしまうため
+    """
+    if context is None:
+        return MAX_WAIT_SEC
+    left = context.get_remaining_time_in_millis() / 1000.0 - call_timeout - 1.0
+    return max(0.0, min(MAX_WAIT_SEC, left))
+
+
+def acquire(platform, account, endpoint, n=1, max_wait=None, reservation=None, reserve=True, context=None,
+            call_timeout=0.0):
+    """
+    RateLimiter.acquire。状態テーブルに届かないときは制御せずに通す（投稿自体は止めない）
+    context を渡すと、max_wait 省略時の待ちを残り時間に収まる分（max_wait_for）に抑える
+    """
+    if max_wait is None and context is not None:
+        max_wait = max_wait_for(context, call_timeout)
+    try:
+        return limiter().acquire(platform, account, endpoint, n, max_wait, reservation, reserve)
+    except RateLimited:
+        raise
+    except Exception as e:
+        print("WARN rate_limiter.acquire:", e)
+        return 0.0
+
+
+def observe(platform, account, endpoint, status, headers, body=None):
+    try:
+        limiter().observe(platform, account, endpoint, status, headers, body)
+    except Exception as e:
+        # 学習に失敗しても呼び出し自体は成功しているので止めない
+        print("WARN rate_limiter.observe:", e)
+
+
+# ===== ローカル検証 =====
+class _VirtualClock:
+    def __init__(self):
+        self.t = 0.0
+
+    def now(self):
+        return self.t
+
+    def sleep(self, s):
+        self.t += s
+
+
+def simulate(executions=300, *, limit=100, window=900, arrival_sec=60, use_limiter=True, max_wait=20.0,
+             retry_wait=60.0, horizon=3600.0) -> dict:
+    """
+    仮想時計で、固定窓（window 秒に limit 回、x-rate-limit-* を返す）の API に
+    executions 件の投稿が arrival_sec 秒の間にまとめて来る状況を回す。
+      use_limiter=False: 従来どおり投げてみて 429 なら retry_wait 秒後にやり直す
+      use_limiter=True : acquire() で予約し、待ちが max_wait を超えたら RateLimited の wait 秒後にやり直す
+    戻り値: {"ok", "rate_limited"(429 の数), "deferred"(RateLimited の数), "calls", "elapsed"}
+    """
+    import heapq
+    clock = _VirtualClock()
+    lim = RateLimiter(MemoryBackend(), clock=clock.now, sleep=lambda s: None)
+    api = {"used": 0, "window_start": 0.0}
+    stats = {"ok": 0, "rate_limited": 0, "deferred": 0, "calls": 0}
+
+    def call_api():
+        now = clock.now()
+        if now >= api["window_start"] + window:
+            api["window_start"] = now - (now - api["window_start"]) % window
+            api["used"] = 0
+        stats["calls"] += 1
+        reset = api["window_start"] + window
+        if api["used"] >= limit:
+            return 429, {"x-rate-limit-limit": str(limit), "x-rate-limit-remaining": "0", "x-rate-limit-reset": str(reset)}
+        api["used"] += 1
+        return 201, {"x-rate-limit-limit": str(limit), "x-rate-limit-remaining": str(limit - api["used"]),
+                     "x-rate-limit-reset": str(reset)}
+
+    rng = random.Random(1)
+    queue = [(rng.uniform(0, arrival_sec), i) for i in range(executions)]
+    heapq.heapify(queue)
+    held = {}   # 実行 -> RateLimited.reservation（ステートマシンの入力で持ち回る想定）
+    last_done = 0.0
+    while queue:
+        t, i = heapq.heappop(queue)
+        if t > horizon:
+            break
+        clock.t = max(clock.t, t)
+        if i < 0:
+            i = -1 - i          # 予約済み（待ち終わった）実行
+        elif use_limiter:
+            try:
+                waited = lim.acquire("x", "acct", "post", max_wait=max_wait, reservation=held.pop(i, None))
+            except RateLimited as e:
+                stats["deferred"] += 1
+                if e.reservation:
+                    held[i] = e.reservation
+                heapq.heappush(queue, (clock.t + e.wait_sec, i))
+                continue
+            if waited:
+                # 待ちの間に他の実行が進められるよう、呼び出し時刻を待ち後にずらしてキューへ戻す
+                heapq.heappush(queue, (clock.t + waited, -1 - i))
+                continue
+        status, headers = call_api()
+        if use_limiter:
+            lim.observe("x", "acct", "post", status, headers)
+        if status == 429:
+            stats["rate_limited"] += 1
+            heapq.heappush(queue, (clock.t + (0 if use_limiter else retry_wait), i))
+        else:
+            stats["ok"] += 1
+            last_done = clock.t
+    stats["elapsed"] = round(last_done, 1)
+    return stats
@@ -0,0 +1,26 @@
+# lambda_x_publish.py (Python 3.11)
+# X 投稿の fast path: get_job の出力を受け、小さな画像・短い動画なら initialize → append → finalize → 処理待ち → post を
+# この 1 回の呼び出しで済ませる（段ごとの Lambda を経由しないので、コールドスタートと TLS ハンドシェイクは 1 回分）
+#  - fast_path=True  : 投稿まで完了（x_post_id を返す）
+#  - fast_path=False : stage="upload_media"。出力をそのまま lambda_x_upload_media に渡し、そこから lambda_post_x へ
+#                      （media があれば済んだ項目は送り直さない。送信済みセグメントも convert_jobs の記録で飛ばされる）
+#  - error            : 段ごとの Lambda と同じ形のエラー（stage にどの段で失敗したか。メディアは media に項目ごと）
+#                      error="rate_limit"（stage="post"）は wait_seconds 待ってから lambda_post_x へ（media_ids / rate_reservation 付き）
+from x_publisher import XPublisher
+
+def lambda_handler(event, context):
+    access_token = event.get("access_token")
+    text = event.get("text")
+    media_urls = event.get("media_urls") or []
+
+    if not access_token or not text:
+        return {"error": "missing required parameters"}
+
+    pub = XPublisher(access_token, event.get("job_id", ""))
+    res = pub.publish(text, media_urls, caption=event.get("caption", ""), context=context,
+                      max_wait_sec=int(event.get("max_wait_sec", 180)),
+                      rate_reservation=event.get("rate_reservation"))
+    if res.get("fast_path") is False:
+        # 段ごとの流れがそのまま使えるよう、受け取った入力を引き継ぐ
+        return {**event, **res}
+    return res
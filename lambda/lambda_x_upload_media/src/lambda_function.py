@@ -0,0 +1,32 @@
+# lambda_x_upload_media.py (Python 3.11)
+# X 投稿のメディアのファンアウト段: get_job の media_urls をすべて並列にアップロードし、media_ids を元の順で lambda_post_x に渡す
+#  - 同じトークンでの同時アップロードは MEDIA_PER_TOKEN 件まで
+#  - 入力に前回の出力（media）があれば、succeeded の項目は送り直さず、processing の項目は処理待ちの続きから進める
+#    （処理結果は convert_jobs にも記録するので、実行をやり直しても処理済みの項目は送り直さない）
+#  - 戻り値（入力を引き継いで media / media_ids / complete を足したもの）:
+#      complete=True                : media_ids がそろった → lambda_post_x へ
+#      complete=False               : wait_sec 秒後に、この出力をそのまま入力にしてもう一度呼ぶ
+#      error="media_upload_failed"  : failed に失敗した index（理由は media[i] の stage / error）
+#                                     この出力で呼び直すと、失敗した項目だけをやり直す
+from x_publisher import XPublisher, media_summary
+
+def lambda_handler(event, context):
+    access_token = event.get("access_token")
+    media_urls = event.get("media_urls") or []
+
+    if not access_token:
+        return {"error": "missing required parameters"}
+
+    pub = XPublisher(access_token, event.get("job_id", ""))
+    items = pub.upload_all(media_urls, previous=event.get("media") or [], context=context,
+                           max_wait_sec=int(event.get("max_wait_sec", 180)))
+    summary = media_summary(items)
+
+    # 前段（lambda_x_publish の fallback / 前回のエラー）の印は落として引き継ぐ
+    out = {k: v for k, v in event.items() if k not in ("error", "failed", "stage", "reason", "fast_path", "wait_sec")}
+    out.update(media=items, media_ids=summary["media_ids"], complete=summary["complete"])
+    if summary["pending"]:
+        out["wait_sec"] = summary["wait_sec"]
+    elif summary["failed"]:
+        out.update(error="media_upload_failed", failed=summary["failed"])
+    return out
@@ -0,0 +1,903 @@
+# x_publisher.py
+# X へのメディア付き投稿（initialize → append → finalize → 処理待ち → post）の各段をまとめたクラス（レイヤで配布）
+#  - 各段のメソッドは従来の Lambda（lambda_x_initialize / lambda_x_append / lambda_x_finalize /
+#    lambda_poll_media_status / lambda_post_x）と同じ dict を返す。各 Lambda はこのクラスの薄いラッパー
+#  - publish(): 小さな画像・短い動画なら 1 プロセスの中で全段を通す（http_helpers の keep-alive 接続をそのまま使う）
+#    大きいメディアや処理待ちが長引く場合は fast_path=False を返し、ステートマシンの段ごとの流れに任せる
+#  - initialize / post は rate_limiter で容量を予約してから呼び、応答の x-rate-limit-* から学習する
+#  - upload_all(): 複数メディアを並列にアップロードし（同じトークンの同時実行数に上限）、結果を元の順で返す
+#  - アップロードの途中経過と処理結果は convert_jobs に記録するので、段ごとの流れに移っても送信済み・処理済みは送り直さない
+import os
+import re
+import io
+import json
+import time
+import random
+import hashlib
+import threading
+import resource
+import mimetypes
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import boto3
+from ddb_helpers import (JobUpdate, get_x_upload, start_x_upload, ack_x_segments, finish_x_upload,
+                         get_media_probe, put_media_probe)
+from http_helpers import request
+from poll_helpers import poll, start_state
+from rate_limiter import RateLimited, account_key, acquire, observe
+
+REGION = os.getenv("AWS_REGION", "ap-northeast-1")
+API_BASE = os.getenv("X_API_BASE", "https://api.x.com").rstrip("/")
+OWN_BUCKETS = {b.strip() for b in (os.getenv("OWN_BUCKETS") or "").split(",") if b.strip()}
+SESSION_MARGIN_SEC = int(os.getenv("SESSION_MARGIN_SEC", "600"))  # 期限間近のセッションは再利用しない
+
+CHUNK_SIZE = 4 * 1024 * 1024  # 4MB（WordPress版と合わせる）
+APPEND_MODE = os.getenv("APPEND_MODE", "stream")  # stream: Range GET でチャンク毎に転送 / buffer: 従来の全量読み込み
+APPEND_CONCURRENCY = int(os.getenv("APPEND_CONCURRENCY", "1"))  # 同時に送るセグメント数
+APPEND_MAX_INFLIGHT_BYTES = int(os.getenv("APPEND_MAX_INFLIGHT_BYTES", str(64 * 1024 * 1024)))  # 同時に保持するチャンクの上限
+SEGMENT_RETRIES = int(os.getenv("SEGMENT_RETRIES", "2"))
+TIME_SAFETY_MS = int(os.getenv("TIME_SAFETY_MS", "10000"))  # Lambda 残り時間がこれを切ったら新規セグメントを投げない
+CHECK_TIMEOUT = float(os.getenv("POLL_CHECK_TIMEOUT", "10"))
+INIT_TIMEOUT = 30   # initialize / post の HTTP タイムアウト（rate_limiter の待ちはこの分を残り時間から引く）
+POST_TIMEOUT = 30
+MEDIA_PER_TOKEN = int(os.getenv("MEDIA_PER_TOKEN", "4"))  # 同じトークンで同時にアップロードするメディア数
+
+FAST_PATH_MAX_BYTES = int(os.getenv("FAST_PATH_MAX_BYTES", str(16 * 1024 * 1024)))  # publish() で一括処理するメディア合計の上限
+FAST_PATH_MIN_MS = int(os.getenv("FAST_PATH_MIN_MS", "20000"))  # 残り時間がこれを切っていたら一括処理を始めない
+
+BOUNDARY = "----itmarBoundary"
+EOL = "\r\n"
+
+s3 = boto3.client("s3", region_name=REGION) if OWN_BUCKETS else None
+
+_token_sems = {}   # トークンのハッシュ -> BoundedSemaphore
+_slots_lock = threading.Lock()
+
+
+class SegmentError(Exception):
+    def __init__(self, segment_index, code, response):
+        super().__init__(f"append_failed: HTTP {code}")
+        self.segment_index = segment_index
+        self.code = code
+        self.response = response
+
+
+class FetchError(Exception):
+    pass
+
+
+class RangeIgnored(Exception):
+    """配信元が Range を無視して 200 で全体を返した（body に全体を持つ。append は通しの 1 回に切り替える）"""
+    def __init__(self, body):
+        super().__init__("range_ignored")
+        self.body = body
+
+
+def _max_rss_mb():
+    # Linux の ru_maxrss は KB 単位
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _own_s3_object(media_url):
+    """自社バケットの URL なら (bucket, key) を返す（virtual-hosted / path 形式の両対応）"""
+    p = urllib.parse.urlparse(media_url)
+    host = p.netloc.split(":")[0].lower()
+    path = urllib.parse.unquote(p.path.lstrip("/"))
+    m = re.match(r"^(.+)\.s3[.-]([a-z0-9-]+\.)?amazonaws\.com$", host)
+    if m:
+        bucket, key = m.group(1), path
+    elif re.match(r"^s3[.-]([a-z0-9-]+\.)?amazonaws\.com$", host) and "/" in path:
+        bucket, key = path.split("/", 1)
+    else:
+        return None
+    return (bucket, key) if bucket in OWN_BUCKETS and key else None
+
+
+def _get_bytes(media_url, headers, timeout):
+    res = request("GET", media_url, headers=headers, timeout=timeout, parse="bytes")
+    if not res["ok"]:
+        raise FetchError(f"media GET failed: HTTP {res['status']} {res['body']}")
+    return res
+
+
+def _probe_total_bytes(media_url):
+    """Range: bytes=0-0 で Content-Range からオブジェクトサイズを得る（本文は 1 バイトだけ）"""
+    res = _get_bytes(media_url, {"Range": "bytes=0-0"}, 10)
+    content_range = res["headers"].get("content-range", "")  # 例: bytes 0-0/123456
+    if res["status"] == 206 and "/" in content_range:
+        return int(content_range.rsplit("/", 1)[1])
+    if res["status"] != 206:
+        raise RangeIgnored(res["body"])
+    return int(res["headers"].get("content-length", "0"))
+
+
+def _read_range(media_url, start, end):
+    """bytes=start-end を取得する。Range 非対応で 200 が返ったら RangeIgnored（セグメントごとに全体を取り直さない）"""
+    res = _get_bytes(media_url, {"Range": f"bytes={start}-{end}"}, 60)
+    if res["status"] == 206:
+        return res["body"]
+    raise RangeIgnored(res["body"])
+
+
+def _checkpoint(job_id, media_url, segment_index):
+    """送信済みセグメントを convert_jobs に記録（失敗してもアップロード自体は続ける）"""
+    try:
+        ack_x_segments(job_id, media_url, [segment_index])
+    except Exception as e:
+        print("WARN ack_x_segments:", e)
+
+
+def _error_result(base, err, done):
+    # 再実行時に completed_segments を渡せば、最初の未完了セグメントから再開できる
+    completed = sorted(done)
+    first_missing = next((i for i, s in enumerate(completed) if i != s), len(completed))
+    return {
+        **base,
+        "error": err,
+        "completed_segments": completed,
+        "next_segment": first_missing,
+    }
+
+
+def _finish(job_id, media_url, media_id, state):
+    """メディアの処理結果を convert_jobs のセッションに記録（再実行で処理済みを送り直さないため）"""
+    try:
+        finish_x_upload(job_id, media_url, media_id, state)
+    except Exception as e:
+        print("WARN finish_x_upload:", e)
+
+
+def _token_slots(access_token):
+    """同じトークンでの同時アップロード数を MEDIA_PER_TOKEN に抑えるセマフォ（プロセス内で共有）"""
+    key = hashlib.sha256((access_token or "").encode("utf-8")).hexdigest()[:16]
+    with _slots_lock:
+        return _token_sems.setdefault(key, threading.BoundedSemaphore(MEDIA_PER_TOKEN))
+
+
+def media_summary(items):
+    """
+    upload_all の結果をまとめる。
+      complete : 全項目が succeeded
+      media_ids: succeeded の media_id（元の順。complete のときはそのまま post に渡せる）
+      failed   : failed の index
+      pending  : まだ終わっていない（uploading / processing / waiting の）件数
+      wait_sec : 次に呼ぶまでの秒数（送信途中があれば 0、処理待ち・空き待ちだけならその最短）
+    """
+    media_ids = [it["media_id"] for it in items if it.get("status") == "succeeded"]
+    failed = [it["index"] for it in items if it.get("status") == "failed"]
+    waits = [int(it.get("wait_sec") or 0) for it in items if it.get("status") in ("processing", "waiting")]
+    uploading = any(it.get("status") == "uploading" for it in items)
+    return {
+        "complete": len(media_ids) == len(items),
+        "media_ids": media_ids,
+        "failed": failed,
+        "pending": len(waits) + sum(1 for it in items if it.get("status") == "uploading"),
+        "wait_sec": 0 if uploading or not waits else min(waits),
+    }
+
+
+def _media_type(media_url, probe):
+    # 署名クエリを除いたパスから推定し、S3 側の ContentType が具体的ならそちらを優先
+    mime_type, _ = mimetypes.guess_type(urllib.parse.urlparse(media_url).path)
+    if probe["mime"] and probe["mime"] not in ("application/octet-stream", "binary/octet-stream"):
+        mime_type = probe["mime"]
+    return mime_type or "application/octet-stream"
+
+
+def _media_category(mime_type):
+    if mime_type.startswith("video/"):
+        return "tweet_video"
+    if mime_type.startswith("image/"):
+        return "tweet_image"
+    return "tweet_media"
+
+
+class XPublisher:
+    """
+    1 つのアクセストークン・1 ジョブ分の X 投稿。
+      pub = XPublisher(access_token, job_id)
+      pub.initialize(media_url) → pub.append(...) → pub.finalize(media_id) → pub.poll_status(media_id) → pub.post(text, [media_id])
+    もしくは pub.publish(text, media_urls, context=context) で全段をまとめて実行する。
+    """
+
+    def __init__(self, access_token, job_id=""):
+        self.access_token = access_token
+        self.job_id = job_id or ""
+        self.account = account_key(access_token)
+
+    def _auth(self, content_type=None):
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        if content_type:
+            headers["Content-Type"] = content_type
+        return headers
+
+    # ===== 事前調査 =====
+    def probe(self, media_url):
+        """
+        オブジェクトのサイズ/MIME/ETag を本文を落とさずに調べる。
+          0) convert_jobs にキャッシュ済みならそれを使う
+          1) 自社バケットなら HeadObject
+          2) それ以外は Range: bytes=0-0 の GET（Content-Range から全体サイズを得る）
+        調べた結果は convert_jobs にキャッシュし、append と再実行時に再利用する。
+        """
+        job_id = self.job_id
+        try:
+            cached = get_media_probe(job_id, media_url)
+        except Exception as e:
+            print("WARN get_media_probe:", e)
+            cached = None
+        if cached and cached["size"] > 0:
+            return {**cached, "source": "cache"}
+
+        own = _own_s3_object(media_url) if s3 else None
+        if own:
+            head = s3.head_object(Bucket=own[0], Key=own[1])
+            probe = {
+                "size": int(head.get("ContentLength", 0)),
+                "mime": head.get("ContentType", ""),
+                "etag": (head.get("ETag") or "").strip('"'),
+                "source": "head_object",
+            }
+        else:
+            res = request("GET", media_url, headers={"Range": "bytes=0-0"}, timeout=10, parse="bytes")
+            if not res["ok"]:
+                raise RuntimeError(f"HTTP {res['status']} {res['body']}")
+            content_range = res["headers"].get("content-range", "")  # 例: bytes 0-0/123456
+            if res["status"] == 206 and "/" in content_range:
+                size = int(content_range.rsplit("/", 1)[1])
+            else:
+                size = int(res["headers"].get("content-length", "0"))
+            probe = {
+                "size": size,
+                "mime": (res["headers"].get("content-type") or "").split(";")[0].strip(),
+                "etag": (res["headers"].get("etag") or "").strip('"'),
+                "source": "range",
+            }
+
+        if probe["size"] > 0:
+            try:
+                put_media_probe(job_id, media_url, probe["size"], probe["mime"], probe["etag"])
+            except Exception as e:
+                print("WARN put_media_probe:", e)
+        return probe
+
+    # ===== initialize =====
+    def initialize(self, media_url, caption="", text="", probe=None, rate_reservation=None, context=None):
+        """
+        Initialize API でアップロードセッションを開く（同じオブジェクトの未失効セッションがあれば再利用）
+        容量がすぐに空かないときは rate_limit と rate_reservation を返す（wait_seconds 後にそれを付けて呼び直す）
+        """
+        job_id = self.job_id
+
+        # ===== サイズ/MIME 取得（本文はダウンロードしない） =====
+        if probe is None:
+            try:
+                probe = self.probe(media_url)
+            except Exception as e:
+                return {"error": f"failed to probe media size: {e}"}
+
+        total_bytes = probe["size"]
+        etag = probe["etag"]
+        print(f"probe source={probe['source']} size={total_bytes} mime={probe['mime']}")
+
+        if total_bytes == 0:
+            return {"error": "total_bytes=0 (object may not be accessible)"}
+
+        mime_type = _media_type(media_url, probe)
+        media_category = _media_category(mime_type)
+        result = {
+            "job_id": job_id,
+            "media_url": media_url,
+            "media_type": mime_type,
+            "media_category": media_category,
+            "total_bytes": total_bytes,
+            "caption": caption,
+            "text": text,
+            "access_token": self.access_token,
+        }
+
+        # ===== 同じオブジェクトの未失効セッションがあれば media_id を再利用 =====
+        try:
+            sess = get_x_upload(job_id, media_url)
+        except Exception as e:
+            print("WARN get_x_upload:", e)
+            sess = None
+        if (sess and sess["media_id"] and sess["total_bytes"] == total_bytes and sess["etag"] == etag
+                and sess["state"] != "failed" and sess["expires_at"] > int(time.time()) + SESSION_MARGIN_SEC):
+            print(f"resume media_id={sess['media_id']} segments_done={len(sess['segments'])}")
+            return {**result, "media_id": sess["media_id"], "status": "resumed"}
+
+        # ===== Initialize API 呼び出し =====
+        try:
+            acquire("x", self.account, "media", reservation=rate_reservation, context=context,
+                    call_timeout=INIT_TIMEOUT)
+        except RateLimited as e:
+            return {"error": "rate_limit", "wait_seconds": int(e.wait_sec) + 1, "rate_reservation": e.reservation}
+        payload = {
+            "media_type": mime_type,
+            "total_bytes": total_bytes,
+            "media_category": media_category
+        }
+        res = request("POST", f"{API_BASE}/2/media/upload/initialize", json_body=payload,
+                      headers=self._auth("application/json"), timeout=INIT_TIMEOUT)
+        code = res["status"]
+        body = res["body"]
+        if code:
+            observe("x", self.account, "media", code, res["headers"])
+
+        if code == 0:
+            return {"error": f"Request failed: {body.get('error')}"}
+        if code < 200 or code >= 300:
+            return {"error": f"HTTPError {code}", "body": json.dumps(body, ensure_ascii=False)}
+
+        media_id = body.get("data", {}).get("id")
+        if not media_id:
+            return {"error": "no media_id returned", "response": body}
+
+        # append の再開用にセッションを保存（media_id の有効期限も控える）
+        expires_after = int(body.get("data", {}).get("expires_after_secs") or 86400)
+        try:
+            start_x_upload(job_id, media_url, media_id, total_bytes, etag, int(time.time()) + expires_after)
+        except Exception as e:
+            print("WARN start_x_upload:", e)
+
+        return {**result, "media_id": media_id, "status": "initialized"}
+
+    # ===== append =====
+    def _post_segment(self, endpoint, media_type, segment_index, chunk):
+        """
+        multipart/form-data の前後だけを組み立て、チャンク本体はコピーせずそのまま送る。
+        戻り値: (status_code, raw_body)
+        """
+        head = io.BytesIO()
+        head.write(f"--{BOUNDARY}{EOL}".encode("utf-8"))
+        head.write(b'Content-Disposition: form-data; name="segment_index"')
+        head.write(f"{EOL}{EOL}{segment_index}{EOL}".encode("utf-8"))
+        head.write(f"--{BOUNDARY}{EOL}".encode("utf-8"))
+        head.write(
+            f'Content-Disposition: form-data; name="media"; filename="part{segment_index}"{EOL}'.encode("utf-8")
+        )
+        head.write(f"Content-Type: {media_type}{EOL}{EOL}".encode("utf-8"))
+        head_bytes = head.getvalue()
+        tail_bytes = f"{EOL}--{BOUNDARY}--{EOL}".encode("utf-8")
+
+        headers = self._auth(f"multipart/form-data; boundary={BOUNDARY}")
+        headers["Content-Length"] = str(len(head_bytes) + len(chunk) + len(tail_bytes))
+
+        # body に iterable を渡すと http.client が要素ごとに送信する（結合コピーが発生しない）
+        # 再試行は _send_with_retry 側で行う
+        res = request("POST", endpoint, body=[head_bytes, chunk, tail_bytes], headers=headers,
+                      timeout=60, retries=0, parse="text")
+        return res["status"], res["body"] if isinstance(res["body"], str) else json.dumps(res["body"])
+
+    def _send_with_retry(self, endpoint, media_type, segment_index, get_chunk):
+        """
+        1 セグメントを送信する。5xx / 429 / 通信エラー（status=0）は指数バックオフ（ジッタ付き）で再試行。
+        get_chunk は再試行のたびに呼ばれ、チャンクをその都度取得する（保持し続けない）。
+        """
+        last_code, last_raw = 0, ""
+        for i in range(SEGMENT_RETRIES + 1):
+            try:
+                code, raw = self._post_segment(endpoint, media_type, segment_index, get_chunk())
+            except FetchError as e:
+                code, raw = 0, str(e)
+            if 200 <= code < 300:
+                return
+            last_code, last_raw = code, raw
+            if 400 <= code < 500 and code != 429:
+                break
+            if i < SEGMENT_RETRIES:
+                time.sleep(random.uniform(0, 2 ** i))
+        raise SegmentError(segment_index, last_code, last_raw)
+
+    def _append_parallel(self, endpoint, media_type, media_url, total_bytes, done, concurrency, context):
+        """
+        未完了セグメントを Range GET → append でワーカープールから並列送信する。
+        done（完了済み segment_index の set）は送信成功のたびに更新され、convert_jobs にも記録される。
+        """
+        total_segments = (total_bytes + CHUNK_SIZE - 1) // CHUNK_SIZE
+        pending = [i for i in range(total_segments) if i not in done]
+
+        def _job(idx):
+            start = idx * CHUNK_SIZE
+            end = min(start + CHUNK_SIZE, total_bytes) - 1
+            self._send_with_retry(endpoint, media_type, idx, lambda: _read_range(media_url, start, end))
+            done.add(idx)
+            _checkpoint(self.job_id, media_url, idx)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            running = set()
+            for idx in pending:
+                if context and context.get_remaining_time_in_millis() < TIME_SAFETY_MS:
+                    break
+                # 同時実行数ぶん投入したら、どれかが終わるまで待って空いた分だけ補充する（保持チャンク ≒ concurrency 個）
+                while len(running) >= concurrency:
+                    finished, running = wait(running, return_when=FIRST_COMPLETED)
+                    for f in finished:
+                        if f.exception():
+                            raise f.exception()
+                running.add(pool.submit(_job, idx))
+            for f in running:
+                f.result()
+
+        return total_segments
+
+    def _append_buffered(self, endpoint, media_type, media_url, data, done):
+        """手元の全体 data から未完了セグメントを順に送る（buffer モードと、Range 非対応の配信元）"""
+        for segment_index, offset in enumerate(range(0, len(data), CHUNK_SIZE)):
+            if segment_index in done:
+                continue
+            chunk = data[offset:offset + CHUNK_SIZE]
+            self._send_with_retry(endpoint, media_type, segment_index, lambda: chunk)
+            done.add(segment_index)
+            _checkpoint(self.job_id, media_url, segment_index)
+        return (len(data) + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    def append(self, media_id, media_url, media_type="application/octet-stream", *, total_bytes=0,
+               completed_segments=(), append_mode=None, concurrency=None, context=None):
+        """
+        Endpoint: {API_BASE}/2/media/upload/{media_id}/append
+
+        append_mode（引数 または環境変数 APPEND_MODE）:
+          - "stream": Range GET で CHUNK_SIZE ずつ取得し、そのまま append へ送る
+                      concurrency（引数 / APPEND_CONCURRENCY）> 1 なら segment_index 単位で並列送信
+          - "buffer": 従来通り全体を読み込んでから順に分割送信する
+                      stream でも配信元が Range を無視したら（200 で全体が返ったら）その全体から順に送る
+        completed_segments を渡すと、そのセグメントは送信せずに残りだけを送る。
+        convert_jobs に同じ media_id のセッションが保存されていれば、記録済みのセグメントも送らない。
+        """
+        job_id = self.job_id
+        append_mode = (append_mode or APPEND_MODE).lower()
+        concurrency = int(concurrency or APPEND_CONCURRENCY)
+        # バイト予算を超えない範囲で同時実行数を決める
+        concurrency = max(1, min(concurrency, APPEND_MAX_INFLIGHT_BYTES // CHUNK_SIZE))
+        done = set(int(i) for i in (completed_segments or []))
+
+        endpoint = f"{API_BASE}/2/media/upload/{media_id}/append"
+        base = {
+            "job_id": job_id,
+            "media_id": media_id,
+            "media_url": media_url,
+            "media_type": media_type,
+            "endpoint": endpoint,
+        }
+        t0 = time.time()
+
+        # ===== 前回の途中経過（initialize が保存したセッション）を取り込む =====
+        try:
+            sess = get_x_upload(job_id, media_url)
+        except Exception as e:
+            print("WARN get_x_upload:", e)
+            sess = None
+        known_total = int(total_bytes or 0)
+        if sess and sess["media_id"] == str(media_id):
+            done |= sess["segments"]
+            known_total = known_total or sess["total_bytes"]
+            print(f"resume media_id={media_id} segments_done={len(done)}")
+        if not known_total:
+            # initialize が convert_jobs にキャッシュしたサイズを使う（再プローブしない）
+            try:
+                probe = get_media_probe(job_id, media_url)
+                known_total = probe["size"] if probe else 0
+            except Exception as e:
+                print("WARN get_media_probe:", e)
+
+        try:
+            if append_mode == "buffer":
+                # ===== 従来経路: 全量取得して順に送信 =====
+                data = _get_bytes(media_url, {}, 60)["body"]
+                total_bytes = len(data)
+                total_segments = self._append_buffered(endpoint, media_type, media_url, data, done)
+            else:
+                # ===== ストリーミング経路 =====
+                try:
+                    # initialize が返した total_bytes があればそれを使い、無ければ 1 バイトだけ取得して確認
+                    total_bytes = known_total or _probe_total_bytes(media_url)
+                    if total_bytes <= 0:
+                        return {"error": "total_bytes=0 (object may not be accessible)"}
+                    total_segments = self._append_parallel(endpoint, media_type, media_url,
+                                                           total_bytes, done, concurrency, context)
+                except RangeIgnored as e:
+                    print(f"[APPEND] source ignored Range; one sequential pass over {len(e.body)} bytes")
+                    append_mode = "stream(range_ignored)"
+                    total_bytes = len(e.body)
+                    if total_bytes <= 0:
+                        return {"error": "total_bytes=0 (object may not be accessible)"}
+                    total_segments = self._append_buffered(endpoint, media_type, media_url, e.body, done)
+
+            print(f"[APPEND] mode={append_mode} concurrency={concurrency} segments={len(done)}/{total_segments} "
+                  f"bytes={total_bytes} elapsed={round(time.time() - t0, 2)}s max_rss={_max_rss_mb()}MB")
+
+            if len(done) < total_segments:
+                # 残り時間不足で打ち切った
+                return _error_result(base, "append_incomplete: lambda time budget exhausted", done)
+
+            return {
+                "status": "appended",
+                "job_id": job_id,
+                "media_id": media_id,
+                "uploaded_segments": total_segments,
+                "total_bytes": total_bytes,
+                "media_type": media_type,
+                "access_token": self.access_token
+            }
+
+        except SegmentError as e:
+            res = _error_result(base, str(e), done)
+            res.update({"segment_index": e.segment_index, "response": e.response})
+            return res
+        except FetchError as e:
+            return _error_result(base, f"network_error: {str(e)}", done)
+        except Exception as e:
+            return _error_result(base, f"Unexpected error: {str(e)}", done)
+
+    # ===== finalize =====
+    def finalize(self, media_id, max_wait_sec=180):
+        """
+        即完了なら status=succeeded、処理中なら status=processing（poll_status に進む）を返す
+        """
+        res = request("POST", f"{API_BASE}/2/media/upload/{media_id}/finalize", headers=self._auth(),
+                      timeout=30, parse="text")
+        code = res["status"]
+        raw = res["body"]
+
+        if code < 200 or code >= 300:
+            return {"error": f"finalize_failed: HTTP {code}", "response": raw}
+
+        body = json.loads(raw)
+        data = body.get("data", {})
+        info = data.get("processing_info", {})
+
+        state = data.get("processing_state") or info.get("state") or "succeeded"
+        check_after = int(info.get("check_after_secs", 5))
+
+        # --- 即完了なら成功を返す ---
+        if state == "succeeded":
+            return {
+                "status": "succeeded",
+                "media_id": media_id,
+                "job_id": self.job_id,
+                "state": state
+            }
+
+        # --- 失敗ならエラーを返す ---
+        if state == "failed":
+            return {
+                "error": "media_processing_failed",
+                "state": state,
+                "response": raw
+            }
+
+        # --- 未完了: poll_status に進ませる ---
+        # 締め切り（max_wait_sec）は finalize の時点から数える
+        return {
+            "status": "processing",
+            "media_id": media_id,
+            "job_id": self.job_id,
+            "state": state,
+            "check_after": check_after,
+            "access_token": self.access_token,
+            "max_wait_sec": max_wait_sec,
+            "poll": start_state(max_wait_sec)
+        }
+
+    # ===== 処理待ち =====
+    def poll_status(self, media_id, max_wait_sec=180, state=None, context=None):
+        """
+        check_after_secs に従って（無ければ指数バックオフで）呼び出しの中で聞き直す。
+        残り時間に収まらない待ちになったら complete=False と check_after（次に呼ぶまでの秒数）を返す。
+        state には前回の戻り値の poll を渡す（初回は finalize が作ったもの / 無くても可）
+        """
+        query = urllib.parse.urlencode({"command": "STATUS", "media_id": media_id})
+        status_url = f"{API_BASE}/2/media/upload?{query}"
+        headers = self._auth()
+        print(f"status_url: {status_url}")
+
+        def check():
+            res = request("GET", status_url, headers=headers, timeout=CHECK_TIMEOUT)
+            if res["status"] == 0:
+                return True, None, {"complete": False, "error": f"URLError: {res['body'].get('error')}"}
+            if not res["ok"]:
+                body = json.dumps(res["body"], ensure_ascii=False)
+                return True, None, {"complete": False, "error": f"status_failed: HTTP {res['status']}", "body": body}
+
+            data = res["body"]
+            # 例: { "data": { "processing_info": { "state": "...", "check_after_secs": ... } } }
+            processing_info = data.get("data", {}).get("processing_info") or {}
+            state = processing_info.get("state")
+            check_after = processing_info.get("check_after_secs")
+            print(f"state: {state}, check_after: {check_after}")
+            # 成功 or 失敗状態なら complete を True に
+            complete = state == "succeeded" or state == "failed"
+            return complete, check_after, {"complete": complete, "status": state, "check_after": check_after}
+
+        try:
+            r = poll(check, state, context=context, max_wait_sec=max_wait_sec)
+        except Exception as e:
+            return {"complete": False, "error": str(e), "media_id": media_id, "job_id": self.job_id}
+
+        result = {
+            **r["result"],
+            "media_id": media_id,
+            "job_id": self.job_id,
+            "max_wait_sec": max_wait_sec,
+            "poll": r["poll"],
+        }
+        if "error" not in result:
+            result["access_token"] = self.access_token
+        if r["timed_out"]:
+            # 締め切りまでに終わらなかった: ループを抜けさせる
+            result.update({"complete": True, "status": "timeout", "error": "max_wait_exceeded"})
+        elif not r["done"]:
+            result["check_after"] = r["wait_sec"]   # ステートマシンの Wait はこの秒数
+        return result
+
+    # ===== post =====
+    def post(self, text, media_ids=(), rate_reservation=None, context=None):
+        """
+        Posts a tweet to X API v2.
+        Supports text-only or text+media posts.
+        Handles rate limit (429) gracefully.
+        投稿前に rate_limiter で容量を予約する。すぐに空かないときは投稿せずに rate_limit を返す
+        （wait_seconds 後に、返した rate_reservation を付けて呼び直せば予約した順番で投稿できる）
+        """
+        job_id = self.job_id
+        post_data = {"text": text}
+        if media_ids:
+            # X expects media_ids as an array
+            post_data["media"] = {"media_ids": list(media_ids)}
+
+        try:
+            acquire("x", self.account, "post", reservation=rate_reservation, context=context,
+                    call_timeout=POST_TIMEOUT)
+        except RateLimited as e:
+            wait_seconds = int(e.wait_sec) + 1
+            return {
+                "error": "rate_limit",
+                "message": f"Xの投稿制限に近いため待機します。あと約 {(wait_seconds + 59) // 60} 分後に再試行してください。",
+                "wait_seconds": wait_seconds,
+                "retry_after_timestamp": int(time.time()) + wait_seconds,
+                "rate_reservation": e.reservation,
+                "job_id": job_id,
+            }
+
+        # 投稿は二重投稿になり得るので再試行しない
+        res = request("POST", f"{API_BASE}/2/posts", json_body=post_data,
+                      headers=self._auth("application/json"), timeout=POST_TIMEOUT, retries=0)
+        code = res["status"]
+        if code:
+            observe("x", self.account, "post", code, res["headers"])
+
+        if code == 0:
+            return {
+                "error": "network_error",
+                "message": res["body"].get("error", "")
+            }
+
+        # --- レート制限対応 ---
+        if code == 429:
+            retry_after_header = res["headers"].get("x-rate-limit-reset")
+            if retry_after_header:
+                try:
+                    retry_after_ts = int(retry_after_header)
+                    wait_seconds = max(0, retry_after_ts - int(time.time()))
+                    wait_minutes = (wait_seconds + 59) // 60
+                    return {
+                        "error": "rate_limit",
+                        "message": f"Xの投稿制限に達しました。あと約 {wait_minutes} 分後に再試行してください。",
+                        "wait_seconds": wait_seconds,
+                        "retry_after_timestamp": retry_after_ts
+                    }
+                except ValueError:
+                    pass
+            return {
+                "error": "rate_limit",
+                "message": "Xの投稿制限に達しました。しばらく待って再試行してください。",
+                "status_code": code
+            }
+
+        if not res["ok"]:
+            return {
+                "error": f"HTTPError: {code}",
+                "response": json.dumps(res["body"], ensure_ascii=False)
+            }
+
+        # --- レスポンス解析 ---
+        response_json = res["body"]
+        if "raw" in response_json:
+            return {
+                "error": "invalid_json",
+                "raw_response": response_json["raw"]
+            }
+
+        # --- 成功判定 ---
+        if "data" in response_json and "id" in response_json["data"]:
+            (JobUpdate(job_id)
+                .status(response_json["data"]["id"])
+                .set(x_post_id=response_json["data"]["id"])
+                .timing("post_x", res["timings"].get("ttfb_ms"))
+                .commit())
+            return {
+                "status": "success",
+                "job_id": job_id,
+                "x_post_id": response_json["data"]["id"],
+            }
+
+        # --- エラー処理 ---
+        JobUpdate(job_id).status("ERROR,post_failed").set(error_detail=json.dumps(response_json, ensure_ascii=False)[:500]).commit()
+        return {
+            "error": "post_failed",
+            "status_code": code,
+            "job_id": job_id,
+            "x_post_id": response_json.get("data", {}).get("id"),
+        }
+
+    # ===== メディア 1 件分（initialize → append → finalize → 処理待ち） =====
+    def upload_media(self, media_url, *, probe=None, previous=None, context=None, max_wait_sec=180):
+        """
+        戻り値（項目ごとの結果。次の呼び出しで previous にそのまま渡せば続きから進める）:
+          {"media_url", "status": "succeeded", "media_id"}
+          {"media_url", "status": "processing", "media_id", "poll", "wait_sec"}  ← X 側の処理待ちが続いている
+          {"media_url", "status": "uploading", "media_id"}                       ← 時間切れ。送信済みセグメントは記録済み
+          {"media_url", "status": "waiting", "wait_sec"}                          ← レート制限の空き待ち
+          {"media_url", "status": "failed", "stage", "error", "detail"}
+        """
+        t0 = time.time()
+        prev = previous or {}
+        if prev.get("status") == "succeeded" and prev.get("media_id"):
+            return prev
+
+        item = {"media_url": media_url}
+        media_id = prev.get("media_id") if prev.get("status") == "processing" else None
+        poll_state = prev.get("poll")
+
+        def _failed(stage, res):
+            print(f"[X_MEDIA] failed stage={stage} url={media_url} error={res.get('error')}")
+            return {**item, "status": "failed", "stage": stage, "error": res.get("error"),
+                    "detail": {k: v for k, v in res.items() if k not in ("error", "access_token", "poll")}}
+
+        if not media_id:
+            # 前の呼び出し（別の実行を含む）で処理まで済んでいれば送り直さない
+            try:
+                sess = get_x_upload(self.job_id, media_url)
+            except Exception as e:
+                print("WARN get_x_upload:", e)
+                sess = None
+            if (sess and sess["state"] == "succeeded"
+                    and sess["expires_at"] > int(time.time()) + SESSION_MARGIN_SEC):
+                return {**item, "status": "succeeded", "media_id": sess["media_id"]}
+
+            init = self.initialize(media_url, probe=probe, rate_reservation=prev.get("rate_reservation"),
+                                   context=context)
+            if init.get("error") == "rate_limit":
+                return {**item, "status": "waiting", "wait_sec": init["wait_seconds"],
+                        "rate_reservation": init.get("rate_reservation")}
+            if "error" in init:
+                return _failed("initialize", init)
+            media_id = init["media_id"]
+            item["media_id"] = media_id
+
+            app = self.append(media_id, media_url, init["media_type"], total_bytes=init["total_bytes"],
+                              context=context)
+            if app.get("error", "").startswith("append_incomplete"):
+                return {**item, "status": "uploading"}
+            if "error" in app:
+                return _failed("append", app)
+
+            fin = self.finalize(media_id, max_wait_sec)
+            if "error" in fin:
+                if fin["error"] == "media_processing_failed":
+                    _finish(self.job_id, media_url, media_id, "failed")
+                return _failed("finalize", fin)
+            if fin["status"] == "succeeded":
+                _finish(self.job_id, media_url, media_id, "succeeded")
+                print(f"[X_MEDIA] succeeded media_id={media_id} elapsed={int((time.time() - t0) * 1000)}ms")
+                return {**item, "status": "succeeded"}
+            poll_state = fin["poll"]
+
+        item["media_id"] = media_id
+        st = self.poll_status(media_id, max_wait_sec, poll_state, context)
+        if "error" in st:
+            return _failed("poll", st)
+        if not st["complete"]:
+            return {**item, "status": "processing", "poll": st["poll"], "wait_sec": st["check_after"]}
+        if st["status"] != "succeeded":
+            _finish(self.job_id, media_url, media_id, "failed")
+            return _failed("poll", {"error": "media_processing_failed", "state": st["status"]})
+        _finish(self.job_id, media_url, media_id, "succeeded")
+        print(f"[X_MEDIA] succeeded media_id={media_id} elapsed={int((time.time() - t0) * 1000)}ms")
+        return {**item, "status": "succeeded"}
+
+    # ===== 複数メディアの並列アップロード =====
+    def upload_all(self, media_urls, *, previous=(), context=None, max_wait_sec=180, probes=None):
+        """
+        media_urls を並列にアップロードする（同じトークンでの同時実行は MEDIA_PER_TOKEN 件まで）。
+        戻り値は media_urls と同じ順の項目ごとの結果（index 付き）。
+        previous（前回の戻り値）で succeeded の項目は送り直さず、processing の項目は処理待ちの続きから進める。
+        同じ URL が重ねて指定されたら 1 回だけ送る。
+        """
+        prev_by_url = {p.get("media_url"): p for p in (previous or ()) if isinstance(p, dict)}
+        probes = probes or {}
+        urls = list(dict.fromkeys(media_urls))
+        slots = _token_slots(self.access_token)
+
+        def _one(url):
+            prev = prev_by_url.get(url)
+            if prev and prev.get("status") == "succeeded" and prev.get("media_id"):
+                return prev
+            with slots:
+                if context and context.get_remaining_time_in_millis() < TIME_SAFETY_MS:
+                    # 始める時間が無い: 次の呼び出しに回す
+                    if prev and prev.get("status") == "processing":
+                        return prev
+                    return {"media_url": url, "status": "uploading"}
+                try:
+                    return self.upload_media(url, probe=probes.get(url), previous=prev, context=context,
+                                             max_wait_sec=max_wait_sec)
+                except Exception as e:
+                    return {"media_url": url, "status": "failed", "stage": "upload",
+                            "error": f"Unexpected error: {str(e)}"}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(urls), MEDIA_PER_TOKEN))) as pool:
+            results = dict(zip(urls, pool.map(_one, urls)))
+        items = [{**results[url], "index": i} for i, url in enumerate(media_urls)]
+        print(f"[X_MEDIA] items={len(items)} " + " ".join(f"{it['index']}:{it['status']}" for it in items))
+        return items
+
+    # ===== 一括実行（fast path） =====
+    def publish(self, text, media_urls=(), *, caption="", context=None, max_wait_sec=180, rate_reservation=None):
+        """
+        メディアのアップロード（並列）→ post を 1 プロセスで続けて行う。
+        戻り値:
+          {"status": "success", "x_post_id", "media_ids", "fast_path": True, "timings_ms"}
+          {"fast_path": False, "stage": "upload_media", "reason", "media"?}
+                  ← 大きい/時間が足りない/処理待ちが長引いた。lambda_x_upload_media に media を渡して続ける
+          {"error": ..., "stage": ...}   ← 失敗（upload_media の失敗は項目ごとの結果を media に含む）
+                                           error="rate_limit" は media_ids と rate_reservation を付けて lambda_post_x へ
+        """
+        t0 = time.time()
+        timings = {}
+
+        def _lap(stage, t):
+            timings[stage] = timings.get(stage, 0) + int((time.time() - t) * 1000)
+
+        def _fallback(stage, reason, **extra):
+            print(f"[X_PUBLISH] fallback stage={stage} reason={reason} timings={timings}")
+            return {"fast_path": False, "stage": stage, "reason": reason, "job_id": self.job_id,
+                    "timings_ms": timings, **extra}
+
+        if context and context.get_remaining_time_in_millis() < FAST_PATH_MIN_MS:
+            return _fallback("upload_media", "time_budget")
+
+        # --- 対象の判定（本文は落とさず、サイズだけ見る） ---
+        t = time.time()
+        probes = {}
+        for url in dict.fromkeys(media_urls):
+            try:
+                probes[url] = self.probe(url)
+            except Exception as e:
+                return {"error": f"failed to probe media size: {e}", "stage": "probe", "media_url": url}
+        _lap("probe", t)
+        total = sum(p["size"] for p in probes.values())
+        if total > FAST_PATH_MAX_BYTES:
+            return _fallback("upload_media", f"media too large ({total} bytes)")
+
+        t = time.time()
+        items = self.upload_all(media_urls, context=context, max_wait_sec=max_wait_sec, probes=probes)
+        _lap("upload", t)
+        summary = media_summary(items)
+        if summary["failed"]:
+            return {"error": "media_upload_failed", "stage": "upload_media", "job_id": self.job_id,
+                    "failed": summary["failed"], "media": items}
+        if not summary["complete"]:
+            # 呼び出しの中では終わらなかった: 送信済み/処理済みの項目はそのまま引き継ぐ
+            return _fallback("upload_media", "media_processing", media=items, wait_sec=summary["wait_sec"])
+
+        t = time.time()
+        res = self.post(text, summary["media_ids"], rate_reservation, context=context)
+        _lap("post", t)
+        print(f"[X_PUBLISH] media={len(items)} bytes={total} timings={timings} "
+              f"elapsed={int((time.time() - t0) * 1000)}ms")
+        if "error" in res:
+            return {**res, "stage": "post", "media_ids": summary["media_ids"]}
+        return {**res, "media_ids": summary["media_ids"], "fast_path": True, "timings_ms": timings}
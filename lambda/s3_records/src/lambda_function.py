@@ -0,0 +1,59 @@
+# s3_records.py
+# S3 イベント通知のレコードを並行に処理する共通部分（レイヤで配布。convert-worker / convert_notifier が使う）
+#  - 直接起動（Records に s3）と SQS 経由（body に S3 通知 JSON）の両方を受ける
+#  - SQS 経由なら失敗したメッセージを batchItemFailures で返し（部分再試行）、
+#    直接起動で失敗があれば例外にして Lambda の非同期リトライに任せる
+#  - 非同期リトライはイベント全体をやり直すので、fn は成功済みのレコードをもう一度処理しても結果が変わらないこと
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+
+def iter_records(event):
+    """
+    S3 イベントの Records を (messageId, s3レコード) で返す。
+    SQS 経由（body に S3 通知 JSON）の場合は messageId を付け、直接起動なら None。
+    """
+    for rec in event.get("Records", []):
+        if "s3" in rec:
+            yield None, rec
+            continue
+        mid = rec.get("messageId")
+        try:
+            inner = json.loads(rec.get("body") or "{}")
+        except Exception as e:
+            print("ERROR bad SQS body:", e)
+            yield mid, {"_error": f"bad body: {e}"}
+            continue
+        for r in inner.get("Records", []):  # s3:TestEvent には Records が無い
+            yield mid, r
+
+
+def run_records(event, fn, concurrency=1):
+    """
+    fn(s3レコード) を concurrency 並列で実行し、結果を集める。
+    fn の戻り値は {"ok": bool, ...}。例外は ok=False として扱う。
+    戻り値: {"batchItemFailures": [...], "results": [...]}
+    """
+    items = list(iter_records(event))
+
+    def _one(item):
+        mid, rec = item
+        if "_error" in rec:
+            return mid, {"ok": False, "error": rec["_error"]}
+        try:
+            return mid, fn(rec)
+        except Exception as e:
+            print("ERROR record:", type(e).__name__, e)
+            return mid, {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items) or 1))) as pool:
+        results = list(pool.map(_one, items))
+
+    failed = [(mid, r) for mid, r in results if not r.get("ok")]
+    print(f"[RECORDS] total={len(results)} failed={len(failed)}")
+    if failed and any(mid is None for mid, _ in failed):
+        raise RuntimeError(f"{len(failed)}/{len(results)} records failed: {[r.get('error') for _, r in failed]}")
+    return {
+        "batchItemFailures": [{"itemIdentifier": mid} for mid in dict.fromkeys(m for m, _ in failed)],
+        "results": [r for _, r in results],
+    }
@@ -0,0 +1,121 @@
+# 各 Lambda を moto の上で import して動かすための共通 fixture
+# 関数は src/lambda_function.py、レイヤーは関数ディレクトリ内のコピー（<fn>/<layer-dir>/<module>.py）を読む
+import os, sys, time, importlib.util
+import boto3
+import pytest
+from moto import mock_aws
+
+LAMBDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REGION = "ap-northeast-1"
+ACCOUNT = "123456789012"
+# 関数ごとに読み直すレイヤーのモジュール（モジュール変数に boto3 クライアントやキャッシュを持つため）
+LAYER_MODULES = ("ddb_helpers", "http_helpers", "token_cipher", "job_store", "poll_helpers", "x_publisher",
+                 "rate_limiter", "s3_records")
+
+
+class FakeContext:
+    """Lambda の context（残り時間だけ。deadline は time.time() 基準の締め切り）"""
+
+    def __init__(self, remaining_ms):
+        self.deadline = time.time() + remaining_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.time()) * 1000))
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """moto の AWS（認証情報はダミー）"""
+    for k, v in {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_SESSION_TOKEN": "testing",
+                 "AWS_DEFAULT_REGION": REGION, "AWS_REGION": REGION}.items():
+        monkeypatch.setenv(k, v)
+    with mock_aws():
+        yield
+
+
+@pytest.fixture
+def load_lambda(monkeypatch):
+    """
+    load_lambda("lambda_start", STATE_MACHINE_ARN=...) → lambda_function モジュール
+    環境変数は import 前に入れる（各関数はモジュールの読み込み時に読む）
+    """
+    def _load(fn, **env):
+        for k, v in env.items():
+            monkeypatch.setenv(k, str(v))
+        base = os.path.join(LAMBDA_DIR, fn)
+        for d in sorted(os.listdir(base)):
+            if d != "src" and os.path.isdir(os.path.join(base, d)):
+                monkeypatch.syspath_prepend(os.path.join(base, d))
+        for m in LAYER_MODULES:
+            sys.modules.pop(m, None)
+        spec = importlib.util.spec_from_file_location(f"{fn}_under_test", os.path.join(base, "src", "lambda_function.py"))
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        return mod
+
+    yield _load
+    for m in LAYER_MODULES:
+        sys.modules.pop(m, None)
+
+
+def _table(name, hash_key, attrs=(), indexes=()):
+    """attrs: [(名前, 型)]、indexes: [(IndexName, HASH, RANGE or None, ProjectionType)]"""
+    defs = {hash_key: "S", **dict(attrs)}
+    gsis = []
+    for index, h, r, proj in indexes:
+        gsis.append({"IndexName": index,
+                     "KeySchema": [{"AttributeName": h, "KeyType": "HASH"}]
+                                  + ([{"AttributeName": r, "KeyType": "RANGE"}] if r else []),
+                     "Projection": {"ProjectionType": proj}})
+    kwargs = {"GlobalSecondaryIndexes": gsis} if gsis else {}
+    return boto3.resource("dynamodb", region_name=REGION).create_table(
+        TableName=name, KeySchema=[{"AttributeName": hash_key, "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": k, "AttributeType": t} for k, t in defs.items()],
+        BillingMode="PAY_PER_REQUEST", **kwargs)
+
+
+@pytest.fixture
+def jobs_table(aws):
+    """convert_jobs（本番と同じ GSI）"""
+    return _table("convert_jobs", "job_id",
+                  attrs=[("site_url", "S"), ("wp_id", "S"), ("updated_at", "N"), ("sched_queue", "S"),
+                         ("publish_at", "N")],
+                  indexes=[("site_url-updated_at-index", "site_url", "updated_at", "ALL"),
+                           ("wp_id-updated_at-index", "wp_id", "updated_at", "ALL"),
+                           ("sched_queue-publish_at-index", "sched_queue", "publish_at", "KEYS_ONLY")])
+
+
+@pytest.fixture
+def src_table(aws):
+    """video_jobs_by_src（変換の状態）"""
+    return _table("video_jobs_by_src", "src_key")
+
+
+@pytest.fixture
+def queues_table(aws):
+    """publish_queues（予約投稿の待ち行列）"""
+    return _table("publish_queues", "queue_key")
+
+
+@pytest.fixture
+def buckets(aws):
+    """入力 / 出力バケット"""
+    s3 = boto3.client("s3", region_name=REGION)
+    for b in ("upload-bucket", "converted-bucket"):
+        s3.create_bucket(Bucket=b, CreateBucketConfiguration={"LocationConstraint": REGION})
+    return s3
+
+
+@pytest.fixture
+def state_machines(aws):
+    """{"x": arn, "ig": arn}（Pass だけのステートマシン）"""
+    sfn = boto3.client("stepfunctions", region_name=REGION)
+    defn = '{"StartAt": "P", "States": {"P": {"Type": "Pass", "End": true}}}'
+    role = f"arn:aws:iam::{ACCOUNT}:role/sf"
+    return {name: sfn.create_state_machine(name=name, definition=defn, roleArn=role)["stateMachineArn"]
+            for name in ("x", "ig")}
+
+
+@pytest.fixture
+def kms_key(aws):
+    return boto3.client("kms", region_name=REGION).create_key()["KeyMetadata"]["KeyId"]
@@ -0,0 +1,49 @@
+# cleanup の sweep: 使い終わったジョブの素材だけ消し、ジョブ無しのアップロードは残す
+import pytest
+
+
+@pytest.fixture
+def cleanup(load_lambda, jobs_table, buckets):
+    return load_lambda("lambda_cleanup", IN_BUCKET="upload-bucket", OUT_BUCKET="converted-bucket")
+
+
+def _put(s3, bucket, key, transcode=False):
+    s3.put_object(Bucket=bucket, Key=key, Body=b"x", **({"Tagging": "transcode=true"} if transcode else {}))
+
+
+def _keys(s3, bucket):
+    return sorted(o["Key"] for o in s3.list_objects_v2(Bucket=bucket).get("Contents", []))
+
+
+@pytest.mark.parametrize("status", ["pending", "scheduled", "processing", "uploading", "converting", "publishing"])
+def test_active_job_media_is_kept(cleanup, jobs_table, buckets, status):
+    _put(buckets, "upload-bucket", "in/a.mp4", transcode=True)
+    jobs_table.put_item(Item={"job_id": "j", "status": status, "in_key": "in/a.mp4"})
+    r = cleanup.lambda_handler({"mode": "sweep", "min_age_sec": 0}, None)
+    assert r["deleted"] == 0 and _keys(buckets, "upload-bucket") == ["in/a.mp4"]
+
+
+def test_sweep_deletes_only_finished_or_tagged_orphans(cleanup, jobs_table, buckets):
+    _put(buckets, "upload-bucket", "in/done.mp4", transcode=True)
+    _put(buckets, "upload-bucket", "in/failed.mp4")
+    _put(buckets, "upload-bucket", "in/deleted-job.mp4", transcode=True)   # ジョブは削除済み
+    _put(buckets, "upload-bucket", "in/wp-media.jpg")                       # ジョブ無しのアップロード（op=get で読む）
+    _put(buckets, "converted-bucket", "converted/done.mp4")
+    _put(buckets, "converted-bucket", "converted/unknown.mp4")
+    jobs_table.put_item(Item={"job_id": "j1", "status": "17890", "in_key": "in/done.mp4",
+                              "out_key": "converted/done.mp4"})
+    jobs_table.put_item(Item={"job_id": "j2", "status": "ERROR,publish,400", "in_key": "in/failed.mp4"})
+
+    dry = cleanup.lambda_handler({"mode": "sweep", "min_age_sec": 0, "dry_run": True}, None)
+    assert sorted(o["key"] for o in dry["orphans"]) == ["converted/done.mp4", "in/deleted-job.mp4", "in/done.mp4",
+                                                        "in/failed.mp4"]
+    r = cleanup.lambda_handler({"mode": "sweep", "min_age_sec": 0}, None)
+    assert r["deleted"] == 4
+    assert _keys(buckets, "upload-bucket") == ["in/wp-media.jpg"]
+    assert _keys(buckets, "converted-bucket") == ["converted/unknown.mp4"]
+
+
+def test_recent_objects_are_kept(cleanup, jobs_table, buckets):
+    _put(buckets, "upload-bucket", "in/done.mp4", transcode=True)
+    jobs_table.put_item(Item={"job_id": "j1", "status": "17890", "in_key": "in/done.mp4"})
+    assert cleanup.lambda_handler({"mode": "sweep"}, None)["deleted"] == 0
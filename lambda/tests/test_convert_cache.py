@@ -0,0 +1,51 @@
+# convert-worker の変換キャッシュ: 容量の確認は合計サイズのカウンタで行い、上限を超えたときだけ全件を読む
+import boto3
+import pytest
+
+from conftest import REGION
+
+
+@pytest.fixture
+def worker(load_lambda, buckets, monkeypatch):
+    boto3.resource("dynamodb", region_name=REGION).create_table(
+        TableName="convert_cache", KeySchema=[{"AttributeName": "cache_key", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "cache_key", "AttributeType": "S"}], BillingMode="PAY_PER_REQUEST")
+    mod = load_lambda("lambda-convert-worker", JOB_STORE_BACKEND="memory", UPLOAD_BUCKET="upload-bucket",
+                      CACHE_TABLE="convert_cache", CACHE_MAX_BYTES="250")
+    buckets.put_object(Bucket="converted-bucket", Key="converted/a.mp4", Body=b"x" * 100)
+    mod.scans = 0
+    real = mod.cache_table.scan
+
+    def scan(**kw):
+        mod.scans += 1
+        return real(**kw)
+    monkeypatch.setattr(mod.cache_table, "scan", scan)
+    return mod
+
+
+def _total(mod):
+    return int(mod.cache_table.get_item(Key={"cache_key": mod.CACHE_TOTAL_KEY})["Item"]["total_bytes"])
+
+
+def test_sweep_runs_only_over_the_cap(worker, monkeypatch):
+    clock = iter(range(1000, 2000))
+    monkeypatch.setattr(worker.time, "time", lambda: next(clock))
+    for k in ("k1", "k2"):
+        worker._cache_put(k, "converted-bucket", "converted/a.mp4", 100)
+    assert worker.scans == 0 and _total(worker) == 200
+
+    worker._cache_put("k3", "converted-bucket", "converted/a.mp4", 100)
+    assert worker.scans == 1 and _total(worker) == 200
+    keys = {i["cache_key"] for i in worker.cache_table.scan()["Items"]} - {worker.CACHE_TOTAL_KEY}
+    assert keys == {"k2", "k3"}
+
+
+def test_sweep_corrects_drift_from_ttl_deletes(worker):
+    worker._cache_put("k1", "converted-bucket", "converted/a.mp4", 100)
+    worker._cache_put("k2", "converted-bucket", "converted/a.mp4", 100)
+    # TTL で消えた（カウンタは減らない）
+    worker.cache_table.delete_item(Key={"cache_key": "k1"})
+    worker._cache_put("k3", "converted-bucket", "converted/a.mp4", 100)
+    assert worker.scans == 1 and _total(worker) == 200
+    keys = {i["cache_key"] for i in worker.cache_table.scan()["Items"]} - {worker.CACHE_TOTAL_KEY}
+    assert keys == {"k2", "k3"}
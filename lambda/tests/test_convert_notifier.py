@@ -0,0 +1,79 @@
+# convert_notifier: レコード単位の失敗（SQS は batchItemFailures、直接起動は例外）と、やり直しで二重に起動しないこと
+import json, base64
+import boto3
+import pytest
+
+from conftest import REGION
+
+
+@pytest.fixture
+def notifier(load_lambda, jobs_table, buckets, state_machines):
+    return load_lambda("lambda_convert_notifier", SF_IG_POST_ARN=state_machines["ig"])
+
+
+def _put(s3, key, job_id):
+    s3.put_object(Bucket="converted-bucket", Key=key, Body=b"v", Metadata={"job-id": job_id})
+
+
+def _rec(key):
+    return {"s3": {"bucket": {"name": "converted-bucket"}, "object": {"key": key}}}
+
+
+def _executions(arn):
+    return boto3.client("stepfunctions", region_name=REGION).list_executions(stateMachineArn=arn)["executions"]
+
+
+def test_direct_retry_does_not_start_twice(notifier, buckets, state_machines):
+    _put(buckets, "converted/a.mp4", "job-a")
+    event = {"Records": [_rec("converted/a.mp4"), _rec("converted/missing.mp4")]}
+
+    # 1 件失敗 → 非同期リトライでイベント全体がもう一度来る
+    for _ in range(2):
+        with pytest.raises(RuntimeError, match="1/2 records failed"):
+            notifier.lambda_handler(event, None)
+    assert len(_executions(state_machines["ig"])) == 1
+
+    _put(buckets, "converted/missing.mp4", "job-b")
+    r = notifier.lambda_handler(event, None)
+    # 同じ名前の実行があれば、入力が同じなら既存のまま・違えば ExecutionAlreadyExists（どちらも成功扱い）
+    assert all(x["ok"] and x["state"] in ("sf_started", "sf_already_started") for x in r["results"])
+    assert sorted(e["name"].split("-")[1] for e in _executions(state_machines["ig"])) == ["a", "b"]
+
+
+def test_already_exists_is_success(notifier, buckets, monkeypatch):
+    _put(buckets, "converted/a.mp4", "job-a")
+
+    def _exists(**kw):
+        raise notifier.sf.exceptions.ExecutionAlreadyExists(
+            {"Error": {"Code": "ExecutionAlreadyExists", "Message": kw["name"]}}, "StartExecution")
+    monkeypatch.setattr(notifier.sf, "start_execution", _exists)
+    r = notifier.lambda_handler({"Records": [_rec("converted/a.mp4")]}, None)
+    assert r["results"][0] == {"ok": True, "key": "converted/a.mp4", "state": "sf_already_started"}
+
+
+def test_sqs_partial_batch_failure(notifier, buckets):
+    _put(buckets, "converted/a.mp4", "job-a")
+    body = lambda key: json.dumps({"Records": [_rec(key)]})
+    event = {"Records": [{"messageId": "m1", "body": body("converted/a.mp4")},
+                         {"messageId": "m2", "body": body("converted/missing.mp4")},
+                         {"messageId": "m3", "body": "{not json"},
+                         {"messageId": "m4", "body": json.dumps({"Event": "s3:TestEvent"})}]}
+    r = notifier.lambda_handler(event, None)
+    assert r["batchItemFailures"] == [{"itemIdentifier": "m2"}, {"itemIdentifier": "m3"}]
+    assert [x["ok"] for x in r["results"]] == [True, False, False]
+
+
+def test_webhook_enqueue_failure_retries_record(load_lambda, jobs_table, buckets, monkeypatch):
+    notifier = load_lambda("lambda_convert_notifier", WEBHOOK_QUEUE_URL="https://sqs.invalid/outbox")
+    buckets.put_object(Bucket="converted-bucket", Key="converted/a.mp4", Body=b"v",
+                       Metadata={"cb-b64": base64.b64encode(b"https://wp.example/hook").decode()})
+
+    def _down(**kw):
+        raise RuntimeError("sqs unavailable")
+    monkeypatch.setattr(notifier.sqs, "send_message", _down)
+    monkeypatch.setattr(notifier, "request", lambda *a, **k: pytest.fail("webhook POSTed inline"))
+
+    r = notifier.lambda_handler({"Records": [{"messageId": "m1", "body": json.dumps({"Records": [
+        _rec("converted/a.mp4")]})}]}, None)
+    assert r["batchItemFailures"] == [{"itemIdentifier": "m1"}]
+    assert "enqueue webhook" in r["results"][0]["error"]
@@ -0,0 +1,73 @@
+# convert-worker のパイプライン: S3 の Range GET → ffmpeg の stdin、stdout → S3 マルチパート
+# ffmpeg の代わりに stdin をそのまま stdout へ写す python を動かす
+import sys, struct
+import pytest
+
+CAT = [sys.executable, "-c", "import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)"]
+DATA = bytes(range(256)) * 30
+
+
+@pytest.fixture
+def worker(load_lambda, buckets, monkeypatch):
+    mod = load_lambda("lambda-convert-worker", JOB_STORE_BACKEND="memory", UPLOAD_BUCKET="upload-bucket")
+    monkeypatch.setattr(mod, "READ_CHUNK", 1000)
+    monkeypatch.setattr(mod.time, "sleep", lambda s: None)
+    buckets.put_object(Bucket="upload-bucket", Key="in/a.mp4", Body=DATA)
+    mod.ranges = []
+    real = mod.s3.get_object
+
+    def get_object(**kw):
+        mod.ranges.append(kw.get("Range"))
+        return real(**kw)
+    monkeypatch.setattr(mod.s3, "get_object", get_object)
+    return mod
+
+
+def _encode(worker, tmp_path):
+    built = []
+
+    def build(dst, fragmented):
+        built.append((dst, fragmented))
+        return CAT
+    feeder = lambda proc: worker._feed_stdin(proc, "upload-bucket", "in/a.mp4", len(DATA))
+    ok = worker._encode_to_s3(build, "converted-bucket", "converted/a.mp4", {"job-id": "j1"}, str(tmp_path), {},
+                              feeder=feeder, stream=True)
+    return ok, built
+
+
+def test_pipe_input_streams_into_multipart_output(worker, buckets, tmp_path):
+    ok, built = _encode(worker, tmp_path)
+    assert ok and built == [("pipe:1", True)]
+    assert worker.ranges == [f"bytes={s}-{min(s + 999, len(DATA) - 1)}" for s in range(0, len(DATA), 1000)]
+    obj = buckets.get_object(Bucket="converted-bucket", Key="converted/a.mp4")
+    assert obj["Body"].read() == DATA and obj["Metadata"] == {"job-id": "j1"}
+    assert not buckets.list_multipart_uploads(Bucket="converted-bucket").get("Uploads")
+
+
+def test_feed_failure_aborts_the_multipart_upload(worker, buckets, tmp_path, monkeypatch):
+    """入力の読み出しが途中で失敗したら、ffmpeg が正常終了しても途切れた出力を完成させない"""
+    real = worker.s3.get_object
+
+    def flaky(**kw):
+        if kw["Range"].startswith("bytes=3000-"):
+            raise RuntimeError("read timeout")
+        return real(**kw)
+    monkeypatch.setattr(worker.s3, "get_object", flaky)
+
+    ok, _ = _encode(worker, tmp_path)
+    assert not ok
+    assert "Contents" not in buckets.list_objects_v2(Bucket="converted-bucket")
+    assert not buckets.list_multipart_uploads(Bucket="converted-bucket").get("Uploads")
+
+
+def _box(kind, size):
+    return struct.pack(">I4s", size, kind) + b"\0" * (size - 8)
+
+
+@pytest.mark.parametrize("boxes, front", [((b"ftyp", b"moov", b"mdat"), True),
+                                          ((b"ftyp", b"mdat", b"moov"), False),
+                                          ((b"ftyp", b"free"), False)])
+def test_pipe_only_when_moov_is_at_the_head(worker, buckets, boxes, front):
+    body = b"".join(_box(kind, 32) for kind in boxes)
+    buckets.put_object(Bucket="upload-bucket", Key="in/b.mp4", Body=body)
+    assert worker._moov_before_mdat("upload-bucket", "in/b.mp4", len(body)) is front
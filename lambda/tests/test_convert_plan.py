@@ -0,0 +1,135 @@
+# convert-worker のプランナー: 入力の probe と Lambda のメモリ量から、コピー/再エンコード・threads・preset を決める
+# 投稿先の制約を満たす入力は S3 コピー（moov が先頭）か remux で済ませる
+import struct
+import pytest
+
+
+@pytest.fixture
+def worker(load_lambda, aws):
+    return load_lambda("lambda-convert-worker", JOB_STORE_BACKEND="memory", UPLOAD_BUCKET="upload-bucket")
+
+
+def _probe(**video):
+    return {"duration": 30.0,
+            "video": {"codec": "h264", "profile": "High", "pix_fmt": "yuv420p", "width": 1080, "height": 1920,
+                      "fps": 30.0, "kbps": 4000, **video},
+            "audio": {"codec": "aac", "sample_rate": 44100, "kbps": 128}}
+
+
+def test_compliant_input_is_stream_copied(worker):
+    plan = worker._plan_encoding(_probe(), {})
+    assert (plan["video"], plan["audio"], plan["scale"], plan["keep_fps"]) == ("copy", "copy", False, True)
+    cmd = worker._build_ffmpeg_cmd("in.mp4", "out.mp4", {}, plan=plan)
+    assert cmd[cmd.index("-c:v") + 1] == "copy" and cmd[cmd.index("-c:a") + 1] == "copy"
+    assert "-vf" not in cmd and "-r" not in cmd and "libx264" not in cmd
+
+
+@pytest.mark.parametrize("video, reason", [({"codec": "hevc"}, "codec"), ({"kbps": 9000}, "bitrate"),
+                                           ({"fps": 60.0}, "fps"), ({"width": 1081}, "odd width"),
+                                           ({"pix_fmt": "yuv422p"}, "pix_fmt"), ({"kbps": 0}, "unknown bitrate")])
+def test_video_outside_the_target_is_encoded(worker, video, reason):
+    plan = worker._plan_encoding(_probe(**video), {})
+    assert plan["video"] == "encode", reason
+    cmd = worker._build_ffmpeg_cmd("in.mp4", "out.mp4", {}, plan=plan)
+    assert "libx264" in cmd and cmd[cmd.index("-preset") + 1] == plan["preset"]
+    assert ("-vf" in cmd) == plan["scale"] and ("-r" in cmd) == (not plan["keep_fps"])
+
+
+@pytest.mark.parametrize("memory_mb, pixels, threads, preset", [
+    (1536, (1080, 1920), 1, "veryfast"),
+    (3008, (1080, 1920), 2, "faster"),
+    (3008, (2160, 3840), 2, "superfast"),   # 4K の縮小は少ない vCPU ではエンコードを軽くする
+    (7076, (2160, 3840), 4, "fast"),
+    (10240, (1080, 1920), 6, "medium"),
+])
+def test_threads_and_preset_follow_memory(worker, monkeypatch, memory_mb, pixels, threads, preset):
+    monkeypatch.setattr(worker, "LAMBDA_MEMORY_MB", memory_mb)
+    plan = worker._plan_encoding(_probe(codec="hevc", width=pixels[0], height=pixels[1]), {})
+    assert (plan["threads"], plan["preset"]) == (threads, preset)
+    cmd = worker._build_ffmpeg_cmd("in.mp4", "out.mp4", {}, plan=plan)
+    assert cmd[cmd.index("-threads") + 1] == str(threads)
+
+
+def test_audio_copy_none_and_encode(worker):
+    assert worker._plan_encoding({**_probe(), "audio": None}, {})["audio"] == "none"
+    assert worker._plan_encoding(_probe(), {"audio_samplerate": 48000})["audio"] == "encode"
+    no_audio = {k: v for k, v in _probe().items() if k != "audio"}
+    plan = worker._plan_encoding(no_audio, {})
+    assert plan["audio"] == "none" and "-an" in worker._build_ffmpeg_cmd("in.mp4", "out.mp4", {}, plan=plan)
+
+
+def test_failed_probe_encodes_everything(worker):
+    plan = worker._plan_encoding({}, {})
+    assert (plan["video"], plan["audio"], plan["scale"]) == ("encode", "encode", True)
+
+
+def test_rotated_input_uses_display_size(worker):
+    j = {"format": {"duration": "12.5"},
+         "streams": [{"codec_type": "video", "codec_name": "h264", "profile": "High", "pix_fmt": "yuv420p",
+                      "width": 1920, "height": 1080, "avg_frame_rate": "30000/1001", "bit_rate": "4000000",
+                      "side_data_list": [{"rotation": -90}]},
+                     {"codec_type": "audio", "codec_name": "aac", "sample_rate": "44100", "bit_rate": "128000"}]}
+    probe = worker._parse_ffprobe_json(j)
+    assert (probe["video"]["width"], probe["video"]["height"]) == (1080, 1920)
+    assert worker._plan_encoding(probe, {})["video"] == "copy"
+
+
+def test_banner_fallback_matches_ffprobe(worker):
+    err = ("  Duration: 00:00:12.50, start: 0.000000, bitrate: 4200 kb/s\n"
+           "  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(progressive), 1080x1920, "
+           "4000 kb/s, 29.97 fps, 29.97 tbr, 30k tbn (default)\n"
+           "  Stream #0:1[0x2](und): Audio: aac (LC) (mp4a / 0x6134706D), 44100 Hz, stereo, fltp, 128 kb/s (default)\n")
+    probe = worker._parse_ffmpeg_banner(err)
+    assert probe["duration"] == 12.5 and probe["video"]["profile"] == "High"
+    assert worker._plan_encoding(probe, {})["video"] == "copy"
+
+
+def _mp4(*kinds):
+    return b"".join(struct.pack(">I4s", 32, k) + b"\0" * 24 for k in kinds)
+
+
+@pytest.fixture
+def transcode(worker, buckets, monkeypatch, tmp_path):
+    """_transcode を ffmpeg 抜きで動かす。戻り値: (path, 組み立てた ffmpeg の引数 or None, 入力が pipe か)"""
+    def _run(probe, body, params=None):
+        buckets.put_object(Bucket="upload-bucket", Key="in/a.mp4", Body=body, Tagging="transcode=true")
+        monkeypatch.setattr(worker, "_probe_input", lambda src: probe)
+        built = []
+
+        def encode(build, dst_bucket, dst_key, out_meta, work, timings, feeder=None, stream=None):
+            built.append((build("out.mp4", False), feeder is not None))
+            return True
+        monkeypatch.setattr(worker, "_encode_to_s3", encode)
+        r = worker._transcode("upload-bucket", "in/a.mp4", len(body), "converted-bucket", "converted/a.mp4",
+                              params or {}, {"job-id": "j1"}, str(tmp_path))
+        assert r["ok"]
+        return (r["path"], *built[0]) if built else (r["path"], None, None)
+    return _run
+
+
+def test_compliant_input_with_moov_at_head_is_copied(transcode, buckets):
+    path, cmd, _ = transcode(_probe(), _mp4(b"ftyp", b"moov", b"mdat"))
+    assert path == "s3_copy" and cmd is None
+    head = buckets.head_object(Bucket="converted-bucket", Key="converted/a.mp4")
+    assert head["ContentType"] == "video/mp4" and head["Metadata"] == {"job-id": "j1"}
+    assert buckets.get_object_tagging(Bucket="converted-bucket", Key="converted/a.mp4")["TagSet"] == []
+
+
+def test_compliant_input_with_moov_at_tail_is_remuxed_from_file(transcode, tmp_path):
+    path, cmd, piped = transcode(_probe(), _mp4(b"ftyp", b"mdat", b"moov"))
+    assert path == "remux" and not piped
+    assert cmd[cmd.index("-i") + 1] == str(tmp_path / "input.mp4")
+    assert cmd[cmd.index("-c") + 1] == "copy" and "+faststart" in cmd
+
+
+@pytest.mark.parametrize("probe, params, expected", [
+    (_probe(codec="hevc"), {}, "transcode"),
+    ({**_probe(), "duration": 150.0}, {}, "transcode"),                          # X は 140 秒まで
+    ({**_probe(), "duration": 150.0}, {"platforms": ["instagram"]}, "s3_copy"),
+    ({}, {}, "transcode"),                                                       # probe に失敗
+])
+def test_platform_limits_decide_the_path(transcode, probe, params, expected):
+    path, cmd, piped = transcode(probe, _mp4(b"ftyp", b"moov", b"mdat"), params)
+    assert path == expected
+    if expected == "transcode":
+        assert piped and cmd[cmd.index("-i") + 1] == "pipe:0"
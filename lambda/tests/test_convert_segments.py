@@ -0,0 +1,128 @@
+# convert-worker の分割並列変換: セグメントの失敗が error のまま残ること（job_store は memory バックエンド）
+import pytest
+
+
+@pytest.fixture
+def worker(aws, load_lambda, monkeypatch):
+    mod = load_lambda("lambda-convert-worker", JOB_STORE_BACKEND="memory", UPLOAD_BUCKET="upload-bucket")
+    mod.table.put({"src_key": "in/a.mp4", "status": "processing", "seg_total": 3})
+    mod.convert_jobs.put({"job_id": "j1", "convert_status": "processing"})
+    mod.concatenated = []
+    monkeypatch.setattr(mod, "_concat_segments", lambda ev, total, started_at, work: mod.concatenated.append(total))
+    return mod
+
+
+def _encode(mod, monkeypatch, ok):
+    calls = []
+
+    def fake(build, dst_bucket, dst_key, out_meta, work, timings, feeder=None, stream=None):
+        calls.append(dst_key)
+        return ok
+    monkeypatch.setattr(mod, "_encode_to_s3", fake)
+    return calls
+
+
+def _segment(index):
+    return {"op": "segment", "bucket": "upload-bucket", "key": "in/a.mp4", "dst_bucket": "converted-bucket",
+            "dst_key": "converted/a.mp4", "params": {}, "out_meta": {"job-id": "j1"}, "plan": {},
+            "total": 3, "index": index, "start": index * 60.0, "duration": 60.0}
+
+
+def _state(mod):
+    return mod.table.get("in/a.mp4").to_item(), mod.convert_jobs.get("j1").get("convert_status")
+
+
+def test_all_segments_done_concatenates_once(worker, monkeypatch):
+    _encode(worker, monkeypatch, True)
+    results = [worker.lambda_handler(_segment(i), None) for i in (2, 0, 1, 1)]
+    assert [r.get("progress") for r in results] == ["1/3", "2/3", "concat", "3/3"]
+    assert worker.concatenated == [3]
+
+
+def test_failed_segment_stops_the_rest(worker, monkeypatch):
+    _encode(worker, monkeypatch, True)
+    assert worker.lambda_handler(_segment(2), None)["progress"] == "1/3"
+
+    _encode(worker, monkeypatch, False)
+    assert worker.lambda_handler(_segment(0), None) == {"ok": False, "index": 0}
+    item, convert_status = _state(worker)
+    assert item["status"] == "error" and item["seg_failed"] == 0 and convert_status == "error"
+
+    # 失敗の後に来たセグメントは変換せず、進捗で error を上書きしない
+    calls = _encode(worker, monkeypatch, True)
+    assert worker.lambda_handler(_segment(1), None)["state"] == "aborted"
+    assert calls == [] and worker.concatenated == []
+    item, convert_status = _state(worker)
+    assert item["status"] == "error" and item["progress"] == "1/3" and convert_status == "error"
+
+
+def test_segment_finishing_after_failure_is_not_counted(worker, monkeypatch):
+    """変換中に別のセグメントが失敗した場合（開始時の確認はすり抜けている）"""
+    def fail_meanwhile(build, dst_bucket, dst_key, out_meta, work, timings, feeder=None, stream=None):
+        worker.table.update("in/a.mp4", set={"status": "error", "seg_failed": 0})
+        worker.convert_jobs.update("j1", set={"convert_status": "error"})
+        return True
+    monkeypatch.setattr(worker, "_encode_to_s3", fail_meanwhile)
+    worker.table.update("in/a.mp4", add={"seg_done": {1}})
+    worker.table.update("in/a.mp4", add={"seg_done": {0}})
+
+    assert worker.lambda_handler(_segment(2), None)["state"] == "aborted"
+    item, convert_status = _state(worker)
+    assert item["seg_done"] == {0, 1} and item["status"] == "error" and convert_status == "error"
+    assert worker.concatenated == []
+
+
+@pytest.mark.parametrize("video, segmented", [("encode", True), ("copy", False)])
+def test_long_input_is_segmented_only_when_video_is_encoded(worker, monkeypatch, tmp_path, video, segmented):
+    monkeypatch.setattr(worker, "_moov_before_mdat", lambda *a: True)
+    monkeypatch.setattr(worker, "_presigned", lambda bucket, key: f"https://{bucket}/{key}")
+    monkeypatch.setattr(worker, "_probe_input", lambda url: {"duration": 600.0})
+    monkeypatch.setattr(worker, "_plan_encoding", lambda probe, params: {"scale": False, "keep_fps": True,
+                                                                        "video": video, "audio": "encode"})
+    monkeypatch.setattr(worker, "_check_compliance", lambda *a: ["audio_hz"])
+    monkeypatch.setattr(worker, "_start_segmented", lambda *a, **k: {"ok": True, "path": "segmented", "async": True})
+    calls = _encode(worker, monkeypatch, True)
+
+    r = worker._transcode("upload-bucket", "in/a.mp4", 100, "converted-bucket", "converted/a.mp4", {},
+                          {"job-id": "j1"}, str(tmp_path))
+    assert (r["path"] == "segmented") is segmented
+    assert calls == ([] if segmented else ["converted/a.mp4"])
+
+
+def _async_failure(payload, condition="RetriesExhausted"):
+    """EventInvokeConfig の OnFailure（宛先は自分自身）に届く形"""
+    return {"version": "1.0", "requestContext": {"condition": condition, "approximateInvokeCount": 3},
+            "requestPayload": payload, "responseContext": {"statusCode": 200, "functionError": "Unhandled"},
+            "responsePayload": {"errorMessage": "Task timed out after 600.00 seconds"}}
+
+
+def test_segment_that_dies_marks_the_job_failed(worker, monkeypatch):
+    _encode(worker, monkeypatch, True)
+    assert worker.lambda_handler(_segment(0), None)["progress"] == "1/3"
+
+    # index 1 はタイムアウトで落ち続けた（seg_failed を書かないまま）
+    r = worker.lambda_handler(_async_failure(_segment(1)), None)
+    assert r == {"ok": True, "index": 1, "state": "marked_failed"}
+    item, convert_status = _state(worker)
+    assert item["status"] == "error" and item["seg_failed"] == 1 and convert_status == "error"
+
+    calls = _encode(worker, monkeypatch, True)
+    assert worker.lambda_handler(_segment(2), None)["state"] == "aborted"
+    assert calls == [] and worker.concatenated == []
+
+
+def test_async_failure_does_not_override_finished_job(worker):
+    worker.table.update("in/a.mp4", set={"status": "done"})
+    assert worker.lambda_handler(_async_failure(_segment(1)), None)["state"] == "unchanged"
+    assert _state(worker)[0]["status"] == "done"
+    assert worker.lambda_handler(_async_failure({"Records": []}), None)["state"] == "logged"
+
+
+def test_cmd_log_redacts_presigned_urls(worker, monkeypatch, tmp_path, capsys):
+    src = "https://upload-bucket.s3.amazonaws.com/in/a.mp4?X-Amz-Signature=secret&X-Amz-Security-Token=tok"
+    monkeypatch.setattr(worker, "_run_ffmpeg", lambda cmd, feeder=None, sink=None: (1, f"{src}: Invalid data"))
+    worker._encode_to_s3(lambda dst, fragmented: ["ffmpeg", "-i", src, dst], "b", "k", {}, str(tmp_path), {},
+                         stream=False)
+    out = capsys.readouterr().out
+    assert "[CMD] ffmpeg -i https://upload-bucket.s3.amazonaws.com/in/a.mp4?<redacted>" in out
+    assert "secret" not in out and "tok" not in out
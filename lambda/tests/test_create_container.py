@@ -0,0 +1,31 @@
+# create_container: 成功時は convert_jobs に書かない（コンテナ ID はステートマシンで渡す）。失敗時だけ status を書く
+import pytest
+
+
+@pytest.fixture
+def create(load_lambda, jobs_table, monkeypatch):
+    mod = load_lambda("lambda_create_container")
+    monkeypatch.setattr(mod, "acquire", lambda *a, **k: None)
+    monkeypatch.setattr(mod, "observe", lambda *a, **k: None)
+    jobs_table.put_item(Item={"job_id": "j1", "status": "processing", "status_rank": 1, "updated_at": 100})
+
+    def _call(status, body):
+        monkeypatch.setattr(mod, "request", lambda *a, **k: {
+            "ok": status < 400, "status": status, "body": body, "timings": {"ttfb_ms": 42}, "headers": {}})
+        return mod.lambda_handler({"job": {"job_id": "j1", "ig_user_id": "178", "access_token": "t"},
+                                   "video_url": "https://v.example/v.mp4"}, None)
+    return _call
+
+
+def test_success_does_not_write_job(create, jobs_table):
+    res = create(200, {"id": "17890"})
+    assert res["ok"] and res["body"]["id"] == "17890"
+    assert jobs_table.get_item(Key={"job_id": "j1"})["Item"] == {
+        "job_id": "j1", "status": "processing", "status_rank": 1, "updated_at": 100}
+
+
+def test_failure_records_error(create, jobs_table):
+    assert not create(400, {"error": {"message": "bad video"}})["ok"]
+    item = jobs_table.get_item(Key={"job_id": "j1"})["Item"]
+    assert item["status"] == "ERROR,create_container,400"
+    assert "bad video" in item["error_detail"] and item["timing_create_container_ms"] == 42
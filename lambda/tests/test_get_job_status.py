@@ -0,0 +1,48 @@
+# /jobs の ETag: ページの中身が変わったら 304 にしない
+import json
+import pytest
+
+SITE = "https://a.example"
+
+
+@pytest.fixture
+def api(load_lambda, jobs_table):
+    for i, (job_id, ts) in enumerate((("j1", 100), ("j2", 200), ("j3", 300))):
+        jobs_table.put_item(Item={"job_id": job_id, "site_url": SITE, "wp_id": str(i), "status": "pending",
+                                  "updated_at": ts})
+    return load_lambda("lambda_get_job_status")
+
+
+def _get(api, etag=None, **qp):
+    r = api.lambda_handler({"queryStringParameters": {"site_url": SITE, **qp},
+                            "headers": {"If-None-Match": etag} if etag else {}}, None)
+    return r["statusCode"], r["headers"].get("ETag"), json.loads(r["body"]) if r["body"] else None
+
+
+def test_unchanged_listing_is_304(api):
+    code, etag, body = _get(api)
+    assert code == 200 and [j["job_id"] for j in body["jobs"]] == ["j3", "j2", "j1"]
+    assert _get(api, etag)[:2] == (304, etag)
+
+
+def test_delete_below_top_changes_etag(api, jobs_table):
+    _, etag, _ = _get(api)
+    jobs_table.delete_item(Key={"job_id": "j1"})
+    code, new, body = _get(api, etag)
+    assert code == 200 and new != etag and [j["job_id"] for j in body["jobs"]] == ["j3", "j2"]
+
+
+def test_same_second_update_of_another_job_changes_etag(api, jobs_table):
+    _, etag, _ = _get(api)
+    jobs_table.update_item(Key={"job_id": "j2"}, UpdateExpression="SET #s = :s, updated_at = :u",
+                           ExpressionAttributeNames={"#s": "status"}, ExpressionAttributeValues={":s": "17890", ":u": 300})
+    code, _, body = _get(api, etag)
+    assert code == 200 and {j["job_id"]: j["status"] for j in body["jobs"]}["j2"] == "17890"
+
+
+def test_second_page_change_changes_etag(api, jobs_table):
+    _, _, first = _get(api, limit="1")
+    _, etag, _ = _get(api, limit="1", cursor=first["next_cursor"])
+    jobs_table.update_item(Key={"job_id": "j2"}, UpdateExpression="SET #s = :s",
+                           ExpressionAttributeNames={"#s": "status"}, ExpressionAttributeValues={":s": "processing"})
+    assert _get(api, etag, limit="1", cursor=first["next_cursor"])[0] == 200
@@ -0,0 +1,32 @@
+# http_helpers の再試行待ち: Retry-After が壊れていても例外にせずバックオフへ
+import sys
+import pytest
+
+
+@pytest.fixture
+def http_helpers(load_lambda):
+    load_lambda("lambda_create_container")
+    return sys.modules["http_helpers"]
+
+
+@pytest.mark.parametrize("value", ["soon", "Mon, 99 Foo 2025", "inf", "nan"])
+def test_bad_retry_after_falls_back_to_backoff(http_helpers, value):
+    wait = http_helpers._retry_wait(503, {"retry-after": value}, 2)
+    assert 0 <= wait <= 0.5 * 2 ** 2
+
+
+def test_retry_after_seconds_and_date(http_helpers, monkeypatch):
+    assert http_helpers._retry_wait(503, {"retry-after": "7"}, 0) == 7
+    monkeypatch.setattr(http_helpers.time, "time", lambda: 1445412470.0)   # 2015-10-21 07:27:50 UTC
+    assert http_helpers._retry_wait(503, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0) == 10
+
+
+@pytest.mark.parametrize("method, retries, attempts", [("GET", None, 3), ("POST", None, 1), ("POST", 2, 3)])
+def test_post_is_not_retried_unless_asked(http_helpers, monkeypatch, method, retries, attempts):
+    calls = []
+    monkeypatch.setattr(http_helpers, "DEFAULT_RETRIES", 2)
+    monkeypatch.setattr(http_helpers.time, "sleep", lambda s: None)
+    monkeypatch.setattr(http_helpers, "_send_once",
+                        lambda *a: calls.append(a[0]) or (503, {"retry-after": "0"}, b"", {}))
+    res = http_helpers.request(method, "https://graph.example/v1/media", retries=retries)
+    assert res["status"] == 503 and res["attempts"] == attempts and len(calls) == attempts
@@ -0,0 +1,48 @@
+# /jobs/changes の watermark: 同じ秒に 2 回更新されたジョブも取りこぼさない
+import json, sys, time, base64
+import pytest
+
+SITE = "https://a.example"
+
+
+@pytest.fixture
+def feed(load_lambda, jobs_table):
+    return load_lambda("lambda_job_changes")
+
+
+@pytest.fixture
+def ddb_helpers(load_lambda, jobs_table):
+    load_lambda("lambda_check_status")
+    return sys.modules["ddb_helpers"]
+
+
+def _get(feed, **qp):
+    r = feed.lambda_handler({"queryStringParameters": {"site_url": SITE, **qp}}, None)
+    assert r["statusCode"] == 200, r["body"]
+    return json.loads(r["body"])
+
+
+def test_second_update_in_same_second_is_returned(feed, ddb_helpers, jobs_table, monkeypatch):
+    now = int(time.time())
+    monkeypatch.setattr(ddb_helpers.time, "time", lambda: now)
+    jobs_table.put_item(Item={"job_id": "j1", "site_url": SITE, "wp_id": "1", "status": "pending", "updated_at": now - 10})
+    wm = _get(feed)["watermark"]
+
+    assert ddb_helpers.set_status("j1", "processing")
+    r = _get(feed, watermark=wm)
+    assert [(j["job_id"], j["status"]) for j in r["jobs"]] == [("j1", "processing")]
+
+    # 同じ秒のうちにもう一度進んだ
+    assert ddb_helpers.set_status("j1", "17890")
+    r = _get(feed, watermark=r["watermark"])
+    assert [(j["job_id"], j["status"], j["updated_at"]) for j in r["jobs"]] == [("j1", "17890", now)]
+
+    # 変化が無ければ何も返さない
+    assert _get(feed, watermark=r["watermark"])["jobs"] == []
+
+
+def test_old_watermark_format_is_accepted(feed, jobs_table):
+    jobs_table.put_item(Item={"job_id": "j1", "site_url": SITE, "status": "pending", "updated_at": 100})
+    jobs_table.put_item(Item={"job_id": "j2", "site_url": SITE, "status": "pending", "updated_at": 100})
+    old = base64.urlsafe_b64encode(json.dumps({"t": 100, "ids": ["j1"]}).encode()).decode().rstrip("=")
+    assert [j["job_id"] for j in _get(feed, watermark=old)["jobs"]] == ["j2"]
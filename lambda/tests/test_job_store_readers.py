@@ -0,0 +1,94 @@
+# job_store に移した読み取り側（/jobs・/jobs/changes・cleanup）を memory / sqlite バックエンドで動かす
+import json, time
+import pytest
+
+SITE = "https://a.example"
+INDEX = "site_url-updated_at-index"
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend_env(request, tmp_path):
+    env = {"JOB_STORE_BACKEND": request.param}
+    if request.param == "sqlite":
+        env["JOB_STORE_SQLITE_PATH"] = str(tmp_path / "jobs.sqlite3")
+    return env
+
+
+def _seed(jobs, rows):
+    for job_id, ts in rows:
+        jobs.put({"job_id": job_id, "site_url": SITE, "wp_id": job_id[1:], "status": "pending", "updated_at": ts})
+
+
+def test_query_page_walks_index_in_both_directions(load_lambda, backend_env):
+    mod = load_lambda("lambda_get_job_status", **backend_env)
+    _seed(mod.jobs, [("j1", 100), ("j2", 200), ("j3", 200), ("j4", 300)])
+    mod.jobs.put({"job_id": "other", "site_url": "https://b.example", "updated_at": 250})
+
+    seen, start = [], None
+    while True:
+        page, start = mod.jobs.query_page(INDEX, "site_url", SITE, "updated_at", desc=True, limit=3, start=start,
+                                          fields=["updated_at"])
+        seen += [(r.job_id, r.updated_at, r.wp_id) for r in page]
+        if not start:
+            break
+    assert seen == [("j4", 300, ""), ("j3", 200, ""), ("j2", 200, ""), ("j1", 100, "")]
+
+    page, start = mod.jobs.query_page(INDEX, "site_url", SITE, "updated_at", gte=200)
+    assert [r.job_id for r in page] == ["j2", "j3", "j4"] and start is None
+    page, _ = mod.jobs.query_page(INDEX, "site_url", SITE, "updated_at", gt=200)
+    assert [r.job_id for r in page] == ["j4"]
+
+
+def test_job_status_pages_and_since(load_lambda, backend_env):
+    api = load_lambda("lambda_get_job_status", **backend_env)
+    _seed(api.jobs, [("j1", 100), ("j2", 200), ("j3", 300)])
+
+    def _get(**qp):
+        r = api.lambda_handler({"queryStringParameters": {"site_url": SITE, **qp}}, None)
+        return r["statusCode"], json.loads(r["body"])
+
+    code, first = _get(limit="2")
+    assert code == 200 and [j["job_id"] for j in first["jobs"]] == ["j3", "j2"]
+    _, second = _get(limit="2", cursor=first["next_cursor"])
+    assert [j["job_id"] for j in second["jobs"]] == ["j1"] and "next_cursor" not in second
+    _, newer = _get(since="100")
+    assert [(j["job_id"], j["wp_id"]) for j in newer["jobs"]] == [("j3", "3"), ("j2", "2")]
+    assert _get(site_url="https://none.example")[0] == 404
+
+
+def test_job_changes_same_second_update(load_lambda, backend_env):
+    feed = load_lambda("lambda_job_changes", **backend_env)
+    now = int(time.time())
+    _seed(feed.jobs, [("j1", now - 10)])
+
+    def _get(**qp):
+        r = feed.lambda_handler({"queryStringParameters": {"site_url": SITE, **qp}}, None)
+        assert r["statusCode"] == 200, r["body"]
+        return json.loads(r["body"])
+
+    wm = _get()["watermark"]
+    feed.jobs.update("j1", set={"status": "processing", "updated_at": now}, add={"rev": 1})
+    r = _get(watermark=wm)
+    assert [(j["job_id"], j["status"]) for j in r["jobs"]] == [("j1", "processing")]
+
+    feed.jobs.update("j1", set={"status": "17890", "updated_at": now}, add={"rev": 1})
+    r = _get(watermark=r["watermark"])
+    assert [(j["job_id"], j["status"]) for j in r["jobs"]] == [("j1", "17890")]
+    assert _get(watermark=r["watermark"])["jobs"] == []
+
+
+def test_cleanup_reads_jobs_from_store(load_lambda, backend_env, buckets):
+    cleanup = load_lambda("lambda_cleanup", IN_BUCKET="upload-bucket", OUT_BUCKET="converted-bucket", **backend_env)
+    for key in ("in/a.mp4", "in/b.mp4", "in/c.mp4"):
+        buckets.put_object(Bucket="upload-bucket", Key=key, Body=b"x")
+    cleanup.jobs.put({"job_id": "done", "status": "17890", "in_key": "in/a.mp4"})
+    cleanup.jobs.put({"job_id": "live", "status": "processing",
+                      "media_urls": ["https://upload-bucket.s3.amazonaws.com/in/b.mp4?X-Amz-Signature=s"]})
+
+    r = cleanup.lambda_handler({"mode": "sweep", "min_age_sec": 0}, None)
+    assert sorted(x["key"] for x in r["results"]) == ["in/a.mp4"]   # in/c.mp4 はジョブ無しのアップロード
+
+    r = cleanup.lambda_handler({"job_id": "live"}, None)
+    assert "failure" not in r and r["deleted"]["src"]
+    assert r["deleted"]["batch"] == [{"bucket": "upload-bucket", "key": "in/b.mp4"}]
+    assert [o["Key"] for o in buckets.list_objects_v2(Bucket="upload-bucket")["Contents"]] == ["in/c.mp4"]
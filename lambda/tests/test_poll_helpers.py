@@ -0,0 +1,89 @@
+# poll_helpers: check_after_secs に従った間隔・指数バックオフ・残り時間に収まらない待ちはステートマシンに返す
+import sys
+import pytest
+
+from conftest import FakeContext
+
+
+@pytest.fixture
+def poll_helpers(load_lambda):
+    load_lambda("lambda_check_status")
+    return sys.modules["poll_helpers"]
+
+
+class Clock:
+    def __init__(self, remaining=900.0):
+        self.t, self.slept, self.end = 0.0, [], remaining
+
+    def now(self):
+        return self.t
+
+    def sleep(self, s):
+        self.slept.append(s)
+        self.t += s
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0.0, self.end - self.t) * 1000)
+
+
+def _server(clock, hints, ready_at):
+    checks = []
+
+    def check():
+        checks.append(clock.now())
+        return clock.now() >= ready_at, hints[min(len(checks), len(hints)) - 1], "state"
+    return check, checks
+
+
+def test_follows_check_after_secs_inline(poll_helpers):
+    clock = Clock()
+    check, checks = _server(clock, [3, 7, 5], ready_at=10)
+    r = poll_helpers.poll(check, context=clock, clock=clock.now, sleep=clock.sleep)
+    assert r["done"] and clock.slept == [3, 7] and checks == [0, 3, 10]
+    assert r["poll"]["invocations"] == 1 and r["poll"]["checks"] == 3
+
+
+def test_backoff_without_hint_is_capped(poll_helpers, monkeypatch):
+    monkeypatch.setattr(poll_helpers.random, "uniform", lambda lo, hi: hi)
+    monkeypatch.setattr(poll_helpers, "INLINE_MAX_SEC", 1000)
+    clock = Clock(remaining=10000)
+    check, _ = _server(clock, [None], ready_at=200)
+    r = poll_helpers.poll(check, context=clock, clock=clock.now, sleep=clock.sleep)
+    assert r["done"] and clock.slept[:6] == [2, 4, 8, 16, 30, 30]
+
+
+def test_long_wait_is_handed_back_and_resumed_on_time(poll_helpers):
+    clock = Clock(remaining=20)
+    check, checks = _server(clock, [15], ready_at=15)
+    r = poll_helpers.poll(check, context=clock, clock=clock.now, sleep=clock.sleep)
+    # 15 秒待つと戻りの余裕（RESERVE_SEC）が残らない → ステートマシンの Wait に任せる
+    assert not r["done"] and r["wait_sec"] == 15 and clock.slept == []
+
+    clock.t, clock.end = 12.0, 72.0   # Wait を短く設定していて 3 秒早く呼ばれた
+    r = poll_helpers.poll(check, r["poll"], context=clock, clock=clock.now, sleep=clock.sleep)
+    assert r["done"] and clock.slept == [3.0] and checks == [0, 15]
+    assert r["poll"]["invocations"] == 2
+
+
+def test_deadline_times_out(poll_helpers):
+    clock = Clock()
+    check, checks = _server(clock, [30], ready_at=1000)
+    r = poll_helpers.poll(check, poll_helpers.start_state(50, 0.0), context=clock, clock=clock.now,
+                          sleep=clock.sleep)
+    assert r["timed_out"] and not r["done"] and checks == [0, 30]
+
+
+def test_x_poll_status_uses_check_after_secs(load_lambda, aws, jobs_table, monkeypatch):
+    load_lambda("lambda_poll_media_status", RATE_LIMIT_BACKEND="memory")
+    xpub = sys.modules["x_publisher"]
+    states = [{"state": "in_progress", "check_after_secs": 9}, {"state": "succeeded"}]
+    monkeypatch.setattr(xpub, "request", lambda method, url, **kw: {
+        "ok": True, "status": 200, "headers": {}, "timings": {},
+        "body": {"data": {"processing_info": states.pop(0)}}})
+    pub = xpub.XPublisher("tok", "j1")
+
+    first = pub.poll_status("m1", 180, None, FakeContext(15000))
+    assert first["complete"] is False and first["check_after"] == 9 and first["status"] == "in_progress"
+    first["poll"]["next_at"] -= 9   # ステートマシンの Wait で check_after 秒たった
+    second = pub.poll_status("m1", 180, first["poll"], FakeContext(60000))
+    assert second["complete"] and second["status"] == "succeeded" and second["poll"]["checks"] == 2
@@ -0,0 +1,67 @@
+# presign の put_batch / get_batch: request_id 付きの再送は同じ job_id / key を返し、ジョブを作り直さない
+import json
+import pytest
+
+
+@pytest.fixture
+def presign(load_lambda, buckets, kms_key, jobs_table):
+    mod = load_lambda("lambda_presign", IN_BUCKET="upload-bucket", OUT_BUCKET="converted-bucket", KMS_KEY_ID=kms_key)
+
+    def _call(body, **headers):
+        r = mod.lambda_handler({"headers": {"X-FB-Token": "fb", "X-Site-Url": "https://a.example", **headers},
+                                "body": json.dumps(body)}, None)
+        return r["statusCode"], json.loads(r["body"])
+    return _call
+
+
+def _batch(n, **extra):
+    return {"op": "put_batch", "wp_id": "7", "ig_user_id": "178", "caption": "c",
+            "files": [{"ext": "jpg"} for _ in range(n)], **extra}
+
+
+def _jobs(jobs_table):
+    return {i["job_id"]: i for i in jobs_table.scan()["Items"]}
+
+
+def test_replay_returns_the_same_files_and_creates_nothing(presign, jobs_table):
+    code, first = presign(_batch(3, request_id="req-1"))
+    assert code == 200 and first["created"] == 3 and not first["replayed"]
+    before = _jobs(jobs_table)
+
+    code, again = presign(_batch(3, request_id="req-1", caption="changed"))
+    assert code == 200 and again["created"] == 0 and again["replayed"]
+    assert [(f["job_id"], f["key"]) for f in again["files"]] == [(f["job_id"], f["key"]) for f in first["files"]]
+    assert _jobs(jobs_table) == before   # 再送で上書きしない（caption も最初のまま）
+
+
+def test_replay_with_more_files_creates_only_the_new_ones(presign, jobs_table):
+    _, first = presign(_batch(2), **{"X-Request-Id": "req-2"})
+    _, more = presign(_batch(3, request_id="req-2"))
+    assert more["created"] == 1 and [f["job_id"] for f in more["files"][:2]] == [f["job_id"] for f in first["files"]]
+    assert len(_jobs(jobs_table)) == 3
+
+
+def test_ids_are_scoped_by_site_and_request(presign, jobs_table):
+    _, a = presign(_batch(1, request_id="req-3"))
+    _, b = presign(_batch(1, request_id="req-3"), **{"X-Site-Url": "https://b.example"})
+    _, c = presign(_batch(1))
+    _, d = presign(_batch(1))
+    ids = {r["files"][0]["job_id"] for r in (a, b, c, d)}
+    assert len(ids) == 4 and len(_jobs(jobs_table)) == 4
+
+
+def test_without_wp_id_only_presigns(presign, jobs_table):
+    code, r = presign({"op": "put_batch", "files": [{"ext": "png"}, {"ext": "mp4"}]})
+    assert code == 200 and r["created"] == 0 and not r["replayed"]
+    assert [f["content_type"] for f in r["files"]] == ["image/png", "video/mp4"]
+    assert all("job_id" not in f and f["x_amz_tagging"] is None for f in r["files"]) and not _jobs(jobs_table)
+
+
+def test_get_batch_reports_each_item(presign):
+    code, r = presign({"op": "get_batch", "items": [{"key": "in/a.jpg"}, {"bucket": "other", "key": "x"},
+                                                    {"bucket": "converted-bucket", "key": ""}]})
+    assert code == 200
+    a, other, empty = r["items"]
+    assert a["bucket"] == "upload-bucket" and a["get_url"]
+    assert other["error"] == "bucket not allowed" and empty["error"] == "bucket and key required"
+    assert presign({"op": "get_batch", "items": []})[0] == 400
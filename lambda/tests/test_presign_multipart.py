@@ -0,0 +1,26 @@
+# presign の multipart_parts: part_numbers は整数の配列だけ受け付ける
+import json
+import pytest
+
+
+@pytest.fixture
+def presign(load_lambda, buckets, kms_key):
+    mod = load_lambda("lambda_presign", IN_BUCKET="upload-bucket", OUT_BUCKET="converted-bucket", KMS_KEY_ID=kms_key)
+    upload_id = buckets.create_multipart_upload(Bucket="upload-bucket", Key="in/v.mp4")["UploadId"]
+    return lambda **body: mod._multipart_parts({"key": "in/v.mp4", "upload_id": upload_id, **body})
+
+
+def test_part_numbers_list_of_ints(presign):
+    r = presign(part_numbers=[3, 1, 3])
+    assert r["statusCode"] == 200, r["body"]
+    assert [p["part_number"] for p in json.loads(r["body"])["parts"]] == [1, 3]
+
+
+@pytest.mark.parametrize("numbers", ["12", 5, {"1": 1}, ["1"], [True], [1.0], [1, None], []])
+def test_part_numbers_rejects_non_integers(presign, numbers):
+    assert presign(part_numbers=numbers)["statusCode"] == 400
+
+
+def test_start_count_still_work(presign):
+    r = presign(start=2, count=3)
+    assert [p["part_number"] for p in json.loads(r["body"])["parts"]] == [2, 3, 4]
@@ -0,0 +1,81 @@
+# 予約投稿（IG）: presign → convert-worker → convert-notifier で publish-at が待ち行列まで届くこと
+# ffmpeg を使わないよう、worker は変換キャッシュのヒット（サーバサイドコピー）の経路を通す
+import json, time
+import boto3
+import pytest
+
+from conftest import REGION
+
+
+@pytest.fixture
+def cache_table(aws):
+    return boto3.resource("dynamodb", region_name=REGION).create_table(
+        TableName="convert_cache", KeySchema=[{"AttributeName": "cache_key", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "cache_key", "AttributeType": "S"}], BillingMode="PAY_PER_REQUEST")
+
+
+@pytest.fixture
+def pipeline(load_lambda, jobs_table, src_table, queues_table, buckets, state_machines, kms_key, cache_table):
+    env = {"IN_BUCKET": "upload-bucket", "OUT_BUCKET": "converted-bucket", "KMS_KEY_ID": kms_key,
+           "UPLOAD_BUCKET": "upload-bucket", "CACHE_TABLE": "convert_cache", "SF_IG_POST_ARN": state_machines["ig"]}
+    return {
+        "presign": load_lambda("lambda_presign", **env),
+        "worker": load_lambda("lambda-convert-worker", **env),
+        "notifier": load_lambda("lambda_convert_notifier", **env),
+    }
+
+
+def _s3_event(bucket, key):
+    return {"Records": [{"s3": {"bucket": {"name": bucket}, "object": {"key": key}}}]}
+
+
+def _upload_and_convert(pipeline, s3, publish_at=None):
+    """presign の指示通りに PUT し、worker を通して出力キーを返す"""
+    body = {"wp_id": "10", "ig_user_id": "178", "ext": "mp4", "out_key": "converted/v.mp4",
+            "params": {"width": 720, "height": 1280}}
+    if publish_at is not None:
+        body["publish_at"] = publish_at
+    r = pipeline["presign"].lambda_handler(
+        {"headers": {"X-FB-Token": "fb", "X-Site-Url": "https://a.example"}, "body": json.dumps(body)}, None)
+    assert r["statusCode"] == 200, r["body"]
+    pre = json.loads(r["body"])
+    s3.put_object(Bucket=pre["bucket"], Key=pre["key"], Body=b"src", ContentType=pre["content_type"],
+                  Metadata=pre["x_amz_meta"], Tagging=pre["x_amz_tagging"])
+
+    # 同じ入力・params の変換結果がキャッシュにある状態にする
+    worker = pipeline["worker"]
+    head = s3.head_object(Bucket=pre["bucket"], Key=pre["key"])
+    ck = worker._cache_key(head["ETag"].strip('"'), head["ContentLength"], worker._parse_params(head["Metadata"]))
+    s3.put_object(Bucket="upload-bucket", Key=f"cache/{ck}.mp4", Body=b"converted")
+    worker.cache_table.put_item(Item={"cache_key": ck, "bucket": "upload-bucket", "key": f"cache/{ck}.mp4",
+                                      "size": 9, "expires_at": int(time.time()) + 3600})
+
+    r = worker.lambda_handler(_s3_event(pre["bucket"], pre["key"]), None)
+    assert r["results"][0]["path"] == "cache_hit"
+    return pre["job_id"], pre["out_key"]
+
+
+def test_publish_at_reaches_scheduler_queue(pipeline, buckets, jobs_table, queues_table):
+    publish_at = int(time.time()) + 3600
+    job_id, out_key = _upload_and_convert(pipeline, buckets, publish_at)
+
+    meta = buckets.head_object(Bucket="converted-bucket", Key=out_key)["Metadata"]
+    assert meta == {"job-id": job_id, "publish-at": str(publish_at)}
+
+    r = pipeline["notifier"].lambda_handler(_s3_event("converted-bucket", out_key), None)
+    assert r["results"][0]["state"] == "scheduled"
+    job = jobs_table.get_item(Key={"job_id": job_id})["Item"]
+    assert job["status"] == "scheduled" and int(job["publish_at"]) == publish_at
+    queue = queues_table.get_item(Key={"queue_key": job["sched_queue"]})["Item"]
+    assert int(queue["pending"]) == 1 and int(queue["next_at"]) == publish_at
+    assert not boto3.client("stepfunctions", region_name=REGION).list_executions(
+        stateMachineArn=pipeline["notifier"].SF_ARN)["executions"]
+
+
+def test_without_publish_at_starts_immediately(pipeline, buckets, queues_table):
+    job_id, out_key = _upload_and_convert(pipeline, buckets)
+
+    assert "publish-at" not in buckets.head_object(Bucket="converted-bucket", Key=out_key)["Metadata"]
+    r = pipeline["notifier"].lambda_handler(_s3_event("converted-bucket", out_key), None)
+    assert r["results"][0]["state"] == "sf_started"
+    assert not queues_table.scan()["Items"]
@@ -0,0 +1,110 @@
+# 予約投稿: lambda_start（X）→ lambda_publish_scheduler
+import json, time
+import boto3
+import pytest
+
+from conftest import REGION
+
+
+class Crash(BaseException):
+    """Lambda がタイムアウト等で途中で止まった代わり（except Exception では捕まらない）"""
+
+
+@pytest.fixture
+def env(jobs_table, queues_table, buckets, state_machines, kms_key):
+    return {"KMS_KEY_ID": kms_key, "STATE_MACHINE_ARN": state_machines["x"], "SF_X_ARN": state_machines["x"],
+            "SF_IG_POST_ARN": state_machines["ig"], "OWN_BUCKETS": "upload-bucket,converted-bucket"}
+
+
+@pytest.fixture
+def start(load_lambda, env):
+    return load_lambda("lambda_start", **env)
+
+
+@pytest.fixture
+def sched(load_lambda, env, start):
+    return load_lambda("lambda_publish_scheduler", **env)
+
+
+def _schedule_x(start, publish_at, media_urls=(), site="https://a.example"):
+    r = start.lambda_handler({"headers": {"X-X-Token": "tok", "X-Site-Url": site},
+                              "body": json.dumps({"wp_id": "1", "text": "t", "publish_at": publish_at,
+                                                  "media_urls": list(media_urls)})}, None)
+    body = json.loads(r["body"])
+    assert body.get("scheduled"), body
+    return body["job_id"]
+
+
+def _executions(arn):
+    return boto3.client("stepfunctions", region_name=REGION).list_executions(stateMachineArn=arn)["executions"]
+
+
+def test_x_media_urls_are_resigned_at_release(start, sched, buckets, jobs_table, monkeypatch):
+    T = int(time.time()) + 3600
+    own = buckets.generate_presigned_url("get_object", Params={"Bucket": "upload-bucket", "Key": "x/a.jpg"},
+                                         ExpiresIn=600)
+    other = "https://cdn.example/b.jpg"
+    job_id = _schedule_x(start, T, [own, other])
+    item = jobs_table.get_item(Key={"job_id": job_id})["Item"]
+    assert item["media_objects"] == [{"bucket": "upload-bucket", "key": "x/a.jpg"}, None]
+
+    monkeypatch.setattr(sched, "GET_EXPIRES", 7200)
+    assert sched.tick(now=T + 5)["started"] == 1
+    item = jobs_table.get_item(Key={"job_id": job_id})["Item"]
+    fresh, kept = item["media_urls"]
+    assert fresh != own and "/x/a.jpg" in fresh and kept == other
+    assert "sched_queue" not in item
+    assert [e["name"] for e in _executions(sched.SF_ARNS["x"])] == [job_id]
+
+
+def test_release_survives_crash_before_start(start, sched, jobs_table, queues_table, monkeypatch):
+    T = int(time.time()) + 3600
+    job_id = _schedule_x(start, T)
+
+    def crash(*a, **k):
+        raise Crash()
+    with monkeypatch.context() as m, pytest.raises(Crash):
+        m.setattr(sched.sf, "start_execution", crash)
+        sched.tick(now=T)
+
+    item = jobs_table.get_item(Key={"job_id": job_id})["Item"]
+    assert item["sched_queue"] and int(item["released_at"]) == T
+    # リースが切れるまでは他の起動も手を出さない
+    assert sched.tick(now=T + 60)["started"] == 0
+    assert sched.tick(now=T + sched.RELEASE_LEASE_SEC + 1)["started"] == 1
+    assert [e["name"] for e in _executions(sched.SF_ARNS["x"])] == [job_id]
+    assert "sched_queue" not in jobs_table.get_item(Key={"job_id": job_id})["Item"]
+    assert int(queues_table.scan()["Items"][0]["pending"]) == 0
+
+
+def test_release_after_crash_past_start_does_not_start_twice(start, sched, jobs_table, queues_table, monkeypatch):
+    T = int(time.time()) + 3600
+    job_id = _schedule_x(start, T)
+    # 起動はできたが sched_queue を消す前に止まった
+    real = sched.jobs.update
+
+    def crash_on_finish(kv, **kw):
+        if kw.get("remove") == ("sched_queue",):
+            raise Crash()
+        return real(kv, **kw)
+    with monkeypatch.context() as m, pytest.raises(Crash):
+        m.setattr(sched.jobs, "update", crash_on_finish)
+        sched.tick(now=T)
+
+    assert sched.tick(now=T + sched.RELEASE_LEASE_SEC + 1)["started"] == 1
+    assert len(_executions(sched.SF_ARNS["x"])) == 1
+    assert "sched_queue" not in jobs_table.get_item(Key={"job_id": job_id})["Item"]
+    assert int(queues_table.scan()["Items"][0]["pending"]) == 0
+
+
+def test_fair_release_across_accounts(start, sched, monkeypatch):
+    monkeypatch.setitem(sched.MAX_INFLIGHT, "x", 10)
+    T = int(time.time()) + 3600
+    ids = {site: [_schedule_x(start, T + i, site=site) for i in range(n)]
+           for site, n in (("https://a.example", 12), ("https://b.example", 2), ("https://c.example", 1))}
+    assert sched.tick(now=T + 100)["started"] == 10
+    names = {e["name"] for e in _executions(sched.SF_ARNS["x"])}
+    assert {site: len(names & set(v)) for site, v in ids.items()} == {
+        "https://a.example": 7, "https://b.example": 2, "https://c.example": 1}
+    # 実行中が上限なので次の起動では流さない
+    assert sched.tick(now=T + 160)["started"] == 0
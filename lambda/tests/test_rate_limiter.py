@@ -0,0 +1,82 @@
+# rate_limiter: 待ちは注入した sleep で行い、残り時間に収まらない待ちはその場で待たずに予約して返す
+import sys, time
+import pytest
+
+
+@pytest.fixture
+def rate_limiter(load_lambda):
+    load_lambda("lambda_create_container")
+    return sys.modules["rate_limiter"]
+
+
+def test_cas_backoff_uses_injected_sleep(rate_limiter, monkeypatch):
+    class Contended(rate_limiter.MemoryBackend):
+        fails = 3
+
+        def cas(self, key, state, version):
+            if self.fails:
+                self.fails -= 1
+                return False
+            return super().cas(key, state, version)
+
+    def _no_real_sleep(s):
+        raise AssertionError("time.sleep called")
+    monkeypatch.setattr(rate_limiter.time, "sleep", _no_real_sleep)
+
+    slept = []
+    lim = rate_limiter.RateLimiter(Contended(), clock=lambda: 0.0, sleep=slept.append)
+    assert lim._update("x", "acct", "tweets", lambda state, now: (dict(state), "done")) == "done"
+    assert len(slept) == 3 and all(0 <= s <= 0.5 for s in slept)
+
+
+@pytest.fixture
+def post_x(load_lambda, jobs_table, monkeypatch):
+    mod = load_lambda("lambda_post_x", RATE_LIMIT_BACKEND="memory")
+    rl, xp = sys.modules["rate_limiter"], sys.modules["x_publisher"]
+
+    def _no_inline_wait(s):
+        raise AssertionError(f"slept {s}s inside a 3 s function")
+    monkeypatch.setattr(rl.limiter(), "sleep", _no_inline_wait)
+    calls = []
+    monkeypatch.setattr(xp, "request", lambda *a, **k: calls.append(a) or {
+        "ok": True, "status": 201, "headers": {}, "body": {"data": {"id": "1"}}})
+    return mod, rl, calls
+
+
+def test_short_function_reserves_instead_of_sleeping(post_x):
+    from conftest import FakeContext
+    mod, rl, calls = post_x
+    # 10 秒後まで止められている（RATE_LIMIT_MAX_WAIT=20 以内なので、context が無ければその場で待つ長さ）
+    rl.observe("x", rl.account_key("tok"), "post", 429, {"x-rate-limit-reset": str(int(time.time()) + 10)})
+
+    r = mod.lambda_handler({"access_token": "tok", "text": "hi"}, FakeContext(3000))
+    assert r["error"] == "rate_limit" and 9 <= r["wait_seconds"] <= 12 and r["rate_reservation"]
+    assert calls == []
+
+
+def test_max_wait_for_leaves_room_for_the_call(rate_limiter):
+    from conftest import FakeContext
+    assert rate_limiter.max_wait_for(FakeContext(3000), 30) == 0
+    assert 8 <= rate_limiter.max_wait_for(FakeContext(60000), 50) <= 9
+    assert rate_limiter.max_wait_for(FakeContext(600000), 30) == rate_limiter.MAX_WAIT_SEC
+    assert rate_limiter.max_wait_for(None, 30) == rate_limiter.MAX_WAIT_SEC
+
+
+@pytest.mark.parametrize("headers", [{"retry-after": "inf"}, {"retry-after": "nan"}, {"retry-after": "1e999"},
+                                     {"retry-after": "Mon, 99 Foo 2025"}, {"x-rate-limit-reset": "inf"},
+                                     {"x-business-use-case-usage": '{"1": [{"estimated_time_to_regain_access": "inf"}]}'}])
+def test_non_finite_hints_do_not_block_forever(rate_limiter, headers):
+    lim = rate_limiter.RateLimiter(rate_limiter.MemoryBackend(), clock=lambda: 1000.0, sleep=lambda s: None)
+    lim.observe("ig", "178", "graph", 429, headers)
+    try:
+        lim.acquire("ig", "178", "graph", max_wait=0)
+    except rate_limiter.RateLimited as e:
+        assert int(e.wait_sec) <= 3600 * 10   # 既定の 10 間隔ぶんだけ止まる（inf にはならない）
+
+
+def test_retry_after_seconds_block_until_then(rate_limiter):
+    lim = rate_limiter.RateLimiter(rate_limiter.MemoryBackend(), clock=lambda: 1000.0, sleep=lambda s: None)
+    lim.observe("x", "acct", "post", 429, {"retry-after": "30"})
+    with pytest.raises(rate_limiter.RateLimited) as e:
+        lim.acquire("x", "acct", "post", max_wait=0)
+    assert e.value.wait_sec == 30
@@ -0,0 +1,30 @@
+# token_cipher（レイヤー）: エンベロープ暗号化と、cryptography が無いときの失敗
+import base64, sys
+import boto3
+import pytest
+
+from conftest import REGION
+
+
+@pytest.fixture
+def cipher(load_lambda, kms_key):
+    load_lambda("lambda_presign", KMS_KEY_ID=kms_key)
+    return sys.modules["token_cipher"]
+
+
+def test_round_trip_uses_one_data_key(cipher, kms_key):
+    tokens = [cipher.encrypt_token(f"tok{i}", kms_key) for i in range(5)]
+    assert all(t.startswith(cipher.PREFIX) for t in tokens)
+    assert [cipher.decrypt_token(t) for t in tokens] == [f"tok{i}" for i in range(5)]
+    assert cipher.stats["generate_data_key"] == 1 and cipher.stats["kms_decrypt"] == 1
+
+
+def test_legacy_kms_cipher_still_decrypts(cipher, kms_key):
+    blob = boto3.client("kms", region_name=REGION).encrypt(KeyId=kms_key, Plaintext=b"old")["CiphertextBlob"]
+    assert cipher.decrypt_token(base64.b64encode(blob).decode("ascii")) == "old"
+
+
+def test_missing_cryptography_fails_at_import(load_lambda, kms_key, monkeypatch):
+    monkeypatch.setitem(sys.modules, "cryptography.hazmat.primitives.ciphers.aead", None)
+    with pytest.raises(ImportError, match="cryptography"):
+        load_lambda("lambda_presign", KMS_KEY_ID=kms_key)
@@ -0,0 +1,101 @@
+# webhook_delivery: 再送のバックオフ・dead-letter・宛先ホストごとの同時送信数（キューは MemoryQueue）
+import json, time, threading
+import pytest
+
+
+@pytest.fixture
+def wh(load_lambda, monkeypatch):
+    mod = load_lambda("lambda_webhook_delivery")
+    monkeypatch.setattr(mod.random, "uniform", lambda lo, hi: hi)   # バックオフは上限側に固定
+    return mod
+
+
+def _responder(wh, monkeypatch, statuses, headers=None, delay=0.0):
+    """statuses を順に返す request の代わり（最後の値を繰り返す）。送信先ごとの呼び出しを記録する"""
+    calls, state = [], {"live": {}, "peak": {}}
+    lock = threading.Lock()
+
+    def _request(method, url, **kw):
+        host = url.split("/")[2]
+        with lock:
+            calls.append(url)
+            n = len(calls)
+            state["live"][host] = state["live"].get(host, 0) + 1
+            state["peak"][host] = max(state["peak"].get(host, 0), state["live"][host])
+        time.sleep(delay)
+        with lock:
+            state["live"][host] -= 1
+        status = statuses[min(n, len(statuses)) - 1]
+        return {"ok": 200 <= status < 300, "status": status, "body": b"", "headers": headers or {}}
+    monkeypatch.setattr(wh, "request", _request)
+    return calls, state["peak"]
+
+
+def _record(i=1, host="wp.example"):
+    return {"id": f"r{i}", "url": f"https://{host}/hook", "payload": {"i": i}, "attempt": 0}
+
+
+def _queues(wh):
+    q, dl = wh.MemoryQueue(), wh.MemoryQueue()
+    sent = []
+    send = q.send
+    q.send = lambda rec, delay=0: (sent.append(delay), send(rec, delay))
+    return q, dl, sent
+
+
+def test_retries_with_exponential_backoff(wh, monkeypatch):
+    calls, _ = _responder(wh, monkeypatch, [503, 502, 200])
+    q, dl, delays = _queues(wh)
+    q.send(_record())
+    delays.clear()
+
+    log = wh.run_local(q, dl)
+    assert log == [["retry"], ["retry"], ["delivered"]]
+    assert delays == [wh.BASE_DELAY_SEC, wh.BASE_DELAY_SEC * 2] and len(calls) == 3
+    assert not dl.items
+
+
+def test_dead_letter_after_max_attempts(wh, monkeypatch):
+    calls, _ = _responder(wh, monkeypatch, [500])
+    q, dl, _ = _queues(wh)
+    q.send(_record())
+
+    log = wh.run_local(q, dl, rounds=50)
+    assert log[-1] == ["dead"] and len(calls) == wh.MAX_ATTEMPTS
+    (_, dead), = dl.items
+    assert dead["attempt"] == wh.MAX_ATTEMPTS and dead["last_status"] == 500 and dead["state"] == "dead"
+
+
+@pytest.mark.parametrize("status, state", [(404, "dead"), (410, "dead"), (429, "retry"), (408, "retry")])
+def test_permanent_4xx_goes_straight_to_dead_letter(wh, monkeypatch, status, state):
+    _responder(wh, monkeypatch, [status])
+    q, dl, _ = _queues(wh)
+    assert wh.deliver([_record()], q, dl) == [state]
+    assert len(dl.items) == (state == "dead") and len(q.items) == (state == "retry")
+
+
+@pytest.mark.parametrize("retry_after, expected", [("120", 120), ("inf", None), ("nan", None),
+                                                   ("Wed, 21 Oct 2015 07:28:00 GMT", None)])
+def test_retry_after_is_honoured_or_ignored(wh, monkeypatch, retry_after, expected):
+    _responder(wh, monkeypatch, [503], headers={"retry-after": retry_after})
+    q, dl, delays = _queues(wh)
+    assert wh.deliver([_record()], q, dl) == ["retry"]
+    (_, rec), = q.items
+    assert rec["attempt"] == 1 and delays == [expected or wh.BASE_DELAY_SEC]
+
+
+def test_per_host_limit(wh, monkeypatch):
+    _, peak = _responder(wh, monkeypatch, [200], delay=0.05)
+    q, dl, _ = _queues(wh)
+    recs = [_record(i, "a.example") for i in range(6)] + [_record(i + 6, "b.example") for i in range(3)]
+    assert wh.deliver(recs, q, dl) == ["delivered"] * 9
+    assert peak["a.example"] == wh.PER_HOST_LIMIT and peak["b.example"] <= wh.PER_HOST_LIMIT
+
+
+def test_handler_reports_only_unsettled_records(wh, monkeypatch):
+    _responder(wh, monkeypatch, [500])
+    broken = wh.MemoryQueue()
+    broken.send = lambda rec, delay=0: (_ for _ in ()).throw(RuntimeError("sqs down"))
+    monkeypatch.setitem(wh._queues, None, broken)
+    r = wh.lambda_handler({"Records": [{"messageId": "m1", "body": json.dumps(_record())}]}, None)
+    assert r == {"batchItemFailures": [{"itemIdentifier": "m1"}]}
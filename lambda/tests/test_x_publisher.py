@@ -0,0 +1,392 @@
+# x_publisher（レイヤー）の append / Range 読み出し
+import sys, json, time, threading, urllib.parse
+import pytest
+
+
+@pytest.fixture
+def xpub(aws, load_lambda):
+    load_lambda("lambda_x_append", RATE_LIMIT_BACKEND="memory")
+    return sys.modules["x_publisher"]
+
+
+class FakeX:
+    """
+    X API とメディア配信元の代わり（x_publisher.request を差し替える）。
+      media     : {url: bytes}。Range 付き GET には 206 で該当部分を返す（honor_range=False なら 200 で全体）
+      states    : finalize / STATUS が順に返す processing_info（尽きたら succeeded）
+      fail_once : 最初の 1 回だけ 400 を返す segment_index の set
+    held は Range GET で取り出してから append の POST が終わるまで手元にあるチャンクの数（peak_held はその最大）
+    """
+
+    def __init__(self, media, honor_range=True, delay=0.0, states=()):
+        self.media, self.honor_range, self.delay = media, honor_range, delay
+        self.states = list(states)
+        self.fail_once = set()
+        self.calls, self.appended, self.posts = [], {}, []
+        self.held = self.peak_held = 0
+        self.lock = threading.Lock()
+        self.next_id = 100
+
+    def __call__(self, method, url, *, headers=None, body=None, json_body=None, form=None, timeout=None,
+                 retries=None, parse=None):
+        headers = headers or {}
+        path = urllib.parse.urlsplit(url).path
+        with self.lock:
+            self.calls.append((method, path, headers.get("Range")))
+        if method == "GET" and url in self.media:
+            return self._media(url, headers.get("Range"))
+        if path.endswith("/initialize"):
+            with self.lock:
+                self.next_id += 1
+                media_id = str(self.next_id)
+            return self._ok({"data": {"id": media_id, "expires_after_secs": 86400}})
+        if path.endswith("/append"):
+            return self._append(path.split("/")[-2], body)
+        if path.endswith("/finalize"):
+            return self._ok(json.dumps({"data": {"processing_info": self._state()}}))
+        if path == "/2/media/upload":
+            return self._ok({"data": {"processing_info": self._state()}})
+        if path == "/2/posts":
+            self.posts.append(json_body)
+            return self._ok({"data": {"id": f"post-{len(self.posts)}"}}, 201)
+        raise AssertionError(f"unexpected {method} {url}")
+
+    @staticmethod
+    def _ok(body, status=200):
+        return {"ok": True, "status": status, "body": body, "headers": {}, "timings": {}}
+
+    def _state(self):
+        with self.lock:
+            return self.states.pop(0) if self.states else {"state": "succeeded"}
+
+    def _media(self, url, rng):
+        data = self.media[url]
+        if rng and self.honor_range:
+            start, end = (int(x) for x in rng.split("=")[1].split("-"))
+            with self.lock:
+                self.held += 1
+                self.peak_held = max(self.peak_held, self.held)
+            return {"ok": True, "status": 206, "body": data[start:end + 1], "headers": {
+                "content-range": f"bytes {start}-{min(end, len(data) - 1)}/{len(data)}"}}
+        return {"ok": True, "status": 200, "body": data, "headers": {"content-length": str(len(data))}}
+
+    def _append(self, media_id, body):
+        head, chunk, _ = body
+        idx = int(head.split(b"\r\n")[3])
+        time.sleep(self.delay)
+        with self.lock:
+            if idx in self.fail_once:
+                self.fail_once.discard(idx)
+                return {"ok": False, "status": 400, "body": "bad segment", "headers": {}, "timings": {}}
+            self.appended.setdefault(media_id, {})[idx] = bytes(chunk)
+            if self.honor_range:
+                self.held -= 1
+        return {"ok": True, "status": 204, "body": "", "headers": {}, "timings": {}}
+
+    def uploaded(self, media_id):
+        segs = self.appended.get(media_id, {})
+        return b"".join(segs[i] for i in sorted(segs))
+
+
+@pytest.fixture
+def small_chunks(xpub, monkeypatch):
+    """セグメントを 1 KiB にして、多数のセグメントを小さなデータで回す"""
+    monkeypatch.setattr(xpub, "CHUNK_SIZE", 1024)
+    return 1024
+
+
+def test_append_parallel_refills_window_while_slow_segment_runs(xpub, monkeypatch):
+    """1 つのセグメントが遅くても、空いた枠には次のセグメントを投入する（まとめて待たない）"""
+    events, lock = [], threading.Lock()
+
+    def send(self, endpoint, media_type, idx, get_chunk):
+        with lock:
+            events.append(("start", idx))
+        time.sleep(0.3 if idx == 0 else 0.01)
+        with lock:
+            events.append(("end", idx))
+
+    monkeypatch.setattr(xpub.XPublisher, "_send_with_retry", send)
+    monkeypatch.setattr(xpub, "_checkpoint", lambda *a: None)
+    done = set()
+    total = xpub.XPublisher("tok", "job")._append_parallel(
+        "https://upload.example/append", "video/mp4", "https://media.example/v.mp4",
+        6 * xpub.CHUNK_SIZE, done, 2, None)
+
+    assert total == 6 and done == set(range(6))
+    assert events.index(("start", 5)) < events.index(("end", 0))
+    # 同時に走るのは concurrency 個まで
+    inflight = peak = 0
+    for kind, _ in events:
+        inflight += 1 if kind == "start" else -1
+        peak = max(peak, inflight)
+    assert peak == 2
+
+
+def test_append_parallel_stops_on_segment_error(xpub, monkeypatch):
+    def send(self, endpoint, media_type, idx, get_chunk):
+        if idx == 1:
+            raise xpub.SegmentError(idx, 400, "bad")
+
+    monkeypatch.setattr(xpub.XPublisher, "_send_with_retry", send)
+    monkeypatch.setattr(xpub, "_checkpoint", lambda *a: None)
+    done = set()
+    with pytest.raises(xpub.SegmentError):
+        xpub.XPublisher("tok", "job")._append_parallel(
+            "https://upload.example/append", "video/mp4", "https://media.example/v.mp4",
+            20 * xpub.CHUNK_SIZE, done, 2, None)
+    assert 1 not in done and len(done) < 19
+
+
+class FakeSource:
+    """media の GET（Range 対応 / 非対応）と append の POST を記録する request の代わり"""
+
+    def __init__(self, data, honor_range):
+        self.data, self.honor_range = data, honor_range
+        self.gets, self.posts = [], []
+
+    def __call__(self, method, url, headers=None, body=None, json_body=None, timeout=None, retries=None, parse=None):
+        if method == "POST":
+            self.posts.append(sum(len(b) for b in body))
+            return {"ok": True, "status": 204, "headers": {}, "body": ""}
+        rng = (headers or {}).get("Range")
+        self.gets.append(rng)
+        if rng and self.honor_range:
+            start, end = (int(x) for x in rng.split("=")[1].split("-"))
+            return {"ok": True, "status": 206, "body": self.data[start:end + 1],
+                    "headers": {"content-range": f"bytes {start}-{end}/{len(self.data)}"}}
+        return {"ok": True, "status": 200, "body": self.data, "headers": {"content-length": str(len(self.data))}}
+
+
+@pytest.mark.parametrize("honor_range, expected_gets", [(True, 4), (False, 1)])
+def test_append_reads_source_once_when_range_is_ignored(xpub, jobs_table, monkeypatch, honor_range, expected_gets):
+    data = bytes(range(256)) * (10 * 1024 * 1024 // 256)   # 10 MiB = 3 セグメント
+    src = FakeSource(data, honor_range)
+    monkeypatch.setattr(xpub, "request", src)
+    res = xpub.XPublisher("tok", "").append("m1", "https://media.example/v.mp4", "video/mp4", concurrency=2)
+
+    assert res["status"] == "appended" and res["uploaded_segments"] == 3 and res["total_bytes"] == len(data)
+    assert len(src.gets) == expected_gets
+    assert len(src.posts) == 3 and sum(src.posts) > len(data)
+
+
+def test_ranged_append_holds_at_most_the_byte_budget(xpub, jobs_table, small_chunks, monkeypatch):
+    """Range GET はセグメントの境界どおり・1 回ずつ。手元のチャンクは APPEND_MAX_INFLIGHT_BYTES 分まで"""
+    data = bytes(range(256)) * 41   # 10.25 セグメント
+    url = "https://media.example/v.mp4"
+    x = FakeX({url: data}, delay=0.02)
+    monkeypatch.setattr(xpub, "request", x)
+    monkeypatch.setattr(xpub, "APPEND_MAX_INFLIGHT_BYTES", 3 * small_chunks)
+
+    res = xpub.XPublisher("tok", "j1").append("m1", url, "video/mp4", total_bytes=len(data), concurrency=8)
+    assert res["status"] == "appended" and res["uploaded_segments"] == 11
+    ranges = sorted(rng for method, _, rng in x.calls if method == "GET")
+    assert ranges == sorted(f"bytes={i * 1024}-{min(i * 1024 + 1023, len(data) - 1)}" for i in range(11))
+    assert x.uploaded("m1") == data
+    assert x.peak_held == 3 and x.held == 0
+
+
+def test_session_resumes_after_failed_append(xpub, jobs_table, small_chunks, monkeypatch):
+    """途中で失敗した append は、次の実行で同じ media_id のまま未送信のセグメントだけを送る"""
+    data = bytes(range(256)) * 20   # 5 セグメント
+    url = "https://media.example/v.mp4"
+    x = FakeX({url: data})
+    x.fail_once = {3}
+    monkeypatch.setattr(xpub, "request", x)
+    pub = xpub.XPublisher("tok", "j1")
+
+    init = pub.initialize(url)
+    assert init["status"] == "initialized"
+    first = pub.append(init["media_id"], url, init["media_type"], total_bytes=init["total_bytes"])
+    assert first["segment_index"] == 3 and first["completed_segments"] == [0, 1, 2]
+
+    again = xpub.XPublisher("tok", "j1").initialize(url)
+    assert again["status"] == "resumed" and again["media_id"] == init["media_id"]
+    x.calls.clear()
+    second = pub.append(again["media_id"], url, again["media_type"], total_bytes=again["total_bytes"])
+    assert second["status"] == "appended"
+    assert sorted(rng for method, _, rng in x.calls if method == "GET") == ["bytes=3072-4095", "bytes=4096-5119"]
+    assert x.uploaded(init["media_id"]) == data
+    assert sum(1 for _, path, _ in x.calls if path.endswith("/initialize")) == 0
+
+
+def test_changed_object_starts_a_new_session(xpub, jobs_table, monkeypatch):
+    url = "https://media.example/v.mp4"
+    x = FakeX({url: b"v" * 10})
+    monkeypatch.setattr(xpub, "request", x)
+    pub = xpub.XPublisher("tok", "j1")
+    probe = {"size": 10, "mime": "video/mp4", "etag": "e1", "source": "test"}
+
+    first = pub.initialize(url, probe=probe)
+    assert pub.initialize(url, probe=probe)["media_id"] == first["media_id"]
+    changed = pub.initialize(url, probe={**probe, "etag": "e2"})
+    assert changed["status"] == "initialized" and changed["media_id"] != first["media_id"]
+
+
+@pytest.fixture
+def xpub_own(aws, load_lambda, buckets):
+    load_lambda("lambda_x_initialize", RATE_LIMIT_BACKEND="memory", OWN_BUCKETS="upload-bucket")
+    return sys.modules["x_publisher"]
+
+
+def test_probe_own_bucket_uses_head_object_and_caches(xpub_own, jobs_table, buckets, monkeypatch):
+    buckets.put_object(Bucket="upload-bucket", Key="in/a.mp4", Body=b"v" * 1234, ContentType="video/mp4")
+    url = "https://upload-bucket.s3.ap-northeast-1.amazonaws.com/in/a.mp4?X-Amz-Signature=s"
+    x = FakeX({})
+    monkeypatch.setattr(xpub_own, "request", x)
+
+    pub = xpub_own.XPublisher("tok", "j1")
+    first = pub.probe(url)
+    assert (first["source"], first["size"], first["mime"]) == ("head_object", 1234, "video/mp4") and first["etag"]
+    second = pub.probe(url)
+    assert second["source"] == "cache" and second["size"] == 1234 and second["etag"] == first["etag"]
+    assert x.calls == []
+
+
+@pytest.mark.parametrize("honor_range", [True, False])
+def test_probe_other_hosts_reads_one_byte(xpub_own, jobs_table, monkeypatch, honor_range):
+    """Range 対応なら Content-Range、非対応（200 で全体）なら Content-Length からサイズを得る"""
+    url = "https://cdn.example/v.mp4"
+    x = FakeX({url: b"v" * 5000}, honor_range=honor_range)
+    monkeypatch.setattr(xpub_own, "request", x)
+
+    probe = xpub_own.XPublisher("tok", "j1").probe(url)
+    assert probe["source"] == "range" and probe["size"] == 5000
+    assert x.calls == [("GET", "/v.mp4", "bytes=0-0")]
+
+
+def test_initialize_does_not_download_the_body(xpub_own, jobs_table, monkeypatch):
+    url = "https://cdn.example/v.mp4"
+    x = FakeX({url: b"v" * 5000})
+    monkeypatch.setattr(xpub_own, "request", x)
+
+    init = xpub_own.XPublisher("tok", "j1").initialize(url)
+    assert init["status"] == "initialized" and init["total_bytes"] == 5000 and init["media_type"] == "video/mp4"
+    assert [(m, rng) for m, _, rng in x.calls] == [("GET", "bytes=0-0"), ("POST", None)]
+
+
+def _media(n, size=3000):
+    return {f"https://media.example/{i}.jpg": bytes([i]) * size for i in range(n)}
+
+
+def test_publish_runs_every_stage_in_one_invocation(xpub, jobs_table, monkeypatch):
+    from conftest import FakeContext
+    media = _media(2)
+    x = FakeX(media)
+    monkeypatch.setattr(xpub, "request", x)
+
+    r = xpub.XPublisher("tok-022a", "j1").publish("hello", list(media), context=FakeContext(60000))
+    assert r["status"] == "success" and r["fast_path"] and r["x_post_id"] == "post-1"
+    assert x.posts == [{"text": "hello", "media": {"media_ids": r["media_ids"]}}]
+    for url, data in media.items():
+        assert x.uploaded(r["media_ids"][list(media).index(url)]) == data
+    stages = [path.rsplit("/", 1)[-1] for method, path, _ in x.calls if method == "POST"]
+    assert stages.count("initialize") == 2 and stages.count("finalize") == 2 and stages[-1] == "posts"
+
+
+@pytest.mark.parametrize("remaining_ms, size, reason", [(5000, 10, "time_budget"),
+                                                        (60000, 17 * 1024 * 1024, "media too large")])
+def test_publish_falls_back_before_uploading(xpub, jobs_table, monkeypatch, remaining_ms, size, reason):
+    from conftest import FakeContext
+    url = "https://media.example/v.mp4"
+    probe = {"size": size, "mime": "video/mp4", "etag": "e", "source": "test"}
+    monkeypatch.setattr(xpub.XPublisher, "probe", lambda self, u: probe)
+    x = FakeX({url: b""})
+    monkeypatch.setattr(xpub, "request", x)
+
+    r = xpub.XPublisher("tok-022b", "j1").publish("hi", [url], context=FakeContext(remaining_ms))
+    assert r["fast_path"] is False and r["stage"] == "upload_media" and r["reason"].startswith(reason)
+    assert x.calls == []
+
+
+def test_publish_hands_long_processing_to_the_state_machine(xpub, jobs_table, monkeypatch):
+    """処理待ちが残り時間に収まらなければ media を返し、次の呼び出しは送信済みのメディアを送り直さない"""
+    from conftest import FakeContext
+    media = _media(1)
+    x = FakeX(media, states=[{"state": "in_progress", "check_after_secs": 20}] * 2)
+    monkeypatch.setattr(xpub, "request", x)
+    pub = xpub.XPublisher("tok-022c", "j1")
+
+    r = pub.publish("hi", list(media), context=FakeContext(25000))
+    assert r["fast_path"] is False and r["reason"] == "media_processing" and r["wait_sec"] == 20
+    (item,) = r["media"]
+    assert item["status"] == "processing" and item["media_id"]
+
+    item["poll"]["next_at"] = 0   # ステートマシンの Wait が終わった
+    x.calls.clear()
+    items = pub.upload_all(list(media), previous=r["media"], context=FakeContext(60000))
+    assert items[0]["status"] == "succeeded" and items[0]["media_id"] == item["media_id"]
+    assert [path for _, path, _ in x.calls] == ["/2/media/upload"]
+
+
+def test_publish_rate_limited_post_keeps_media_ids(xpub, jobs_table, monkeypatch):
+    from conftest import FakeContext
+    media = _media(1)
+    monkeypatch.setattr(xpub, "request", FakeX(media))
+    pub = xpub.XPublisher("tok-022d", "j1")
+    rl = sys.modules["rate_limiter"]
+    rl.observe("x", pub.account, "post", 429, {"x-rate-limit-reset": str(int(time.time()) + 600)})
+
+    r = pub.publish("hi", list(media), context=FakeContext(60000))
+    assert r["error"] == "rate_limit" and r["stage"] == "post" and len(r["media_ids"]) == 1
+    assert r["rate_reservation"] and r["wait_seconds"] > 500
+
+
+def test_upload_all_keeps_input_order_under_the_token_limit(xpub, jobs_table, monkeypatch):
+    """先頭のメディアが遅くても結果と media_ids は指定順。同じトークンの同時アップロードは MEDIA_PER_TOKEN 件まで"""
+    from conftest import FakeContext
+    media = _media(5)
+    urls = list(media)
+    monkeypatch.setattr(xpub, "request", FakeX(media))
+    monkeypatch.setattr(xpub, "MEDIA_PER_TOKEN", 2)
+    live, peak, finished, lock = [0], [0], [], threading.Lock()
+    real = xpub.XPublisher.upload_media
+
+    def upload_media(self, url, **kw):
+        with lock:
+            live[0] += 1
+            peak[0] = max(peak[0], live[0])
+        time.sleep(0.2 if url == urls[0] else 0.02)
+        try:
+            return real(self, url, **kw)
+        finally:
+            with lock:
+                live[0] -= 1
+                finished.append(url)
+    monkeypatch.setattr(xpub.XPublisher, "upload_media", upload_media)
+
+    pub = xpub.XPublisher("tok-023a", "j1")
+    items = pub.upload_all(urls + [urls[1]], context=FakeContext(60000))
+    assert [it["index"] for it in items] == list(range(6)) and [it["media_url"] for it in items] == urls + [urls[1]]
+    assert finished[-1] == urls[0] and peak[0] == 2 and len(finished) == 5   # 重複した URL は 1 回だけ
+    summary = xpub.media_summary(items)
+    assert summary["complete"] and summary["media_ids"][5] == summary["media_ids"][1]
+    assert len(set(summary["media_ids"])) == 5
+
+
+def test_upload_all_skips_items_already_succeeded(xpub, jobs_table, monkeypatch):
+    from conftest import FakeContext
+    media = _media(2)
+    urls = list(media)
+    x = FakeX(media)
+    monkeypatch.setattr(xpub, "request", x)
+    previous = [{"media_url": urls[0], "status": "succeeded", "media_id": "900", "index": 0}]
+
+    items = xpub.XPublisher("tok-023b", "j1").upload_all(urls, previous=previous, context=FakeContext(60000))
+    assert [it["status"] for it in items] == ["succeeded", "succeeded"] and items[0]["media_id"] == "900"
+    assert {rng for method, _, rng in x.calls if method == "GET"} <= {"bytes=0-0", "bytes=0-2999"}
+    assert x.uploaded("900") == b"" and x.uploaded(items[1]["media_id"]) == media[urls[1]]
+
+
+def test_publish_does_not_post_when_one_media_fails(xpub, jobs_table, monkeypatch):
+    from conftest import FakeContext
+    media = _media(3)
+    x = FakeX(media)
+    x.fail_once = {0}   # どのメディアも 1 セグメント → 最初に append したメディアが 400 で失敗する
+    monkeypatch.setattr(xpub, "request", x)
+    monkeypatch.setattr(xpub, "MEDIA_PER_TOKEN", 1)
+
+    r = xpub.XPublisher("tok-023c", "j1").publish("hi", list(media), context=FakeContext(60000))
+    assert r["error"] == "media_upload_failed" and r["failed"] == [0]
+    assert [it["status"] for it in r["media"]] == ["failed", "succeeded", "succeeded"]
+    assert r["media"][0]["stage"] == "append" and x.posts == []